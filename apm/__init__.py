@@ -1,12 +1,19 @@
 # coding=utf-8
 
+import os
 from typing import Dict, List
 
 from tornado.options import options
+from twisted.internet import task
 
+from util.exception import print_frame
 from util.message import WampMessage
 
 
+def ws_compression() -> List[str]:
+    return [x.strip() for x in options.ws_compression.split(",") if x.strip()]
+
+
 class ApmApp:
     def __init__(self) -> None:
         from .buffer import ApmBuffer
@@ -39,20 +46,82 @@ class ApmApp:
 
                 self.messages.append(message)
 
-            from util.message import WsClientMessage
-
-            for index in range(options.shard * options.apm_multiple):
-                client = WsClientMessage()
-                client.run(options.apm_client.format(port=index))
-                self.connections[index] = (client, list(), list())
+            self.slaves_mtime: float = None
+            self.load_slaves()
+            self.slaves_looper = task.LoopingCall(self.load_slaves)
+            self.slaves_looper.start(10, now=False)
 
         else:
             self.proxy = ApmProxy(self.buffer)
 
             from util.message import WsServerMessage
-            server = WsServerMessage()
+            from .slave import APM_PROTOCOL
+            server = WsServerMessage([APM_PROTOCOL], ws_compression())
             server.add_slot(
                 WsServerMessage.recv_message,
                 self.proxy.handle_slave
             )
             server.run(options.apm_server.format(port=options.shard))
+
+        if options.apm_stats_port:
+            from .stats import ApmStatsApp
+            self.stats = ApmStatsApp()
+            self.stats.listen(options.apm_stats_port, address="127.0.0.1")
+
+    def read_slaves(self) -> Dict[str, int]:
+        """
+        apm_slaves lists one "address [weight]" per line; without it the
+        slaves are apm_client over shard * apm_multiple ports.
+        """
+        path = options.apm_slaves
+        if not path:
+            return {
+                options.apm_client.format(port=index): 1
+                for index in range(options.shard * options.apm_multiple)
+            }
+
+        mtime = os.stat(path).st_mtime
+        if mtime == self.slaves_mtime:
+            return None
+
+        weights: Dict[str, int] = dict()
+        with open(path, encoding='utf-8') as fp:
+            for line in fp:
+                items = line.split()
+                if not items or items[0].startswith('#'):
+                    continue
+                weights[items[0]] = int(items[1]) if len(items) > 1 else 1
+        self.slaves_mtime = mtime
+        return weights
+
+    def load_slaves(self) -> None:
+        try:
+            weights = self.read_slaves()
+        except (OSError, ValueError) as e:
+            print_frame(e)
+            return
+
+        if weights is None or weights == self.proxy.slaves.weights:
+            return
+
+        from util.message import WsClientMessage
+        from .slave import ApmSlaveWriter, APM_PROTOCOL
+
+        removed = [
+            self.connections.pop(address)
+            for address in list(self.connections) if address not in weights
+        ]
+
+        for address in weights:
+            if address not in self.connections:
+                client = WsClientMessage([APM_PROTOCOL], ws_compression())
+                client.run(address)
+                self.connections[address] = ApmSlaveWriter(
+                    client, options.apm_slave_pending
+                )
+
+        self.proxy.set_slaves(weights)
+        for writer in removed:
+            # lines not yet sent to a removed slave go to the new owners of their series
+            self.proxy.reroute(writer.pending)
+            writer.stop()
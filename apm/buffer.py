@@ -1,6 +1,7 @@
 # coding=utf-8
 
-from typing import Dict
+import unittest
+from typing import Dict, List, Tuple
 
 import numpy as np
 
@@ -63,10 +64,123 @@ class ApmLinkedList(object):
         return self.index
 
 
+class ApmMatrix(object):
+    """
+    Every series of one metric, one row per idc, over the last HISTORY 10s
+    buckets; bucket ts // 10 lives in column ts // 10 % HISTORY. The newest
+    LAG buckets are still filling, so detect() checks every bucket behind
+    them it has not checked yet against the BASELINE buckets before each,
+    for all rows at once. HISTORY is longer than a WINDOW so the buckets
+    skipped when newest jumps ahead keep their baseline until detect() runs.
+    A row is only checked up to the last bucket its series reported in, and
+    a series silent for a WINDOW gives its row back for the next new idc.
+    """
+
+    WINDOW = 9
+    LAG = 2
+    BASELINE = WINDOW - LAG - 1
+    HISTORY = 2 * WINDOW
+
+    def __init__(self, capacity: int=16) -> None:
+        self.rows: Dict[str, int] = dict()
+        self.points: List = list()
+        self.values = np.zeros((capacity, self.HISTORY))
+        # last bucket each row reported in, -1 for a free row
+        self.seen = np.full(capacity, -1, dtype=np.int64)
+        self.free: List[int] = list()
+        self.newest = -1
+        self.checked = -1
+
+    def add(self, point) -> None:
+        row = self.rows.get(point.key)
+        if row is None:
+            if self.free:
+                row = self.free.pop()
+                self.points[row] = point
+            else:
+                row = len(self.points)
+                if row == len(self.values):
+                    values = np.zeros((2 * row, self.HISTORY))
+                    values[:row] = self.values
+                    self.values = values
+                    seen = np.full(2 * row, -1, dtype=np.int64)
+                    seen[:row] = self.seen
+                    self.seen = seen
+                self.points.append(point)
+            self.rows[point.key] = row
+        else:
+            self.points[row] = point  # latest tags for the alert
+
+        bucket = int(point.ts) // 10
+        if self.newest < 0:
+            self.newest = bucket  # history starts as zeros
+            self.checked = bucket - self.LAG
+
+        if bucket > self.newest:
+            if bucket - self.newest >= self.HISTORY:
+                self.values[:] = 0.0
+            else:
+                columns = [b % self.HISTORY for b in range(self.newest + 1, bucket + 1)]
+                self.values[:, columns] = 0.0
+            self.newest = bucket
+        elif bucket <= self.newest - self.HISTORY:
+            return  # too late, already out of the history
+
+        self.values[row, bucket % self.HISTORY] += point.value
+        if bucket > self.seen[row]:
+            self.seen[row] = bucket
+
+    def detect(self) -> List[Tuple[int, int, float, float, float]]:
+        """(row, bucket, value, avg, std) of every breach, in each bucket since the last check."""
+        self.evict()
+        last = self.newest - self.LAG
+        # the oldest bucket whose baseline is still held
+        first = max(self.checked + 1, self.newest - self.HISTORY + self.BASELINE + 1)
+        if last < first:
+            return []
+        self.checked = last
+
+        values = self.values[:len(self.points)]
+        seen = self.seen[:len(self.points)]
+        breaches: List[Tuple[int, int, float, float, float]] = list()
+        for bucket in range(first, last + 1):
+            baseline = values[:, [b % self.HISTORY for b in range(bucket - self.BASELINE, bucket)]]
+            current = values[:, bucket % self.HISTORY]
+            avg = baseline.mean(axis=1)
+            std = baseline.std(axis=1) + 0.1 #correct zero misinformation
+            # a series that went quiet is not a drop to zero
+            breach = (np.abs(current - avg) > 10*std) & (seen >= bucket)
+            breaches.extend(
+                (row, bucket, float(current[row]), float(avg[row]), float(std[row]))
+                for row in np.flatnonzero(breach).tolist()
+            )
+        return breaches
+
+    def evict(self) -> None:
+        """Frees the rows of series not seen within the WINDOW, once their buckets are checked."""
+        seen = self.seen[:len(self.points)]
+        dead = (seen >= 0) & (seen <= self.newest - self.WINDOW) & (seen <= self.checked)
+        for row in np.flatnonzero(dead).tolist():
+            del self.rows[self.points[row].key]
+            self.points[row] = None
+            self.values[row] = 0.0
+            self.seen[row] = -1
+            self.free.append(row)
+
+    def window(self, row: int, bucket: int) -> Tuple[List[float], List[int]]:
+        """The WINDOW buckets around a checked bucket, as the alert shows them."""
+        buckets = range(bucket + self.LAG - self.WINDOW + 1, bucket + self.LAG + 1)
+        return (
+            [float(self.values[row, b % self.HISTORY]) for b in buckets],
+            [b * 10 for b in buckets],
+        )
+
+
 class ApmBuffer:
     def __init__(self) -> None:
         self.buffer: Dict = dict()
         self.metrics: Dict = dict()
+        self.matrices: Dict[str, ApmMatrix] = dict()
         self.metric_cache: Dict = dict()
         self.tags_cache: Dict = dict()
 
@@ -101,56 +215,29 @@ class ApmBuffer:
     def add_list(self, item) -> bool:
         try:
             point = factory(item)
-            metric = self.metrics.get(point.metric, None) #metric as key
-            if metric is None:
-                metric = dict()
-                self.metrics[point.metric] = metric
-
-            buffer = metric.get(point.key, None) # idc as key
-            if buffer is None:
-                #buffer = (list(), list())   # buffer[0]:value, buffer[1]:ts
-                buffer = ([0, 0, 0, 0, 0], [0, 0, 0, 0, 0])   # buffer[0]:value, buffer[1]:ts
-                metric[point.key] = buffer
-
-            point_ts = int(point.ts/10) * 10
-            point_value = point.value
-
-            if point_ts in buffer[1]:
-                ts_index = buffer[1].index(point_ts)  # ts_index is the same as value_index
-                buffer[0][ts_index] += point_value
-            else:
-                if point_ts > buffer[1][-1]:  # cur_time is newer than the last timestamp
-                    buffer[0].append(point_value)
-                    buffer[1].append(point_ts)
-                    result, offset = self.std_3(buffer, point)
-                    #if result:  #remove alert point
-                        #buffer[0].pop(offset)
-                        #buffer[1].pop(offset)
-
-            if len(buffer[0]) >= 9:
-                buffer[0].pop(0)
-                buffer[1].pop(0)
+            matrix = self.matrices.get(point.metric, None) #metric as key
+            if matrix is None:
+                matrix = ApmMatrix()
+                self.matrices[point.metric] = matrix
+            matrix.add(point)
         except Exception as e:
             print("add_list():", e)
         return True
 
-    def std_3(self, buffer, point):
-        values = buffer[0]
-        ts = buffer[1]
-        offset = -3
-        warn = False
-        try:
-            cur_value = values[offset]
-            cur_ts = ts[offset]
-            avg = np.mean(values[:offset])
-            std = np.std(values[:offset]) + 0.1 #correct zero misinformation
-            if abs(cur_value - avg) > 10*std:
-                print("warning::", avg, std, values, ts, point.metric, point.key)
-                point.write_es(cur_value, avg, std, cur_ts, buffer)
-                warn = True
-        except Exception as e:
-            print("calc_std_3:", e)
-        return warn, offset
+    def detect(self) -> List[Tuple[str, str]]:
+        """Runs at each 10s boundary, returns the breaching (metric, idc) pairs."""
+        breaches: List[Tuple[str, str]] = list()
+        for metric, matrix in self.matrices.items():
+            try:
+                for row, bucket, value, avg, std in matrix.detect():
+                    point = matrix.points[row]
+                    buffer = matrix.window(row, bucket)
+                    print("warning::", avg, std, buffer[0], buffer[1], metric, point.key)
+                    point.write_es(value, avg, std, bucket * 10, buffer)
+                    breaches.append((metric, point.key))
+            except Exception as e:
+                print("detect():", metric, e)
+        return breaches
 
     def add_link(self, item) -> bool:
         point = factory(item)
@@ -185,3 +272,53 @@ class ApmBuffer:
             buffer.remove(buffer.head)
 
         return True
+
+
+class TestApmMatrix(unittest.TestCase):
+    class Point:
+        def __init__(self, key, ts, value):
+            self.key = key
+            self.ts = ts
+            self.value = value
+
+    def fill(self, matrix, start, stop, value=1.0):
+        for bucket in range(start, stop):
+            matrix.add(self.Point("idc", bucket * 10, value))
+
+    def test_detect(self):
+        matrix = ApmMatrix()
+        self.fill(matrix, 100, 110)
+        matrix.add(self.Point("idc", 1100, 100.0))
+        self.assertEqual(matrix.detect(), [])
+        self.fill(matrix, 111, 113)
+        self.assertEqual([(row, bucket) for row, bucket, *_ in matrix.detect()], [(0, 110)])
+        # checked once only
+        self.assertEqual(matrix.detect(), [])
+
+    def test_skipped(self):
+        matrix = ApmMatrix()
+        self.fill(matrix, 100, 110)
+        matrix.add(self.Point("idc", 1100, 100.0))
+        matrix.detect()
+        # newest jumps several buckets before the next detect, the spike is still checked
+        self.fill(matrix, 111, 116)
+        self.assertEqual([bucket for _, bucket, *_ in matrix.detect()], [110])
+        self.assertEqual(matrix.checked, 113)
+
+    def test_quiet(self):
+        matrix = ApmMatrix()
+        for bucket in range(100, 110):
+            matrix.add(self.Point("live", bucket * 10, 1.0))
+            matrix.add(self.Point("quiet", bucket * 10, 50.0))
+        matrix.detect()
+
+        for bucket in range(110, 120):
+            matrix.add(self.Point("live", bucket * 10, 1.0))
+            # going quiet is no drop alert
+            self.assertEqual(matrix.detect(), [])
+
+        # the quiet row is reclaimed and taken by the next new idc
+        self.assertEqual(list(matrix.rows), ["live"])
+        matrix.add(self.Point("new", 1200, 1.0))
+        self.assertEqual(matrix.rows["new"], 1)
+        self.assertEqual(float(matrix.values[1].sum()), 1.0)
@@ -0,0 +1,309 @@
+# coding=utf-8
+
+import os
+import tempfile
+import time
+import unittest
+from typing import Dict, List, Generator
+
+from twisted.application.internet import ClientService, backoffPolicy
+from twisted.internet import protocol, task
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+from util import reactor
+from util.exception import print_frame
+from .stats import stats
+
+
+@implementer(IPushProducer)
+class InfluxProtocol(protocol.Protocol):
+    # the transport pauses us while its send buffer is over its high-water mark
+    paused: bool = False
+
+    def connectionMade(self) -> None:
+        self.transport.registerProducer(self, True)
+        self.factory.shard.connected(self)
+
+    def pauseProducing(self) -> None:
+        self.paused = True
+
+    def resumeProducing(self) -> None:
+        self.paused = False
+        self.factory.shard.resumed()
+
+    def stopProducing(self) -> None:
+        pass
+
+    def connectionLost(self, reason: object=None) -> None:
+        self.factory.shard.disconnected(self)
+
+    def dataReceived(self, data: bytes) -> None:
+        pass
+
+
+class InfluxFactory(protocol.Factory):
+    protocol = InfluxProtocol
+
+    def __init__(self, shard: 'InfluxShard') -> None:
+        self.shard: InfluxShard = shard
+
+
+class InfluxShard:
+    """
+    One InfluxDB put listener, reached through a small pool of persistent
+    connections. Lines are buffered and written round robin over the open
+    connections that are not paused. While all are paused (a slow InfluxDB)
+    lines are held up to buffer_max bytes; beyond that, or while none is
+    open, they go to a spill file, which is replayed once a connection
+    comes back.
+    """
+
+    def __init__(self, index: int, host: str, port: int, pool_size: int,
+                 flush_size: int, spill_dir: str, spill_max: int,
+                 buffer_max: int=16 << 20) -> None:
+        self.index = index
+        self.address = "%s:%s" % (host, port)
+        self.flush_size = flush_size
+        self.buffer_max = buffer_max
+        self.spill_max = spill_max
+        self.spill_file = None
+        if spill_dir:
+            self.spill_file = os.path.join(spill_dir, "influx-%d.spill" % index)
+        self.replaying = False
+
+        self.buffer: List[str] = list()
+        self.buffer_bytes = 0
+        self.protocols: List[InfluxProtocol] = list()
+        self.next = 0
+
+        self.lines_written = 0
+        self.bytes_written = 0
+        self.lines_spilled = 0
+        self.lines_dropped = 0
+        self.connects = 0
+
+        self.services: List[ClientService] = list()
+        for _ in range(pool_size):
+            endpoint = TCP4ClientEndpoint(reactor(), host, port, timeout=10)
+            service = ClientService(
+                endpoint, InfluxFactory(self),
+                retryPolicy=backoffPolicy(initialDelay=1.0, maxDelay=60.0)
+            )
+            service.startService()
+            self.services.append(service)
+
+    def connected(self, proto: InfluxProtocol) -> None:
+        print("influx %s connected" % self.address)
+        self.protocols.append(proto)
+        self.connects += 1
+        if self.spill_file and not self.replaying and os.path.exists(self.spill_file):
+            self.replaying = True
+            task.cooperate(self.replay())
+
+    def disconnected(self, proto: InfluxProtocol) -> None:
+        if proto in self.protocols:
+            print("influx %s disconnected" % self.address)
+            self.protocols.remove(proto)
+
+    def writable(self) -> InfluxProtocol:
+        """The next connection round robin that is not paused, or None."""
+        for _ in range(len(self.protocols)):
+            self.next = (self.next + 1) % len(self.protocols)
+            proto = self.protocols[self.next]
+            if not proto.paused:
+                return proto
+        return None
+
+    def resumed(self) -> None:
+        if self.buffer:
+            self.flush()
+
+    def write(self, lines: List[str]) -> None:
+        self.buffer.extend(lines)
+        self.buffer_bytes += sum(len(line) for line in lines) + len(lines)
+        if self.buffer_bytes >= self.flush_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+
+        proto = self.writable()
+        if proto is None and self.protocols and self.buffer_bytes <= self.buffer_max:
+            # every connection is paused, hold on until one drains
+            return
+
+        lines, self.buffer, self.buffer_bytes = self.buffer, list(), 0
+        data = ("\n".join(lines) + "\n").encode()
+
+        if proto is None:
+            self.spill(data, len(lines))
+            return
+
+        proto.transport.write(data)
+        self.lines_written += len(lines)
+        self.bytes_written += len(data)
+
+    def spill(self, data: bytes, count: int) -> None:
+        if not self.spill_file:
+            self.lines_dropped += count
+            return
+
+        try:
+            size = os.path.getsize(self.spill_file) if os.path.exists(self.spill_file) else 0
+            if size + len(data) > self.spill_max:
+                self.lines_dropped += count
+                return
+
+            with open(self.spill_file, "ab") as fp:
+                fp.write(data)
+            self.lines_spilled += count
+        except OSError as e:
+            self.lines_dropped += count
+            print_frame(e)
+
+    def replay(self) -> Generator[None, None, None]:
+        # runs cooperatively so a large spill file does not stall the reactor
+        replaying = self.spill_file + ".replay"
+        try:
+            os.replace(self.spill_file, replaying)
+            with open(replaying, "rb") as fp:
+                while True:
+                    chunk = fp.read(self.flush_size)
+                    if not chunk:
+                        break
+                    # keep whole lines together, the rest goes with the next chunk
+                    chunk += fp.readline()
+                    proto = self.writable()
+                    while proto is None and self.protocols:
+                        # all paused, wait for the transports to drain
+                        yield task.deferLater(reactor(), 0.1, lambda: None)
+                        proto = self.writable()
+                    if proto is not None:
+                        proto.transport.write(chunk)
+                        self.lines_written += chunk.count(b"\n")
+                        self.bytes_written += len(chunk)
+                    else:
+                        rest = chunk + fp.read()
+                        self.spill(rest, rest.count(b"\n"))
+                        break
+                    yield None
+            os.unlink(replaying)
+        except OSError as e:
+            print_frame(e)
+        finally:
+            self.replaying = False
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "connections": len(self.protocols),
+            "buffered": len(self.buffer),
+            "buffered_bytes": self.buffer_bytes,
+            "paused": sum(1 for proto in self.protocols if proto.paused),
+            "lines_written": self.lines_written,
+            "bytes_written": self.bytes_written,
+            "lines_spilled": self.lines_spilled,
+            "lines_dropped": self.lines_dropped,
+            "connects": self.connects,
+        }
+
+
+class InfluxWriter:
+    """Shards are numbered over influx_addrs x influx_ports, like metric_shard expects."""
+
+    def __init__(self, addrs: str, ports: str, pool_size: int=2,
+                 flush_size: int=65536, flush_interval: float=1.0,
+                 spill_dir: str="", spill_max: int=256 << 20,
+                 buffer_max: int=16 << 20) -> None:
+        self.shards: Dict[int, InfluxShard] = dict()
+        self.unrouted = 0
+
+        if spill_dir:
+            try:
+                os.makedirs(spill_dir, exist_ok=True)
+            except OSError as e:
+                print_frame(e)
+                spill_dir = ""
+
+        index = 0
+        for host in addrs.split(":"):
+            for port in ports.split(":"):
+                self.shards[index] = InfluxShard(
+                    index, host, int(port), pool_size,
+                    flush_size, spill_dir, spill_max, buffer_max
+                )
+                index += 1
+
+        self.looper = task.LoopingCall(self.flush)
+        self.looper.start(flush_interval, now=False)
+
+    def write(self, shard: int, lines: List[str]) -> None:
+        influx = self.shards.get(shard)
+        if influx is None:
+            self.unrouted += len(lines)
+            return
+        influx.write(lines)
+
+    def flush(self) -> None:
+        start = time.time()
+        for influx in self.shards.values():
+            try:
+                influx.flush()
+            except Exception as e:
+                print_frame(e)
+        stats.observe("influx.flush", time.time() - start)
+
+    def stats(self) -> Dict[int, Dict[str, int]]:
+        return {index: influx.stats() for index, influx in self.shards.items()}
+
+
+class TestBackpressure(unittest.TestCase):
+    class Transport:
+        def __init__(self):
+            self.data = list()
+
+        def write(self, data):
+            self.data.append(data)
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # no pool, connections are attached by hand
+        self.shard = InfluxShard(0, "127.0.0.1", 8089, 0, 1 << 20, self.tmp.name, 1 << 20, 64)
+        self.proto = InfluxProtocol()
+        self.proto.factory = InfluxFactory(self.shard)
+        self.proto.transport = self.Transport()
+        self.shard.protocols.append(self.proto)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_write(self):
+        self.shard.write(["a v=1"])
+        self.shard.flush()
+        self.assertEqual(self.proto.transport.data, [b"a v=1\n"])
+
+    def test_paused(self):
+        self.proto.pauseProducing()
+        self.shard.write(["a v=1"])
+        self.shard.flush()
+        self.assertEqual(self.proto.transport.data, [])
+        self.assertEqual(self.shard.stats()["paused"], 1)
+        self.assertEqual(self.shard.buffer, ["a v=1"])
+
+        # draining the transport writes the held lines out
+        self.proto.resumeProducing()
+        self.assertEqual(self.proto.transport.data, [b"a v=1\n"])
+        self.assertEqual(self.shard.buffer, [])
+
+    def test_spill(self):
+        self.proto.pauseProducing()
+        lines = ["metric%02d v=1" % i for i in range(10)]
+        self.shard.write(lines)
+        self.shard.flush()
+        self.assertEqual(self.proto.transport.data, [])
+        self.assertEqual(self.shard.buffer_bytes, 0)
+        self.assertEqual(self.shard.lines_spilled, 10)
+        with open(self.shard.spill_file, "rb") as fp:
+            self.assertEqual(fp.read(), ("\n".join(lines) + "\n").encode())
@@ -1,33 +1,49 @@
 #encoding:utf8
 import json
+import sys
 import time
+import urllib.request
 
-def calc_metrics():
-    all_metric = dict()
-    s_time = time.time()
-    try:
-        while True:
-            e_time = time.time()
-            if e_time - s_time >= 10:
-                s_time = e_time
-                for i in range(48080,48096):
-                    file = open("/usr/local/cdntoolkit/ctk/apm/" + str(i) + ".txt")
-                    content = file.read()
-                    jd = json.loads(content)
-                    for metric, value in jd.items():
-                        temp = all_metric.get(metric, None)
-                        if temp is None:
-                            all_metric[metric] = 0
-                        all_metric[metric] += value
-                for _metric,_value in all_metric.items():
-                    print(_metric, int(_value/10))
-                    all_metric[_metric] = 0
-                print('------------------------------')
-            else:
-                time.sleep(0.1)
-    except Exception as e:
-        print("calc_metrics:", e)
+from tornado.options import options
+
+# python -m apm.master_count --apm_stats_port=<first stats port> [last stats port]
+
+
+def fetch(port):
+    url = "http://127.0.0.1:%d/apm/stats" % port
+    with urllib.request.urlopen(url, timeout=2) as response:
+        return json.loads(response.read().decode())
+
+
+def calc_metrics(ports, interval=10):
+    last = dict()
+    while True:
+        all_metric = dict()
+        for port in ports:
+            try:
+                for metric, value in fetch(port)["metrics"].items():
+                    all_metric[metric] = all_metric.get(metric, 0) + value
+            except Exception as e:
+                print("calc_metrics %d:" % port, e)
+
+        if last:
+            total = 0
+            for _metric, _value in sorted(all_metric.items()):
+                rate = (_value - last.get(_metric, 0)) / interval
+                total += rate
+                print(_metric, int(rate))
+            print('all', int(total))
+            print('------------------------------')
+        last = all_metric
+        time.sleep(interval)
 
 
 if __name__ == "__main__":
-    calc_metrics()
+    import options as current_options
+    current_options.load_options()
+    rest = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    first = options.apm_stats_port
+    if not first:
+        sys.exit("--apm_stats_port is not set")
+    end = int(rest[0]) if rest else first + 15
+    calc_metrics(range(first, end + 1))
@@ -1,7 +1,15 @@
 # coding=utf-8
 
+import itertools
 import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
 import time
+import unittest
+from typing import Dict, List, Tuple
 
 import requests
 from tornado.options import options
@@ -23,13 +31,6 @@ class Point:
 
     def write_es(self, cur_value, avg, std, ts, buffer):
         try:
-            meta = dict()
-            datas = []
-            meta["_index"] = "alert"
-            meta["_type"] = "monitor"
-            _meta = dict()
-            _meta["index"] = meta
-            __meta = json.dumps(_meta)
             __item = dict()
             __item["@timestamp"] = rfc3339_format(ts)
             __item["time_created"] = rfc3339_format(time.time())
@@ -45,22 +46,263 @@ class Point:
             __item["fall"] = int(cur_value - avg)
 
             __item["msg"] = '%s,%s'%(buffer[0], buffer[1])
-            _d = json.dumps(__item)
-            datas.append(__meta)
-            datas.append(_d)
-            _r = requests.post(
-                "http://{address}/_bulk".format(
-                    address=options.elasticsearch_offline
-                ),
-                data='\n'.join(datas) + '\n'
-            )
-
-            if _r.status_code != 200:
-                print(_r.text)
+            alert_sink().put(self.metric, self.key, ts, __item)
 
         except Exception as e:
             print("write_es " + str(e))
 
 
+class AlertSink:
+    """
+    Alerts are queued by the detectors and written to elasticsearch by a
+    background thread, in bulk requests of up to batch_size documents or
+    every flush_interval seconds over one keep-alive session. A (metric,
+    idc) pair alerts at most once per suppress seconds. A failed bulk is
+    retried, then appended to the spill file, which is replayed in
+    batch_size bulks after the next successful write.
+    """
+
+    META = json.dumps({"index": {"_index": "alert", "_type": "monitor"}})
+
+    def __init__(self, address: str, batch_size: int=500,
+                 flush_interval: float=1.0, suppress: int=60,
+                 spill_file: str="", spill_max: int=64 << 20,
+                 queue_size: int=10000, retries: int=3) -> None:
+        self.url = "http://{address}/_bulk".format(address=address)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.suppress = suppress
+        self.spill_file = spill_file
+        self.spill_max = spill_max
+        self.retries = retries
+
+        self.alerts: queue.Queue = queue.Queue(queue_size)
+        # detector threads of a worker pool share the sink
+        self.lock = threading.Lock()
+        self.last: Dict[Tuple[str, str], int] = dict()
+        self.pruned = 0
+        self.session = requests.Session()
+
+        self.queued = 0
+        self.suppressed = 0
+        self.dropped = 0
+        self.written = 0
+        self.spilled = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, metric: str, idc: str, ts: int, item: Dict) -> bool:
+        doc = json.dumps(item)
+        with self.lock:
+            last = self.last.get((metric, idc))
+            if last is not None and abs(ts - last) < self.suppress:
+                self.suppressed += 1
+                return False
+            self.last[(metric, idc)] = ts
+            self.prune(ts)
+
+            try:
+                self.alerts.put_nowait(doc)
+                self.queued += 1
+                return True
+            except queue.Full:
+                self.dropped += 1
+                return False
+
+    def prune(self, ts: int) -> None:
+        # called with the lock held; pairs that have not alerted within the
+        # window no longer suppress anything
+        if ts - self.pruned < self.suppress:
+            return
+        self.pruned = ts
+        for key in [key for key, last in self.last.items() if ts - last >= self.suppress]:
+            del self.last[key]
+
+    def run(self) -> None:
+        while True:
+            docs: List[str] = list()
+            deadline = time.time() + self.flush_interval
+            while len(docs) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    docs.append(self.alerts.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            if docs:
+                self.flush(docs)
+
+    def flush(self, docs: List[str]) -> None:
+        body = ''.join(self.META + '\n' + doc + '\n' for doc in docs)
+        if self.post(body):
+            self.written += len(docs)
+            self.replay()
+        else:
+            self.spill(body, len(docs))
+
+    def post(self, body: str) -> bool:
+        for attempt in range(self.retries):
+            try:
+                _r = self.session.post(self.url, data=body.encode(), timeout=10)
+                if _r.status_code == 200:
+                    return True
+                print("write_es", _r.status_code, _r.text[:200])
+            except Exception as e:
+                print("write_es " + str(e))
+            time.sleep(2 ** attempt)
+        return False
+
+    def spill(self, body: str, count: int) -> None:
+        try:
+            if not self.spill_file:
+                raise OSError("no spill file")
+            size = os.path.getsize(self.spill_file) if os.path.exists(self.spill_file) else 0
+            if size + len(body) > self.spill_max:
+                raise OSError("spill file full")
+            with open(self.spill_file, "a", encoding='utf-8') as fp:
+                fp.write(body)
+            self.spilled += count
+        except OSError as e:
+            self.dropped += count
+            print("write_es spill " + str(e))
+
+    def replay(self) -> None:
+        if not self.spill_file or not os.path.exists(self.spill_file):
+            return
+        replaying = self.spill_file + ".replay"
+        try:
+            os.replace(self.spill_file, replaying)
+            with open(replaying, "r", encoding='utf-8') as fp:
+                while True:
+                    # a meta line and a document line per alert
+                    lines = list(itertools.islice(fp, 2 * self.batch_size))
+                    if not lines:
+                        break
+                    body = ''.join(lines)
+                    if not self.post(body):
+                        # put back what is left, for the next successful write
+                        with open(self.spill_file, "a", encoding='utf-8') as out:
+                            out.write(body)
+                            shutil.copyfileobj(fp, out)
+                        break
+                    self.written += len(lines) // 2
+            os.unlink(replaying)
+        except OSError as e:
+            print("write_es replay " + str(e))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self.queued,
+            "pending": self.alerts.qsize(),
+            "suppressed": self.suppressed,
+            "dropped": self.dropped,
+            "written": self.written,
+            "spilled": self.spilled,
+        }
+
+
+_sink: AlertSink = None
+_sink_pid: int = 0
+_sink_name: str = "alert"
+_sink_lock = threading.Lock()
+
+
+def set_alert_name(name: str) -> None:
+    """Names the spill file, so each worker process replays its own."""
+    global _sink_name
+    _sink_name = name
+
+
+def alert_sink() -> AlertSink:
+    # one sink per process, slave workers may be forked
+    global _sink, _sink_pid
+    with _sink_lock:
+        if _sink is not None and _sink_pid == os.getpid():
+            return _sink
+
+        spill_file = ""
+        if options.apm_alert_spill_dir:
+            os.makedirs(options.apm_alert_spill_dir, exist_ok=True)
+            spill_file = os.path.join(
+                options.apm_alert_spill_dir, "%s.spill" % _sink_name
+            )
+        _sink = AlertSink(
+            options.elasticsearch_offline,
+            batch_size=options.apm_alert_batch,
+            flush_interval=options.apm_alert_interval,
+            suppress=options.apm_alert_suppress,
+            spill_file=spill_file,
+            spill_max=options.apm_alert_spill_max,
+        )
+        _sink_pid = os.getpid()
+        return _sink
+
+
 def factory(item) -> Point:
     return Point(item)
+
+
+class TestAlertSink(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.sink = AlertSink("127.0.0.1:9200", batch_size=2, suppress=60,
+                              spill_file=os.path.join(self.tmp.name, "alert.spill"))
+        self.posts = list()
+        self.sink.post = lambda body: self.posts.append(body) or True
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_prune(self):
+        self.assertTrue(self.sink.put("m", "idc1", 1000, {}))
+        self.assertFalse(self.sink.put("m", "idc1", 1030, {}))
+        self.assertTrue(self.sink.put("m", "idc2", 1070, {}))
+        # idc1 fell out of the window and is forgotten
+        self.assertEqual(list(self.sink.last), [("m", "idc2")])
+
+    def test_prune_threads(self):
+        errors = list()
+
+        def put(idc):
+            try:
+                for ts in range(1000, 3000):
+                    self.sink.put("m%d" % (ts % 50), idc, ts, {})
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=put, args=("idc%d" % n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.sink.queued + self.sink.suppressed + self.sink.dropped, 8 * 2000)
+        # pruned at most one window ago
+        self.assertTrue(all(2999 - last < 2 * 60 for last in self.sink.last.values()))
+
+    def test_replay(self):
+        docs = [json.dumps({"n": n}) for n in range(5)]
+        with open(self.sink.spill_file, "w", encoding='utf-8') as fp:
+            fp.write(''.join(AlertSink.META + '\n' + doc + '\n' for doc in docs))
+
+        self.sink.replay()
+        self.assertEqual([body.count('\n') // 2 for body in self.posts], [2, 2, 1])
+        self.assertEqual(self.sink.written, 5)
+        self.assertFalse(os.path.exists(self.sink.spill_file))
+
+    def test_replay_failed(self):
+        docs = [json.dumps({"n": n}) for n in range(5)]
+        body = ''.join(AlertSink.META + '\n' + doc + '\n' for doc in docs)
+        with open(self.sink.spill_file, "w", encoding='utf-8') as fp:
+            fp.write(body)
+
+        # the second bulk fails, it and the rest stay spilled
+        self.sink.post = lambda body: self.posts.append(body) or len(self.posts) < 2
+        self.sink.replay()
+        self.assertEqual(self.sink.written, 2)
+        with open(self.sink.spill_file, "r", encoding='utf-8') as fp:
+            self.assertEqual(fp.read(), ''.join(body.splitlines(True)[4:]))
@@ -1,258 +1,428 @@
 # coding=utf-8
 
-import json
-import socket
-import threading
-import queue
 import time
 import re
-from typing import List, Dict, Tuple
+import unittest
+from typing import List, Dict, Tuple, Union
 from tornado.options import options
+from twisted.internet import task
 
-from util import reactor, perf
 from util.exception import print_frame
+from util.batch import decode_batch
+from util.compress import decompress
+from util.json import AttrJson
 from util.observer import Observer
+from .influx import InfluxWriter
+from .ring import ApmHashRing
+from .stats import stats
+from .worker import ApmWorkerPool
 
 
 class ApmProxy(Observer):
     def __init__(self, buffer, connections=None) -> None:
-        #perf()
         self.buffer = buffer
         self.connections = connections
-        self.influx_connections: Dict[int, Tuple] = dict()
-        self.count = 0
+        self.routes: Dict[str, Tuple[int, bool]] = dict()
+        self.slaves: ApmHashRing = ApmHashRing(options.apm_slave_vnodes)
+        self.slave_routes: Dict[Tuple[str, str, str], str] = dict()
         # for count packages
         self.package_num = 0
         self.s_time = time.time()
-       
-        # for count_ts error
-        self.hostname = list()
-        # end
-        # for count metric_num every 10s
-        self.count_metric_by_idc = dict()
-        self.one_metric_count = 0
-        self.all_metric_count = 0
-        self.start_time = time.time()
-        self.start_time_count = time.time()
-        self.flag = False
-        # end
-        # for thread_master
-        self.connections2slave = dict()
-        self.connections2influx = dict()
-        for i in range(16):
-            self.connections2slave[i] = queue.Queue(100000)
-            self.connections2influx[i] = queue.Queue(100000)
-
-        def send_slave(slave_client):
-            
-            while True:
-                try:
-                    _slave_client = slave_client.get(block=True)
-                    _slave_client[0].send_message(_slave_client[1])
-                except Exception as s_e:
-                    # print("send_thread slave:", s_e, slave_client.qsize(), slave_shard)
-                    pass
-        def send_influx(influx_client):
-            while True: 
-                try:  
-                    _influx_client = influx_client.get(block=True)
-                    temp = _influx_client[1].encode()
-                    result = _influx_client[0].sendall(temp)
-                except Exception as e:
-                    print("send_thread influxdb:", e, len(temp))
-                    pass
-
-        self.thread_items = queue.Queue()
-        def calc_std_3(thread_items):
-            while True:
-                try:
-                    if thread_items.qsize() <= 0:
-                        time.sleep(1)
-                        continue
 
-                    _buffer = self.buffer
-                    _buffer.add_list(thread_items.get(block=False))
-                except Exception as e:
-                    print("thread error calc_std_3():", e)
-        for i in range(16):
-            if options.role == "master":
-                t_handle_slave = threading.Thread(target=send_slave, args=(self.connections2slave[i], ))
-                t_handle_influx = threading.Thread(target=send_influx, args=(self.connections2influx[i], ))
-                t_handle_slave.setDaemon(False)
-                t_handle_influx.setDaemon(False)
-                t_handle_slave.start()
-                t_handle_influx.start()
-            else:
-                t_handle = threading.Thread(target=calc_std_3, args=(self.thread_items[i], ))
-                t_handle.setDaemon(False)
-                t_handle.start()
-        # end
+        self.workers: ApmWorkerPool = None
+        if options.role != "master":
+            self.workers = ApmWorkerPool(
+                options.apm_workers,
+                mode=options.apm_worker_mode,
+                queue_size=options.apm_worker_queue,
+            )
 
+        self.influx: InfluxWriter = None
         if options.role == "master":
-            try:
-                i = 0
-                for influx_ip in options.influx_addrs.split(":"):
-                    for influx_port in options.influx_ports.split(":"):
-                        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        s.settimeout(10)
-                        s.connect((influx_ip, int(influx_port)))
-                        self.influx_connections[i] = (s, list())
-                        i += 1
-            except Exception as e:
-                print_frame(e)
+            self.influx = InfluxWriter(
+                options.influx_addrs,
+                options.influx_ports,
+                pool_size=options.influx_pool,
+                flush_size=options.influx_flush_size,
+                flush_interval=options.influx_flush_interval,
+                spill_dir=options.influx_spill_dir,
+                spill_max=options.influx_spill_max,
+                buffer_max=options.influx_buffer_max,
+            )
+            self.register_master_stats()
+            self.slaves_looper = task.LoopingCall(self.flush_slaves)
+            self.slaves_looper.start(7, now=False)
+            self.stats_tags = "role=master master=%s" % str(options.router_port_end)[-2:]
+        else:
+            stats.gauge("slave.dispatched", lambda: self.workers.dispatched)
+            stats.gauge("slave.dropped", lambda: self.workers.dropped)
+            # the slave writes no series of its own, one idle connection per
+            # shard carries its self metrics; they are not worth a spill file
+            self.influx = InfluxWriter(
+                options.influx_addrs,
+                options.influx_ports,
+                pool_size=1,
+                flush_interval=10,
+                spill_dir="",
+            )
+            self.stats_tags = "role=slave slave=%s" % options.shard
+        self.stats_looper = task.LoopingCall(self.emit_stats)
+        self.stats_looper.start(10, now=False)
 
         super().__init__()
 
-    def handle_master(self, content: str):
+    SLAVE_METRICS = frozenset(('ngx.log.qps', 'ngx.log.speed.avg'))
+    SLAVE_ISPS = frozenset(("CNC", "CTC", "CMCC"))
+    SLAVE_TAGS = re.compile(r'(?:^| )(province|isp)=([^ ]*)')
+
+    def route(self, metric: str) -> Tuple[int, bool]:
+        route = self.routes.get(metric)
+        if route is None:
+            influx_shard = options.config.metric_shard.get(metric, None)
+            if influx_shard is None:
+                influx_shard = 7
+            route = (influx_shard, metric in self.SLAVE_METRICS)
+            self.routes[metric] = route
+        return route
+
+    def slave_shard(self, metric: str, put_data: str) -> str:
+        tags = dict(self.SLAVE_TAGS.findall(put_data))
+        province = tags['province']
+        isp = tags['isp']
+        if isp not in self.SLAVE_ISPS:
+            isp = 'other'
+
+        key = (metric, province, isp)
+        shard = self.slave_routes.get(key)
+        if shard is None:
+            shard = self.slaves.get("%s%s_%s" % key)
+            self.slave_routes[key] = shard
+        return shard
+
+    def set_slaves(self, weights: Dict[str, int]) -> None:
+        """Rebuilds the slave ring; only the series on moved arcs change slave."""
+        self.slaves.build(weights)
+        moved = 0
+        slave_routes: Dict[Tuple[str, str, str], str] = dict()
+        for key, shard in self.slave_routes.items():
+            slave_routes[key] = self.slaves.get("%s%s_%s" % key)
+            if slave_routes[key] != shard:
+                moved += 1
+        self.slave_routes = slave_routes
+        stats.count("master.slave_moved", moved)
+        print("apm slaves: %d, series moved: %d/%d" % (len(weights), moved, len(slave_routes)))
+
+    @staticmethod
+    def master_line(item: Dict) -> str:
+        """A walker point as "version,metric,ts,value;put metric ts value tags"."""
+        tags = " ".join(
+            "%s=%s" % (k, v) for k, v in item.items()
+            if k not in ("metric", "ts", "value")
+        )
+        return "%s,%s,%s,%s;put %s %s %s %s" % (
+            options.release_version, item["metric"], item["ts"], item["value"],
+            item["metric"], item["ts"], item["value"], tags
+        )
+
+    def master_lines(self, content: Union[str, bytes]) -> List[str]:
+        """
+        Master lines of a publish: a (compressed) batch from pre-aggregating
+        walkers, JSON lines from the others, or master lines as they are.
+        """
+        content = decompress(content)
+        if isinstance(content, bytes):
+            return [self.master_line(item) for item in decode_batch(content)]
+
+        lines = content.split('\n')
+        for i, line in enumerate(lines):
+            if line.startswith('{'):
+                lines[i] = self.master_line(AttrJson.loads_plain(line))
+        return lines
+
+    def handle_master(self, content: Union[str, bytes]):
         try:
             if 'd' in options.debug:
                 print(content)
             self.package_num += 1
             e_time = time.time()
-            _buffer = self.buffer
-            lines: List[object] = content.split('\n')
+            lines = self.master_lines(content)
             if e_time - self.s_time >= 10:
                 ts = int(self.s_time/10) * 10
                 self.s_time = e_time
                 _line = '%s,apm.master.num,%s,%s;put apm.master.num %s %s master=%s'%(options.release_version,ts,self.package_num, ts,self.package_num,str(options.router_port_end)[-2:])
                 self.package_num = 0
                 lines.append(_line)
-            cur_time = time.time()
+
+            # "version,metric,ts,value;put metric ts value tags..."
+            start = time.time()
+            counts: Dict[str, int] = dict()
+            influx_lines: Dict[int, List[str]] = dict()
+            slave_lines: Dict[str, List[str]] = dict()
+            route = self.route
+            bad = 0
             for line in lines:
-                if line:
-                    _data = line.split(';', 1)
-                    if len(_data) < 2:
+                semi = line.find(';')
+                first = line.find(',', 0, semi)
+                if semi < 0 or first < 0:
+                    if line:
+                        bad += 1
+                    continue
+                second = line.find(',', first + 1, semi)
+                if second < 0:
+                    second = semi
+
+                metric = line[first + 1:second]
+                put_data = line[semi + 1:]
+                influx_shard, to_slave = route(metric)
+                if to_slave:
+                    try:
+                        shard = self.slave_shard(metric, put_data)
+                    except KeyError:
                         continue
-                    prefix = _data[0]
-                    put_data = _data[1]
-                    vmtv = prefix.split(',')
-                    metric = vmtv[1]
-                    #influx_shard = _buffer.make_key(metric, 8)
-                    influx_shard = options.config.metric_shard.get(metric, None)
-                    if influx_shard is None:
-                        influx_shard = 7
-                    if metric in ('ngx.log.qps', 'ngx.log.speed.avg'):
-                        province = re.findall("province=([^ ]*)", put_data)[0]
-                        isp = re.findall("isp=([^ ]*)", put_data)[0]
-                        if isp not in ("CNC", "CTC", "CMCC"):
-                            isp = 'other'
-                        shard = _buffer.make_key_by_tags(metric + "%s_%s"%(province, isp), 16)
-                        server, buffer, buff = self.connections[shard]
-                        buffer.append(line)
-                    
-                    influd_server, buff_put = self.influx_connections[influx_shard]
-                    buff_put.append(put_data)
-                    self.metric_count(metric, False) 
+                    shard_lines = slave_lines.get(shard)
+                    if shard_lines is None:
+                        shard_lines = slave_lines[shard] = list()
+                    shard_lines.append(line)
+
+                shard_lines = influx_lines.get(influx_shard)
+                if shard_lines is None:
+                    shard_lines = influx_lines[influx_shard] = list()
+                shard_lines.append(put_data)
+                counts[metric] = counts.get(metric, 0) + 1
+
+            routed = time.time()
+            for influx_shard, shard_lines in influx_lines.items():
+                self.influx.write(influx_shard, shard_lines)
+            stats.observe("master.route", routed - start)
+            stats.observe("master.influx_write", time.time() - routed)
+            for shard, shard_lines in slave_lines.items():
+                writer = self.connections.get(shard)
+                if writer is not None:
+                    writer.write(shard_lines)
+            stats.count("master.packages")
+            stats.count("master.lines", len(lines))
+            stats.count("master.bad_lines", bad)
+            stats.count_metrics(counts)
 
         except Exception as e:
             print_frame(e)
-        end_time = time.time()
-        check_time = end_time - self.start_time
-        try:
-            self.count += 1
-            # if self.count == 256 or check_time >= 10:
-            if  check_time >= 7:
-                self.start_time = end_time
-                self.count = 0
-                _shard, __shard = 0, 0
-                for _shard, _client in self.connections.items():
-                    self.connections2slave[_shard].put([_client[0], "\n".join(_client[1])])
-                    _client[1].clear()
-                for __shard, __client in self.influx_connections.items():
-                    if len(__client[1]) < 1:
-                        continue
-                    self.connections2influx[__shard].put([__client[0], "\n".join(__client[1]) + '\n']) 
-                    __client[1].clear()
-        except Exception as e:
-            print("influx_connections%s:%s" % (__shard, e))
+
+    def reroute(self, lines: List[str]) -> None:
+        """Master lines held for a slave that left, written to the slaves now owning them."""
+        slave_lines: Dict[str, List[str]] = dict()
+        for line in lines:
+            prefix, _, put_data = line.partition(';')
+            try:
+                shard = self.slave_shard(prefix.split(',', 2)[1], put_data)
+            except (IndexError, KeyError):
+                continue
+            slave_lines.setdefault(shard, list()).append(line)
+
+        for shard, shard_lines in slave_lines.items():
+            writer = self.connections.get(shard)
+            if writer is not None:
+                writer.write(shard_lines)
+        stats.count("master.slave_rerouted", sum(len(x) for x in slave_lines.values()))
+
+    @staticmethod
+    def slave_item(line: str) -> Dict:
+        """A forwarded master line back into the point a worker detects on."""
+        prefix, _, put_data = line.partition(';')
+        _, metric, ts, value = prefix.split(',', 3)
+        item = {"metric": metric, "ts": int(ts), "value": float(value)}
+        # "put metric ts value tag=value ..."
+        for tag in put_data.split(' ')[4:]:
+            key, _, tag_value = tag.partition('=')
+            if tag_value:
+                item[key] = tag_value
+        return item
 
     def handle_slave(self, content: str):
-        lines: List[object] = content.split('\n')
         try:
-            for line in lines:
-                if line:
-                    item = json.loads(line)
-                    self.thread_items.put(item)
+            start = time.time()
+            items = list()
+            bad = 0
+            for line in content.split('\n'):
+                if not line:
+                    continue
+                try:
+                    items.append(self.slave_item(line))
+                except ValueError:
+                    bad += 1
+            self.workers.dispatch(items)
+            stats.observe("slave.parse", time.time() - start)
+            stats.count("slave.lines", len(items))
+            stats.count("slave.bad_lines", bad)
 
         except Exception as e:
             print_frame(e)
 
-    def run(self):
-        return
-        _buffer = self.buffer
-        _buffer.handle()
-        reactor().callLater(30, self.run)
+    def register_master_stats(self):
+        def influx_total(name):
+            return lambda: sum(shard[name] for shard in self.influx.stats().values())
 
-    def metric_count_slave(self, metric_name):
+        for name in ("connections", "buffered", "buffered_bytes", "paused", "lines_written",
+                     "bytes_written", "lines_spilled", "lines_dropped", "connects"):
+            stats.gauge("influx." + name, influx_total(name))
+        stats.gauge("influx.unrouted", lambda: self.influx.unrouted)
+        stats.gauge("master.slave_backlog", lambda: sum(
+            writer.pending_bytes for writer in self.connections.values()
+        ))
+        stats.gauge("master.slave_backlog_max", lambda: max(
+            [writer.pending_bytes for writer in self.connections.values()] or [0]
+        ))
+        stats.gauge("master.slave_dropped", lambda: sum(
+            writer.lines_dropped for writer in self.connections.values()
+        ))
 
-        end_time = time.time()
-        if metric_name == 'testing':
-            self.one_metric_count += 1
+    def flush_slaves(self):
+        for shard, writer in self.connections.items():
+            try:
+                writer.flush()
+            except Exception as e:
+                print("flush slave %s:%s" % (shard, e))
 
-        self.all_metric_count += 1
+    def emit_stats(self):
+        try:
+            ts = int(time.time())
+            influx_lines: Dict[int, List[str]] = dict()
+            for metric, line in stats.lines(ts, self.stats_tags).items():
+                influx_lines.setdefault(self.route(metric)[0], list()).append(line)
+            for influx_shard, shard_lines in influx_lines.items():
+                self.influx.write(influx_shard, shard_lines)
+        except Exception as e:
+            print_frame(e)
 
-        if end_time - self.start_time_count >= 10:
-            self.start_time_count = end_time
 
-            file_name = '/usr/local/cdntoolkit/ctk/apm/' + '%s' % options.shard + '.txt'
-            file_obj = open(file_name, 'w')
-            try:
-                file_obj.writelines(str(self.one_metric_count) + '_' + str(self.all_metric_count) + '_' + str(end_time) + '\n')
-            finally:
-                file_obj.close()
-            self.one_metric_count = 0
-            self.all_metric_count = 0
-
-    def metric_count(self, metric, flag):
-        # for verify data_num
-        end_time = time.time()
-        one_metric_count = self.count_metric_by_idc.get(metric, None)
-        all_metric_count = self.count_metric_by_idc.get("all", None)
-        if not flag and one_metric_count is None:
-            self.count_metric_by_idc[metric] = 1
-        else:
-            self.count_metric_by_idc[metric] += 1
-        if not flag and all_metric_count is None:
-            self.count_metric_by_idc['all'] = 1
-        else:
-            self.count_metric_by_idc['all'] += 1
+class TestWalkerToMaster(unittest.TestCase):
+    """Walker publishes, in every form it sends, routed by handle_master."""
 
-        if end_time - self.start_time_count >= 10:
-            self.start_time_count = end_time
+    class Message:
+        def __init__(self):
+            self.sent = list()
 
-            file_name = '/usr/local/cdntoolkit/ctk/apm/' + '%s' % options.router_port_start + '.txt'
-            file_obj = open(file_name, 'w')
-            try:
-                # file_obj.writelines(str(self.one_metric_count) + '_' + str(self.all_metric_count) + '\n')
-                file_obj.writelines(json.dumps(self.count_metric_by_idc))
-            finally:
-                file_obj.close()
-            self.count_metric_by_idc = dict()
-        return True
-
-    def calc_metric_by_idc(self, idc, metric_key):
-        try:
-            metrics = self.count_metric_by_idc.get(idc, None)
-            if metrics is None:
-                metrics = list()
-                self.count_metric_by_idc[idc] = metrics
-
-            if metric_key in metrics:
-                pass
-            else:
-                metrics.append(metric_key)
-
-            end_time = time.time()
-            if end_time - self.start_time >= 300:
-                self.start_time = end_time
-
-                file_name = '/usr/local/cdntoolkit/ctk/apm/test/' + '%s' % options.router_port_start + '.txt'
-                file_obj = open(file_name, 'w')
-                try:
-                    file_obj.writelines(json.dumps(self.count_metric_by_idc))
-                finally:
-                    file_obj.close()
-                self.count_metric_by_idc.clear()
-        except Exception as e:
-            self.count_metric_by_idc.clear()
-            print("calc_metric_by_idc", e)
+        def send(self, topic, data):
+            self.sent.append(data)
+            return True
+
+    class Influx:
+        def __init__(self):
+            self.lines = list()
+
+        def write(self, shard, lines):
+            self.lines.extend(lines)
+
+    class Slave:
+        def __init__(self):
+            self.lines = list()
+
+        def write(self, lines):
+            self.lines.extend(lines)
+
+    def setUp(self):
+        from tornado.options import define
+        from util.json import AttrDict
+        for name, value in (("release_version", 0), ("debug", ""), ("router_port_end", 48096),
+                            ("apm_compress", ""), ("apm_preaggregate", False),
+                            ("topic_apm_collector", "apm.collector")):
+            if name not in options:
+                define(name, default=value, type=type(value))
+        if "config" not in options:
+            define("config", default=AttrDict(), type=AttrDict)
+        if "metric_shard" not in options.config:
+            options.config.metric_shard = dict()
+        self.saved = options.apm_compress
+
+        self.proxy = ApmProxy.__new__(ApmProxy)
+        self.proxy.routes = dict()
+        self.proxy.slave_routes = dict()
+        self.proxy.slaves = ApmHashRing(16)
+        self.proxy.slaves.build({"slave": 1})
+        self.proxy.connections = {"slave": self.Slave()}
+        self.proxy.package_num = 0
+        self.proxy.s_time = time.time()
+        self.proxy.influx = self.Influx()
+
+    def tearDown(self):
+        options.apm_compress = self.saved
+
+    def publish(self, compress: str, preaggregate: bool):
+        from orderedattrdict import AttrDict
+        from util.json import AttrJson
+        from util.protocol import ConfigGetResponse
+        from walker.apm import ApmHandler
+
+        options.apm_compress = compress
+        walker = ApmHandler.__new__(ApmHandler)
+        walker.offset = 0.0
+        walker.message = self.Message()
+        walker.pending = dict()
+        walker.looper = True if preaggregate else None
+        walker.config = ConfigGetResponse(AttrDict(
+            country="CN", province="shandong", area="north", idc="SD_1", isp="CNC", role="edge"))
+
+        lines = list()
+        for metric, value in (("ngx.log.qps", 12.5), ("proc.net.bytes", 100)):
+            item = AttrDict()
+            item.metric = metric
+            item.ts = 1500000000
+            item.value = value
+            item.host = "CDN-SD-1"
+            lines.append(AttrJson.dumps_plain(item))
+        walker.data("\n".join(lines))
+        if preaggregate:
+            walker.flush()
+
+        from util import reactor
+        for call in reactor().getDelayedCalls():
+            if call.func == walker.send_apm:
+                func, args = call.func, call.args
+                call.cancel()
+                func(*args)
+        self.assertEqual(len(walker.message.sent), 1)
+        return walker.message.sent[0]
+
+    def check(self, data):
+        self.proxy.handle_master(data)
+        puts = sorted(line.split(" ")[1:4] for line in self.proxy.influx.lines)
+        self.assertEqual(puts, [["ngx.log.qps", "1500000000", "12.5"], ["proc.net.bytes", "1500000000", "100"]])
+        for line in self.proxy.influx.lines:
+            self.assertIn("province=shandong", line)
+            self.assertIn("idc=SD_1", line)
+        slave = self.proxy.connections["slave"].lines
+        self.assertEqual(len(slave), 1)
+        self.assertTrue(slave[0].startswith("0,ngx.log.qps,1500000000,12.5;put ngx.log.qps"))
+
+    def test_slave_item(self):
+        line = self.proxy.master_line({"metric": "ngx.log.qps", "ts": 1500000000, "value": 12.5,
+                                       "idc": "SD_1", "province": "shandong"})
+        self.assertEqual(ApmProxy.slave_item(line), {
+            "metric": "ngx.log.qps", "ts": 1500000000, "value": 12.5,
+            "idc": "SD_1", "province": "shandong",
+        })
+        with self.assertRaises(ValueError):
+            ApmProxy.slave_item("garbage")
+
+    def test_reroute(self):
+        data = self.publish("", False)
+        self.proxy.handle_master(data)
+        lines = self.proxy.connections["slave"].lines
+
+        # the slave is gone, what it held goes to the new owner
+        self.proxy.connections = {"other": self.Slave()}
+        self.proxy.set_slaves({"other": 1})
+        self.proxy.reroute(lines)
+        self.assertEqual(self.proxy.connections["other"].lines, lines)
+
+    def test_json(self):
+        data = self.publish("", False)
+        self.assertIsInstance(data, str)
+        self.check(data)
+
+    def test_json_compressed(self):
+        data = self.publish("zlib", False)
+        self.assertIsInstance(data, bytes)
+        self.check(data)
+
+    def test_batch_compressed(self):
+        self.check(self.publish("zlib", True))
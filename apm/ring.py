@@ -0,0 +1,49 @@
+# coding=utf-8
+
+import bisect
+import hashlib
+import struct
+from typing import Dict, List
+
+_U32 = struct.Struct(">I")
+
+
+def hash32(key: str) -> int:
+    return _U32.unpack_from(hashlib.md5(key.encode()).digest())[0]
+
+
+class ApmHashRing:
+    """
+    Consistent hash ring of apm slaves. Each slave owns vnodes * weight
+    points on the ring and a key goes to the slave owning the first point
+    after hash32(key), so adding or removing a slave only moves the keys
+    of the arcs it gains or loses.
+    """
+
+    def __init__(self, vnodes: int=160) -> None:
+        self.vnodes = vnodes
+        self.weights: Dict[str, int] = dict()
+        self.points: List[int] = list()
+        self.nodes: List[str] = list()
+
+    def __len__(self) -> int:
+        return len(self.weights)
+
+    def build(self, weights: Dict[str, int]) -> None:
+        points = list()
+        for node, weight in weights.items():
+            for index in range(self.vnodes * max(weight, 0)):
+                points.append((hash32("%s#%d" % (node, index)), node))
+        points.sort()
+
+        self.weights = dict(weights)
+        self.points = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def get(self, key: str) -> str:
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, hash32(key))
+        if index == len(self.points):
+            index = 0
+        return self.nodes[index]
@@ -0,0 +1,73 @@
+# coding=utf-8
+
+import time
+from typing import Dict, List
+
+from util.message import WsClientMessage
+from util.observer import Observer
+from .stats import stats
+
+# websocket subprotocol of master -> slave, compression is negotiated on it
+APM_PROTOCOL: str = "ctk.apm.v1"
+
+
+class ApmSlaveWriter(Observer):
+    """
+    Write buffer of one apm slave, used on the reactor thread only. Lines
+    are held until flush(); while the connection is down or the transport
+    has paused it, they stay pending up to max_pending bytes and go out
+    when the transport drains. Anything beyond that is dropped.
+    """
+
+    def __init__(self, client: WsClientMessage, max_pending: int=64 << 20) -> None:
+        super().__init__()
+        self.client = client
+        self.max_pending = max_pending
+        self.pending: List[str] = list()
+        self.pending_bytes = 0
+        self.due = False
+
+        self.messages = 0
+        self.bytes_sent = 0
+        self.lines_dropped = 0
+
+        client.add_slot(WsClientMessage.drained, self.drained)
+
+    def write(self, lines: List[str]) -> None:
+        size = sum(len(line) for line in lines) + len(lines)
+        if self.pending_bytes + size > self.max_pending:
+            self.lines_dropped += len(lines)
+            return
+        self.pending.extend(lines)
+        self.pending_bytes += size
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        if not self.client.writable:
+            self.due = True
+            return
+
+        data = "\n".join(self.pending)
+        self.pending, self.pending_bytes, self.due = list(), 0, False
+
+        start = time.time()
+        self.client.send_message(data)
+        stats.observe("master.slave_send", time.time() - start)
+        self.messages += 1
+        self.bytes_sent += len(data)
+
+    def drained(self) -> None:
+        if self.due:
+            self.flush()
+
+    def stop(self) -> None:
+        self.client.service.stopService()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": self.pending_bytes,
+            "messages": self.messages,
+            "bytes_sent": self.bytes_sent,
+            "lines_dropped": self.lines_dropped,
+        }
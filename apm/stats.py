@@ -0,0 +1,132 @@
+# coding=utf-8
+
+import bisect
+import json
+import threading
+import time
+from typing import Dict, Callable, Union
+
+import tornado.web
+
+
+class ApmHistogram:
+    """Latency histogram with fixed millisecond buckets."""
+
+    BOUNDS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+    __slots__ = ('buckets', 'count', 'sum', 'max')
+
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, ms: float) -> None:
+        self.buckets[bisect.bisect_left(self.BOUNDS, ms)] += 1
+        self.count += 1
+        self.sum += ms
+        if ms > self.max:
+            self.max = ms
+
+    def snapshot(self) -> Dict:
+        bounds = [str(bound) for bound in self.BOUNDS] + ["inf"]
+        return {
+            "count": self.count,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+            "buckets": dict(zip(bounds, self.buckets)),
+        }
+
+
+class ApmStats:
+    """
+    In process counters, gauges and latency histograms of the apm pipeline.
+    Counters and histograms are cumulative since start; gauges are either
+    set or read from a callable at snapshot time. Per metric point counts
+    are kept apart so the apm.self.* series stay bounded.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters: Dict[str, int] = dict()
+        self.gauges: Dict[str, Union[float, Callable[[], float]]] = dict()
+        self.histograms: Dict[str, ApmHistogram] = dict()
+        self.metrics: Dict[str, int] = dict()
+
+    def count(self, name: str, n: int=1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def count_metrics(self, counts: Dict[str, int]) -> None:
+        with self.lock:
+            metrics = self.metrics
+            for metric, n in counts.items():
+                metrics[metric] = metrics.get(metric, 0) + n
+
+    def gauge(self, name: str, value: Union[float, Callable[[], float]]) -> None:
+        self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = ApmHistogram()
+            histogram.observe(seconds * 1000)
+
+    def snapshot(self) -> Dict:
+        gauges: Dict[str, float] = dict()
+        for name, value in list(self.gauges.items()):
+            try:
+                gauges[name] = value() if callable(value) else value
+            except Exception as e:
+                print("apm stats gauge %s:" % name, e)
+
+        with self.lock:
+            return {
+                "uptime": int(time.time() - self.started),
+                "counters": dict(self.counters),
+                "gauges": gauges,
+                "histograms": {
+                    name: histogram.snapshot()
+                    for name, histogram in self.histograms.items()
+                },
+                "metrics": dict(self.metrics),
+            }
+
+    def lines(self, ts: int, tags: str) -> Dict[str, str]:
+        """apm.self.* put lines by metric name, ready for influx."""
+        snapshot = self.snapshot()
+        values: Dict[str, float] = dict()
+        for name, value in snapshot["counters"].items():
+            values[name] = value
+        for name, value in snapshot["gauges"].items():
+            values[name] = value
+        for name, histogram in snapshot["histograms"].items():
+            values[name + ".count"] = histogram["count"]
+            values[name + ".avg"] = round(histogram["avg"], 3)
+            values[name + ".max"] = round(histogram["max"], 3)
+
+        lines: Dict[str, str] = dict()
+        for name, value in values.items():
+            metric = "apm.self." + name
+            lines[metric] = "put %s %s %s %s" % (metric, ts, value, tags)
+        return lines
+
+
+class ApmStatsHandler(tornado.web.RequestHandler):
+    def get(self) -> None:
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(stats.snapshot()))
+
+
+class ApmStatsApp(tornado.web.Application):
+    def __init__(self) -> None:
+        handlers = [
+            (r'/apm/stats$', ApmStatsHandler),
+        ]
+        tornado.web.Application.__init__(self, handlers, debug=False)
+
+
+stats: ApmStats = ApmStats()
@@ -0,0 +1,99 @@
+# coding=utf-8
+
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+from typing import Dict, List, Any
+
+from .buffer import ApmBuffer
+from .mr import set_alert_name
+
+
+def apm_worker_loop(index: int, items_queue: Any) -> None:
+    if multiprocessing.current_process().name != "MainProcess":
+        set_alert_name("alert-%d" % index)
+
+    buffer = ApmBuffer()
+    boundary = int(time.time()) // 10
+    while True:
+        try:
+            items = items_queue.get(timeout=1.0)
+        except queue.Empty:
+            items = ()
+        if items is None:
+            return
+
+        for item in items:
+            try:
+                buffer.add_list(item)
+            except Exception as e:
+                print("apm worker %d add_list():" % index, e)
+
+        # all series are checked together once per 10s bucket
+        now = int(time.time()) // 10
+        if now != boundary:
+            boundary = now
+            buffer.detect()
+
+
+class ApmWorkerPool:
+    """
+    Slave side anomaly detection. Points are hashed by (metric, idc) to one
+    of N workers, each owning a private ApmBuffer, so every series is only
+    ever touched by one worker and needs no locking. Workers are threads,
+    or processes when mode is "process" so detection is not bound to one
+    core by the GIL. dispatch() never blocks the reactor: a full worker
+    queue drops the batch and counts it.
+    """
+
+    def __init__(self, workers: int, mode: str="thread", queue_size: int=10000) -> None:
+        self.workers = max(workers, 1)
+        self.mode = mode
+        self.dispatched = 0
+        self.dropped = 0
+        self.queues: List[Any] = list()
+        self.runners: List[Any] = list()
+
+        for index in range(self.workers):
+            if mode == "process":
+                items_queue = multiprocessing.Queue(queue_size)
+                runner = multiprocessing.Process(
+                    target=apm_worker_loop, args=(index, items_queue), daemon=True
+                )
+            else:
+                items_queue = queue.Queue(queue_size)
+                runner = threading.Thread(
+                    target=apm_worker_loop, args=(index, items_queue), daemon=True
+                )
+            runner.start()
+            self.queues.append(items_queue)
+            self.runners.append(runner)
+
+    def shard(self, item: Dict) -> int:
+        key = "%s\0%s" % (item["metric"], item.get("idc", "unknown"))
+        return zlib.crc32(key.encode()) % self.workers
+
+    def dispatch(self, items: List[Dict]) -> None:
+        shards: Dict[int, List[Dict]] = dict()
+        for item in items:
+            index = self.shard(item)
+            batch = shards.get(index)
+            if batch is None:
+                batch = shards[index] = list()
+            batch.append(item)
+
+        for index, batch in shards.items():
+            try:
+                self.queues[index].put_nowait(batch)
+                self.dispatched += len(batch)
+            except queue.Full:
+                self.dropped += len(batch)
+
+    def stop(self) -> None:
+        for items_queue in self.queues:
+            try:
+                items_queue.put_nowait(None)
+            except queue.Full:
+                pass
@@ -0,0 +1,328 @@
+# coding=utf-8
+
+"""
+Throughput benchmark for the apm master and slave paths.
+
+    python -m bench.apm_master [--packages N] [--lines N] [--metrics N] ...
+
+A synthetic router feed of "version,metric,ts,value;put ..." packages,
+spread over 16 router ports, is pushed through ApmProxy.handle_master on
+the reactor. Local TCP listeners stand in for the InfluxDB shards and
+websocket servers for the apm slaves, so the writers do real socket IO.
+The same series are then fed to a slave ApmProxy.handle_slave, and to a
+bare ApmBuffer for add_list/detect. Reported are lines/s, p50/p99
+handling latency per package and RSS growth of the process.
+"""
+
+import argparse
+import contextlib
+import io
+import random
+import socket
+import sys
+import time
+from typing import Dict, List
+
+from tornado.options import options
+from twisted.internet import protocol, task
+
+from util.observer import Observer
+
+SLAVE_METRICS = ('ngx.log.qps', 'ngx.log.speed.avg')
+PROVINCES = ('beijing', 'shandong', 'guangdong', 'sichuan', 'jiangsu', 'hubei', 'henan', 'zhejiang')
+ISPS = ('CNC', 'CTC', 'CMCC', 'OTHER')
+
+
+def rss() -> int:
+    with open("/proc/self/status") as fp:
+        for line in fp:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def free_port() -> int:
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+class SinkProtocol(protocol.Protocol):
+    def dataReceived(self, data: bytes) -> None:
+        self.factory.received += len(data)
+        self.factory.lines += data.count(b"\n")
+
+
+class SinkFactory(protocol.Factory):
+    protocol = SinkProtocol
+
+    def __init__(self) -> None:
+        self.received = 0
+        self.lines = 0
+
+
+class SlaveSink(Observer):
+    def __init__(self) -> None:
+        super().__init__()
+        self.received_bytes = 0
+        self.lines = 0
+
+    def received(self, data: str) -> None:
+        self.received_bytes += len(data)
+        self.lines += data.count("\n") + 1
+
+
+class Feed:
+    """
+    Series are metric x host, each host fixed to a province, isp and idc.
+    Every series reports once per 10s bucket, in a fixed shuffled order.
+    """
+
+    def __init__(self, metrics: int, hosts: int, seed: int=1) -> None:
+        rand = random.Random(seed)
+        names = list(SLAVE_METRICS) + sorted(options.config.metric_shard)
+        while len(names) < metrics:
+            names.append("bench.metric.%d" % len(names))
+        names = names[:max(metrics, len(SLAVE_METRICS))]
+
+        self.series = list()
+        for index in range(hosts):
+            province = rand.choice(PROVINCES)
+            isp = rand.choice(ISPS)
+            host = {
+                "host": "CDN-%s-%s-%d" % (province[:2].upper(), isp, index),
+                "province": province,
+                "isp": isp,
+                "idc": "%s_%s_%d" % (province[:2].upper(), isp, index % 64),
+            }
+            for metric in names:
+                self.series.append(dict(host, metric=metric))
+        rand.shuffle(self.series)
+        self.rand = rand
+        self.next = 0
+
+    def items(self, count: int, ts: int) -> List[Dict]:
+        items = list()
+        for _ in range(count):
+            item = dict(self.series[self.next])
+            self.next = (self.next + 1) % len(self.series)
+            item["ts"] = ts + self.rand.randint(0, 9)
+            item["value"] = round(self.rand.uniform(90, 110), 2)
+            items.append(item)
+        return items
+
+    def packages(self, count: int, lines: int, ports: int, ts: int) -> List[List[str]]:
+        """count packages per router port of lines master lines each."""
+        version = options.release_version
+        packages: List[List[str]] = [list() for _ in range(ports)]
+        for index in range(count):
+            content = list()
+            for item in self.items(lines, ts):
+                content.append(
+                    "%s,%s,%s,%s;put %s %s %s host=%s province=%s isp=%s idc=%s" % (
+                        version, item["metric"], item["ts"], item["value"],
+                        item["metric"], item["ts"], item["value"],
+                        item["host"], item["province"], item["isp"], item["idc"]
+                    )
+                )
+            packages[index % ports].append("\n".join(content))
+        return packages
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.results: Dict[str, Dict] = dict()
+
+        from util import reactor
+        self.reactor = reactor()
+
+        self.influx_sinks = list()
+        ports = list()
+        for _ in range(args.influx):
+            sink = SinkFactory()
+            ports.append(str(self.reactor.listenTCP(0, sink, interface="127.0.0.1").getHost().port))
+            self.influx_sinks.append(sink)
+        options.influx_addrs = "127.0.0.1"
+        options.influx_ports = ":".join(ports)
+        options.influx_spill_dir = ""
+        options.apm_alert_spill_dir = ""
+
+        from apm import ws_compression
+        from apm.slave import APM_PROTOCOL
+        from util.message import WsServerMessage
+        self.slave_sink = SlaveSink()
+
+        self.slave_servers = list()
+        self.slave_addresses = list()
+        for _ in range(args.slaves):
+            port = free_port()
+            server = WsServerMessage([APM_PROTOCOL], ws_compression())
+            server.add_slot(WsServerMessage.recv_message, self.slave_sink.received)
+            server.run("tcp:port=%d:interface=127.0.0.1" % port)
+            self.slave_servers.append(server)
+            self.slave_addresses.append("tcp:host=127.0.0.1:port=%d" % port)
+
+        self.feed = Feed(args.metrics, args.hosts)
+
+    def master(self) -> None:
+        from apm.buffer import ApmBuffer
+        from apm.proxy import ApmProxy
+        from apm import ws_compression
+        from apm.slave import ApmSlaveWriter, APM_PROTOCOL
+        from util.message import WsClientMessage
+
+        options.role = "master"
+        connections: Dict = dict()
+        proxy = ApmProxy(ApmBuffer(), connections)
+        for address in self.slave_addresses:
+            client = WsClientMessage([APM_PROTOCOL], ws_compression())
+            client.run(address)
+            connections[address] = ApmSlaveWriter(client, options.apm_slave_pending)
+        proxy.set_slaves({address: 1 for address in self.slave_addresses})
+
+        args = self.args
+        packages = self.feed.packages(args.packages, args.lines, args.ports, int(time.time()))
+        # interleave the router ports like the reactor would deliver them
+        feed = [content for contents in zip(*packages) for content in contents]
+
+        latencies: List[float] = list()
+        rss_start = rss()
+
+        def run():
+            start = time.time()
+            for content in feed:
+                begin = time.perf_counter()
+                proxy.handle_master(content)
+                latencies.append(time.perf_counter() - begin)
+                yield None
+            self.results["master"] = {
+                "lines": len(feed) * args.lines,
+                "seconds": time.time() - start,
+                "latencies": latencies,
+                "rss": rss() - rss_start,
+            }
+            proxy.influx.flush()
+            proxy.flush_slaves()
+
+        def drain():
+            d = task.cooperate(run()).whenDone()
+            d.addCallback(lambda _: task.deferLater(self.reactor, args.drain, lambda: None))
+            d.addBoth(lambda _: self.reactor.stop())
+
+        # give the slave clients time to connect
+        self.reactor.callLater(1.0, drain)
+        self.reactor.run()
+
+        self.results["master"]["influx_lines"] = sum(sink.lines for sink in self.influx_sinks)
+        self.results["master"]["influx_unrouted"] = proxy.influx.unrouted
+        self.results["master"]["slave_lines"] = self.slave_sink.lines
+
+    def slave(self) -> None:
+        from apm.proxy import ApmProxy
+        from apm.buffer import ApmBuffer
+
+        options.role = "slave"
+        proxy = ApmProxy(ApmBuffer())
+        args = self.args
+        # master lines, as the master forwards them
+        packages = self.feed.packages(args.packages, args.lines, 1, int(time.time()))
+        contents = packages[0]
+
+        latencies: List[float] = list()
+        rss_start = rss()
+        start = time.time()
+        for content in contents:
+            begin = time.perf_counter()
+            proxy.handle_slave(content)
+            latencies.append(time.perf_counter() - begin)
+        self.results["slave"] = {
+            "lines": len(contents) * args.lines,
+            "seconds": time.time() - start,
+            "latencies": latencies,
+            "rss": rss() - rss_start,
+            "dropped": proxy.workers.dropped,
+        }
+        proxy.workers.stop()
+
+    def buffer(self) -> None:
+        from apm.buffer import ApmBuffer
+
+        args = self.args
+        buffer = ApmBuffer()
+        ts = int(time.time()) // 10 * 10
+        rss_start = rss()
+        latencies: List[float] = list()
+        breaches = 0
+        start = time.time()
+        # every series once per bucket, detection at each bucket boundary;
+        # the first check of a series is against zero history and breaches
+        for bucket in range(args.buckets):
+            items = self.feed.items(len(self.feed.series), ts + bucket * 10)
+            begin = time.perf_counter()
+            for item in items:
+                buffer.add_list(item)
+            latencies.append(time.perf_counter() - begin)
+            breaches += len(buffer.detect())
+        self.results["buffer"] = {
+            "lines": args.buckets * len(self.feed.series),
+            "seconds": time.time() - start,
+            "latencies": latencies,
+            "rss": rss() - rss_start,
+            "breaches": breaches,
+        }
+
+    def report(self) -> None:
+        print("%-8s %10s %12s %10s %10s %10s  %s" % (
+            "path", "lines", "lines/s", "p50 ms", "p99 ms", "rss MB", "extra"))
+        for name, result in self.results.items():
+            latencies = result.pop("latencies")
+            lines = result.pop("lines")
+            seconds = result.pop("seconds")
+            print("%-8s %10d %12.0f %10.3f %10.3f %10.1f  %s" % (
+                name, lines, lines / seconds if seconds else 0,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                result.pop("rss") / (1 << 20),
+                " ".join("%s=%s" % item for item in result.items()),
+            ))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--packages", type=int, default=1600, help="packages over all router ports")
+    parser.add_argument("--lines", type=int, default=500, help="lines per package")
+    parser.add_argument("--ports", type=int, default=16, help="router ports")
+    parser.add_argument("--metrics", type=int, default=16, help="distinct metric names")
+    parser.add_argument("--hosts", type=int, default=1000, help="distinct hosts, series are metrics x hosts")
+    parser.add_argument("--influx", type=int, default=8, help="influxdb stand-in shards, metric_shard uses 8")
+    parser.add_argument("--slaves", type=int, default=4, help="apm slave stand-ins")
+    parser.add_argument("--buckets", type=int, default=12, help="10s buckets for the buffer run")
+    parser.add_argument("--drain", type=float, default=2.0, help="seconds to let writers drain")
+    parser.add_argument("--verbose", action="store_true", help="keep the pipeline's own prints")
+    args, rest = parser.parse_known_args()
+
+    sys.argv = [sys.argv[0], "--app=apm"] + rest
+    import options as current_options
+    current_options.load_options()
+
+    bench = Bench(args)
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        bench.master()
+        bench.slave()
+        bench.buffer()
+    bench.report()
+
+
+if __name__ == "__main__":
+    main()
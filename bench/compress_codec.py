@@ -0,0 +1,123 @@
+# coding=utf-8
+
+"""
+Compression benchmark for apm payloads.
+
+    python -m bench.compress_codec [--number N] [--sample FILE]
+
+The default samples are one walker publish to topic_apm_collector as JSON
+lines and as a util.batch payload, for a host with the usual ifstat,
+iostat, netstat and procstats series, and one master -> slave message.
+--sample adds a captured payload from disk. Every algorithm from
+util.compress is run on each; lz4 rows only appear when it is installed.
+"""
+
+import argparse
+import random
+import timeit
+from typing import Dict, List, Union
+
+from orderedattrdict import AttrDict
+
+from util.batch import encode_batch
+from util.compress import algorithms, compress, decompress
+from util.json import AttrJson
+
+HOST = "CDN-SD-LC-CNC2-132"
+
+
+def host_items(ts: int=1500000000, seed: int=1) -> List[AttrDict]:
+    rand = random.Random(seed)
+    items: List[AttrDict] = list()
+
+    def add(metric: str, value: Union[int, float], **tags: str) -> None:
+        item = AttrDict()
+        item.metric = metric
+        item.ts = ts
+        item.value = value
+        item.update(tags)
+        item.host = HOST
+        item.area = "north"
+        item.country = "CN"
+        item.province = "shandong"
+        item.role = "edge"
+        item.isp = "CNC"
+        item.idc = "SD_LC_CNC_2"
+        items.append(item)
+
+    for iface in ("eth0", "eth1", "eth2", "eth3"):
+        for direction in ("in", "out"):
+            for name in ("bytes", "packets", "errs", "dropped", "fifo.errs", "frame.errs", "compressed", "multicast"):
+                add("proc.net.%s" % name, rand.randint(0, 1 << 40), iface=iface, direction=direction)
+    for disk in ["sd%s" % c for c in "abcdefghijkl"]:
+        for name in ("read_requests", "read_merged", "read_sectors", "msec_read", "write_requests",
+                     "write_merged", "write_sectors", "msec_write", "ios_in_progress", "msec_total",
+                     "msec_weighted_total"):
+            add("iostat.disk.%s" % name, rand.randint(0, 1 << 32), dev=disk)
+    for name in range(50):
+        add("net.stat.tcp.stat%d" % name, rand.randint(0, 1 << 24), type="tcp")
+    for cpu in range(32):
+        for name in ("user", "nice", "system", "idle", "iowait", "irq", "softirq"):
+            add("proc.stat.cpu.percpu", rand.randint(0, 1 << 32), cpu=str(cpu), type=name)
+    return items
+
+
+def slave_message(items: List[AttrDict]) -> str:
+    """Master lines as forwarded to an apm slave."""
+    lines: List[str] = list()
+    for item in items:
+        tags = " ".join(
+            "%s=%s" % (k, v) for k, v in item.items()
+            if k not in ("metric", "ts", "value")
+        )
+        lines.append("12,%s,%s,%s;put %s %s %s %s" % (
+            item.metric, item.ts, item.value,
+            item.metric, item.ts, item.value, tags
+        ))
+    return "\n".join(lines)
+
+
+def samples(extra: List[str]) -> Dict[str, Union[str, bytes]]:
+    items = host_items()
+    result: Dict[str, Union[str, bytes]] = {
+        "walker.json": "\n".join(AttrJson.dumps_plain(item) for item in items),
+        "walker.batch": encode_batch(HOST, items),
+        "slave.lines": slave_message(items[:200]),
+    }
+    for path in extra:
+        with open(path, "rb") as fp:
+            result[path] = fp.read()
+    return result
+
+
+def run(number: int, extra: List[str]) -> None:
+    codecs = [("zlib", 1), ("zlib", 6)]
+    if "lz4" in algorithms():
+        codecs.insert(0, ("lz4", 0))
+
+    print("%-16s %-8s %10s %10s %8s %12s %12s" % (
+        "payload", "codec", "raw B", "packed B", "ratio", "pack us", "unpack us"))
+    for name, payload in samples(extra).items():
+        raw = len(payload.encode() if isinstance(payload, str) else payload)
+        for algorithm, level in codecs:
+            packed = compress(payload, algorithm, level or 6)
+            assert decompress(packed) == payload
+            pack_time = timeit.timeit(lambda: compress(payload, algorithm, level or 6), number=number)
+            unpack_time = timeit.timeit(lambda: decompress(packed), number=number)
+            label = algorithm if algorithm == "lz4" else "%s-%d" % (algorithm, level)
+            print("%-16s %-8s %10d %10d %8.2f %12.1f %12.1f" % (
+                name, label, raw, len(packed), raw / len(packed),
+                pack_time * 1e6 / number, unpack_time * 1e6 / number
+            ))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument("--sample", action="append", default=[], help="captured payload file")
+    args = parser.parse_args()
+    run(args.number, args.sample)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# coding=utf-8
+
+"""
+Microbenchmark for util.json on realistic payloads.
+
+    python -m bench.json_codec [--number N]
+
+apm is one collector sample as stamped by ApmHandler.data, transaction is
+a sync transaction document with ObjectIds and dates. Every codec is run
+on the same JSON text; orjson/ujson rows only appear when installed.
+"""
+
+import argparse
+import datetime
+import json
+import timeit
+from typing import Callable, Dict, List, Tuple
+
+from bson.objectid import ObjectId
+from orderedattrdict import AttrDict
+
+import util.json as attr_json
+from util.json import AttrJson
+
+
+def apm_payload() -> AttrDict:
+    item = AttrDict()
+    item.metric = "iostat.disk.read_requests"
+    item.ts = 1500000000
+    item.value = 123456789
+    item.dev = "sda"
+    item.host = "CDN-SD-LC-CNC2-132"
+    item.area = "north"
+    item.country = "CN"
+    item.province = "shandong"
+    item.role = "edge"
+    item.isp = "CNC"
+    item.idc = "SD_LC_CNC_2"
+    return item
+
+
+def transaction_payload() -> AttrDict:
+    now = datetime.datetime(2017, 7, 14, 2, 40, 0, 123456)
+    item = AttrDict()
+    item.transaction_id = ObjectId()
+    item.create_time = now
+    item.last_time = now
+    item.date = now.date()
+    item.status = "running"
+    item.dst = ["CDN-SD-LC-CNC2-%d" % i for i in range(20)]
+    item.application = AttrDict(name="sync", path="/usr/local/nginx/conf", version="a36711c582fb53a5")
+    item.results = [
+        AttrDict(transfer_id=ObjectId(), host="CDN-SD-LC-CNC2-%d" % i, code=0, message="ok", time=now)
+        for i in range(20)
+    ]
+    return item
+
+
+def codecs() -> List[Tuple[str, Callable[[str], object], Callable[[AttrDict], str]]]:
+    result = [
+        ("AttrJson", AttrJson.loads, AttrJson.dumps),
+        ("AttrJson.plain", AttrJson.loads_plain, AttrJson.dumps_plain),
+        ("json", json.loads, json.dumps),
+    ]
+    if attr_json.orjson is not None:
+        orjson = attr_json.orjson
+        result.append((
+            "orjson", orjson.loads,
+            lambda obj: orjson.dumps(obj, default=attr_json.attr_json_default)
+        ))
+    if attr_json.ujson is not None:
+        ujson = attr_json.ujson
+        result.append(("ujson", ujson.loads, lambda obj: ujson.dumps(obj, default=attr_json.attr_json_default)))
+    return result
+
+
+def run(number: int) -> None:
+    payloads: Dict[str, AttrDict] = {
+        "apm": apm_payload(),
+        "transaction": transaction_payload(),
+    }
+
+    print("%-12s %-16s %12s %12s" % ("payload", "codec", "loads us", "dumps us"))
+    for name, payload in payloads.items():
+        text = AttrJson.dumps(payload)
+        for codec, loads, dumps in codecs():
+            try:
+                load_time = timeit.timeit(lambda: loads(text), number=number)
+            except Exception as e:
+                print("%-12s %-16s loads failed: %r" % (name, codec, e))
+                continue
+            try:
+                dump_time = timeit.timeit(lambda: dumps(payload), number=number)
+                dump_us = "%12.2f" % (dump_time * 1e6 / number)
+            except TypeError:
+                dump_us = "%12s" % "n/a"
+            print("%-12s %-16s %12.2f %s" % (name, codec, load_time * 1e6 / number, dump_us))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+    run(args.number)
+
+
+if __name__ == "__main__":
+    main()
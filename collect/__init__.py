@@ -8,8 +8,9 @@ class CollectApp:
         from .collector import Collector
         self.meta: Dict[str, Collector] = dict()
 
+        from util.batch import BATCH_PROTOCOL
         from util.message import WsClientMessage
-        self.message = WsClientMessage()
+        self.message = WsClientMessage([BATCH_PROTOCOL])
 
         from tornado.options import options
         self.message.run(options.config.unix_sock)
@@ -1,24 +1,31 @@
 # coding=utf-8
 
+import ctypes
+import ctypes.util
+import functools
+import json
 import math
+import multiprocessing
 import os
 import queue
 import random
+import select
+import socket
 import subprocess
 import threading
 import time
 import traceback
 import unittest
 import util.pygtrie as pygtrie
-from collections import defaultdict
+from collections import defaultdict, deque
+from urllib import parse
 
-import numpy as np
-import pandas as pd
 import regex
 
 
 class DomainTree:
     def __init__(self, domains):
+        self.domains = list(domains)
         self.tree = pygtrie.StringTrie(separator='.')
         for domain in domains:
             self.tree[domain[::-1]] = domain
@@ -27,21 +34,61 @@ class DomainTree:
         return self.tree.longest_prefix(domain[::-1])[1]
 
 
+class DomainRewriter:
+    """
+    Maps a $http_host to the canonical domain reported in ngx.log.*.
+    Host cardinality is tiny compared to line volume, so results are kept
+    in a bounded LRU cache; cache_delta() reports its hits and misses since
+    the last call.
+    """
+
+    def __init__(self, tree, cache_size=65536):
+        self.tree = tree
+        self.rewrite = functools.lru_cache(maxsize=cache_size)(self._rewrite)
+        self.hits = 0
+        self.misses = 0
+
+    def _rewrite(self, host):
+        try:
+            hostname = parse.urlparse('http://' + host).hostname
+        except ValueError:
+            hostname = host
+
+        if not hostname:
+            return "unknown"
+
+        try:
+            socket.inet_aton(hostname)
+            return 'example.com'
+        except OSError:
+            return self.tree.match(hostname) or "unknown"
+
+    def cache_info(self):
+        return self.rewrite.cache_info()
+
+    def cache_delta(self):
+        info = self.rewrite.cache_info()
+        hits, misses = info.hits - self.hits, info.misses - self.misses
+        self.hits, self.misses = info.hits, info.misses
+        return hits, misses
+
+
 supported_domains = DomainTree(['www.example.com'])
+domain_rewriter = DomainRewriter(supported_domains)
+domains_version = 0
 
 
 def rewrite_domain(s):
-    import socket
-    from urllib import parse
+    return domain_rewriter.rewrite(s)
 
-    hostname = s
 
-    try:
-        hostname = parse.urlparse('http://' + hostname).hostname
-        socket.inet_aton(hostname)
-        return 'example.com'
-    except:
-        return supported_domains.match(hostname) or "unknown"
+def reload_domains(domains):
+    """Swap in a new domain list; the old cache goes away with the old rewriter."""
+    global supported_domains, domain_rewriter, domains_version
+    tree = DomainTree(domains)
+    supported_domains = tree
+    domain_rewriter = DomainRewriter(tree)
+    domains_version += 1
 
 
 class NgxVar:
@@ -137,63 +184,380 @@ d_for" "$upstream_http_via" "$bill_status" "$connection"';
         return bytes(value, 'utf-8').decode('unicode_escape') if self.non_trivial(value) else ""
 
 
+def _non_trivial(value):
+    return value and value != b"-"
+
+
+def _parse_int(value):
+    return int(value) if _non_trivial(value) else 0
+
+
+def _parse_float(value):
+    v = float(value) if _non_trivial(value) else 1e-6
+    if math.isclose(v, 0, abs_tol=1e-6):
+        v = 1e-6
+    return v
+
+
+def _parse_upstream(value):
+    for delim in (b' : ', b', '):
+        try:
+            return sum([_parse_float(x) for x in value.split(delim)])
+        except ValueError:
+            pass
+    return _parse_float(value)
+
+
+class NgxBatch:
+    """
+    Column oriented view of a block of access log lines, one list per field
+    NgxSample needs. Row i of every column belongs to the same log line.
+    """
+    COLUMNS = (
+        'timestamp',
+        'host',
+        'status',
+        'bytes_sent',
+        'content_length',
+        'request_time',
+        'upstream_response_time',
+    )
+
+    def __init__(self):
+        self.timestamp = []
+        self.host = []
+        self.status = []
+        self.bytes_sent = []
+        self.content_length = []
+        self.request_time = []
+        self.upstream_response_time = []
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def append(self, timestamp, host, status, bytes_sent, content_length,
+               request_time, upstream_response_time):
+        self.timestamp.append(timestamp)
+        self.host.append(host)
+        self.status.append(status)
+        self.bytes_sent.append(bytes_sent)
+        self.content_length.append(content_length)
+        self.request_time.append(request_time)
+        self.upstream_response_time.append(upstream_response_time)
+
+
+class NgxBatchParser:
+    """
+    Parses a block of raw log lines (bytes) into a NgxBatch in one pass.
+
+    Every field of cdn_log is wrapped in double quotes, so splitting a line
+    on b'"' puts the values at the odd indexes; this replaces the recursive
+    NgxVar.PATTERN match. $time_local only changes once per second, so the
+    strptime result is cached by its raw bytes.
+    """
+    FALLBACK_SUFFIX = b':16688'
+
+    def __init__(self, ignore_fallback=True, time_cache_size=4096):
+        self.ignore_fallback = ignore_fallback
+        self.time_cache_size = time_cache_size
+        self.time_cache = dict()
+        self.errors = 0
+
+    def parse_time(self, value):
+        ts = self.time_cache.get(value)
+        if ts is None:
+            if len(self.time_cache) >= self.time_cache_size:
+                self.time_cache.clear()
+            ts = int(time.mktime(time.strptime(value.decode('ascii'), '%d/%b/%Y:%H:%M:%S %z')))
+            self.time_cache[value] = ts
+        return ts
+
+    def parse(self, block):
+        batch = NgxBatch()
+        lines = block.split(b'\n') if isinstance(block, bytes) else block
+        cache = self.time_cache
+        errors = 0
+
+        for line in lines:
+            if not line:
+                continue
+
+            values = line.split(b'"')[1::2]
+            try:
+                if self.ignore_fallback and values[0].endswith(self.FALLBACK_SUFFIX):
+                    continue
+
+                timestamp = cache.get(values[2])
+                if timestamp is None:
+                    timestamp = self.parse_time(values[2])
+
+                host = values[9]
+                host = host.decode('unicode_escape') if _non_trivial(host) else ""
+                upstream_response_time = _parse_upstream(values[22]) if len(values) > 22 else 0.0
+
+                batch.append(
+                    timestamp,
+                    host,
+                    _parse_int(values[4]),
+                    _parse_int(values[6]),
+                    _parse_int(values[7]),
+                    _parse_float(values[14]),
+                    upstream_response_time,
+                )
+            except (IndexError, ValueError, UnicodeDecodeError):
+                errors += 1
+
+        if errors:
+            self.errors += errors
+            print('ngx batch parser: skipped %d bad lines' % errors)
+
+        return batch
+
+
+class NgxSketch:
+    """
+    Log-bucketed histogram (DDSketch style) used for the median. Bucket i
+    holds values in (GAMMA ** (i - 1), GAMMA ** i], so any quantile is
+    returned with at most RELATIVE_ACCURACY relative error, and two
+    sketches merge by adding their bucket counts.
+    """
+    RELATIVE_ACCURACY = 0.01
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+
+    __slots__ = ('bins', 'zeros', 'count')
+
+    def __init__(self):
+        self.bins = dict()
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+
+        index = math.ceil(math.log(value) / self.LOG_GAMMA)
+        self.bins[index] = self.bins.get(index, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.zeros += other.zeros
+        bins = self.bins
+        for index, count in other.bins.items():
+            bins[index] = bins.get(index, 0) + count
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return 2 * self.GAMMA ** index / (self.GAMMA + 1)
+
+        return 2 * self.GAMMA ** max(self.bins) / (self.GAMMA + 1)
+
+
+class NgxStat:
+    __slots__ = ('count', 'sum', 'min', 'max', 'sketch')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sketch = NgxSketch()
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.sketch.add(value)
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else 0
+
+    @property
+    def mid(self):
+        return min(max(self.sketch.quantile(0.5), self.min), self.max) if self.count else 0
+
+
+class NgxGroup:
+    __slots__ = ('ts', 'count', 'speed', 'req_time', 'ups_time', 'body_size')
+
+    def __init__(self):
+        self.ts = 0
+        self.count = 0
+        self.speed = NgxStat()
+        self.req_time = NgxStat()
+        self.ups_time = NgxStat()
+        self.body_size = NgxStat()
+
+    def add(self, timestamp, speed, req_time, ups_time, body_size):
+        self.ts = timestamp // 10 * 10
+        self.count += 1
+        self.speed.add(speed)
+        self.req_time.add(req_time)
+        self.ups_time.add(ups_time)
+        self.body_size.add(body_size)
+
+    def merge(self, other):
+        self.ts = max(self.ts, other.ts)
+        self.count += other.count
+        self.speed.merge(other.speed)
+        self.req_time.merge(other.req_time)
+        self.ups_time.merge(other.ups_time)
+        self.body_size.merge(other.body_size)
+
+
+class NgxAggregator:
+    """
+    Online aggregate of one sample window keyed by (domain, status class).
+    Lines are folded in as they arrive, so a window costs O(groups) memory
+    and flushing it is O(groups) regardless of the request rate.
+    """
+    STATS = ('speed', 'req_time', 'ups_time', 'body_size')
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.groups = dict()
+        self.newest = 0
+
+    def __len__(self):
+        return len(self.groups)
+
+    def group(self, domain, code):
+        key = (domain, code)
+        group = self.groups.get(key)
+        if group is None:
+            group = NgxGroup()
+            self.groups[key] = group
+        return group
+
+    def add(self, timestamp, host, status, bytes_sent, content_length,
+            request_time, upstream_response_time):
+        self.group(rewrite_domain(host), status // 100).add(
+            timestamp, bytes_sent / request_time, request_time,
+            upstream_response_time, content_length
+        )
+
+    def add_batch(self, batch, start=0, end=None):
+        self.newest = max(self.newest, max(batch.timestamp[start:end], default=0))
+        add = self.add
+        for row in zip(
+                batch.timestamp[start:end],
+                batch.host[start:end],
+                batch.status[start:end],
+                batch.bytes_sent[start:end],
+                batch.content_length[start:end],
+                batch.request_time[start:end],
+                batch.upstream_response_time[start:end]):
+            add(*row)
+
+    def add_var(self, ngx_var):
+        self.newest = max(self.newest, ngx_var.time_local)
+        self.add(
+            ngx_var.time_local,
+            ngx_var.http_host,
+            ngx_var.status,
+            ngx_var.bytes_sent,
+            ngx_var.sent_http_content_length,
+            ngx_var.request_time,
+            ngx_var.upstream_response_time,
+        )
+
+    def merge(self, other):
+        self.newest = max(self.newest, other.newest)
+        for (domain, code), group in other.groups.items():
+            self.group(domain, code).merge(group)
+
+    def metrics(self):
+        metrics = []
+        for (domain, code), group in self.groups.items():
+            values = [('ngx.log.qps', group.count / self.interval)]
+            for name in self.STATS:
+                stat = getattr(group, name)
+                values.append(('ngx.log.%s.avg' % name, stat.avg))
+                values.append(('ngx.log.%s.mid' % name, stat.mid))
+                values.append(('ngx.log.%s.min' % name, stat.min))
+                values.append(('ngx.log.%s.max' % name, stat.max))
+
+            for name, value in values:
+                if math.isclose(value, 0, abs_tol=1e-6):
+                    value = 0
+
+                metrics.append({
+                    'domain': domain,
+                    'code': code,
+                    'ts': group.ts,
+                    'metric': name,
+                    'value': value,
+                })
+
+        return metrics
+
+
 class NgxSample:
-    def __init__(self, stream, interval=10, ignore_fallback=True):
+    def __init__(self, stream, interval=10, ignore_fallback=True, batch=False):
         self.stream = stream
         self.interval = interval
         self.last_time = 0
-        self.stack = []
+        self.aggregator = NgxAggregator(interval)
         self.ignore_fallback = ignore_fallback
+        self.parser = NgxBatchParser(ignore_fallback) if batch else None
 
     def sample(self):
-        d = {
-            'timestamp': [],
-            'domain': [],
-            'code': [],
-            'speed': [],
-            'req_time': [],
-            'ups_time': [],
-            'body_size': [],
-        }
-
-        for item in self.stack:
-            d['timestamp'].append(item.time_local // 10 * 10)
-            d['domain'].append(rewrite_domain(item.http_host))
-            d['code'].append(int(item.status / 100))
-            d['speed'].append(item.bytes_sent / item.request_time)
-            d['req_time'].append(item.request_time)
-            d['ups_time'].append(item.upstream_response_time)
-            d['body_size'].append(item.sent_http_content_length)
-
+        aggregator = self.aggregator
         self.last_time = 0
-        self.stack = []
-        df = pd.DataFrame(d)
-        group = df.groupby(['domain', 'code'])
-        return pd.DataFrame({
-            'ts': group['timestamp'].last(),
-            'ngx.log.qps': group.size() / self.interval,
-            'ngx.log.speed.avg': group['speed'].mean(),
-            'ngx.log.speed.mid': group['speed'].median(),
-            'ngx.log.speed.min': group['speed'].min(),
-            'ngx.log.speed.max': group['speed'].max(),
-            'ngx.log.req_time.avg': group['req_time'].mean(),
-            'ngx.log.req_time.mid': group['req_time'].median(),
-            'ngx.log.req_time.min': group['req_time'].min(),
-            'ngx.log.req_time.max': group['req_time'].max(),
-            'ngx.log.ups_time.avg': group['ups_time'].mean(),
-            'ngx.log.ups_time.mid': group['ups_time'].median(),
-            'ngx.log.ups_time.min': group['ups_time'].min(),
-            'ngx.log.ups_time.max': group['ups_time'].max(),
-            'ngx.log.body_size.avg': group['body_size'].mean(),
-            'ngx.log.body_size.mid': group['body_size'].median(),
-            'ngx.log.body_size.min': group['body_size'].min(),
-            'ngx.log.body_size.max': group['body_size'].max(),
-        }).reset_index()
+        self.aggregator = NgxAggregator(self.interval)
+        return aggregator
 
     def ngx_var(self, x):
         return x
 
+    def domain_cache(self):
+        """Domain cache hits and misses since the last call."""
+        return domain_rewriter.cache_delta()
+
+    def feed(self, batch):
+        start = 0
+        for i, timestamp in enumerate(batch.timestamp):
+            if self.last_time == 0:
+                self.last_time = timestamp
+            elif timestamp - self.last_time >= self.interval:
+                self.aggregator.add_batch(batch, start, i)
+                start = i
+                yield self.sample()
+                self.last_time = timestamp
+
+        self.aggregator.add_batch(batch, start)
+
     def __iter__(self):
+        if self.parser is not None:
+            for block in self.stream:
+                yield from self.feed(self.parser.parse(block))
+
+            yield self.sample()
+            return
+
         for line in self.stream:
             try:
                 ngx_var = self.ngx_var(NgxVar(line))
@@ -207,13 +571,125 @@ class NgxSample:
             if self.last_time == 0:
                 self.last_time = timestamp
             if timestamp - self.last_time < self.interval:
-                self.stack.append(ngx_var)
+                self.aggregator.add_var(ngx_var)
             else:
                 yield self.sample()
 
         yield self.sample()
 
 
+class NgxWorker:
+    """Per-process state of a NgxPoolSample worker."""
+    instance = None
+
+    def __init__(self, interval, ignore_fallback):
+        self.interval = interval
+        self.parser = NgxBatchParser(ignore_fallback)
+
+    @classmethod
+    def init(cls, interval, ignore_fallback, domains):
+        reload_domains(domains)
+        cls.instance = cls(interval, ignore_fallback)
+
+    @classmethod
+    def run(cls, block):
+        worker = cls.instance
+        batch = worker.parser.parse(block)
+        interval = worker.interval
+        windows = dict()
+        start = 0
+        timestamps = batch.timestamp
+        for i in range(1, len(timestamps) + 1):
+            if i < len(timestamps) and \
+                    timestamps[i] // interval == timestamps[start] // interval:
+                continue
+
+            window = timestamps[start] // interval * interval
+            aggregator = windows.get(window)
+            if aggregator is None:
+                aggregator = NgxAggregator(interval)
+                windows[window] = aggregator
+            aggregator.add_batch(batch, start, i)
+            start = i
+
+        # the hosts are rewritten here, the parent's cache sees none of them
+        return windows, domain_rewriter.cache_delta()
+
+
+class NgxPoolSample(NgxSample):
+    """
+    Shards raw log blocks across worker processes. Each worker parses its
+    block and pre-aggregates it per interval-aligned window; the parent only
+    merges the partial aggregates, in block order, into the open window.
+    At most max_pending blocks are in flight so a slow pool pushes back
+    on the tailer instead of buffering the log in memory. The domain list
+    goes to the workers once, through the pool initializer; a reload
+    drains the blocks in flight and restarts the pool with the new list.
+    """
+
+    def __init__(self, stream, workers, interval=10, ignore_fallback=True, max_pending=None):
+        super().__init__(stream, interval, ignore_fallback, batch=True)
+        self.workers = workers
+        self.max_pending = max_pending or workers * 2
+        self.pool = None
+        self.pool_version = None
+        self.start_pool()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def start_pool(self):
+        if self.pool is not None:
+            self.pool.terminate()
+        self.pool_version = domains_version
+        self.pool = multiprocessing.Pool(
+            self.workers, NgxWorker.init,
+            (self.interval, self.ignore_fallback, supported_domains.domains)
+        )
+
+    def domain_cache(self):
+        hits, misses = self.cache_hits, self.cache_misses
+        self.cache_hits = self.cache_misses = 0
+        return hits, misses
+
+    def merge(self, result):
+        try:
+            windows, (hits, misses) = result.get()
+        except Exception:
+            print(traceback.format_exc())
+            return
+
+        self.cache_hits += hits
+        self.cache_misses += misses
+
+        for window in sorted(windows):
+            if self.last_time == 0:
+                self.last_time = window
+            elif window >= self.last_time + self.interval:
+                yield self.sample()
+                self.last_time = window
+            self.aggregator.merge(windows[window])
+
+    def __iter__(self):
+        pending = deque()
+        try:
+            for block in self.stream:
+                if domains_version != self.pool_version:
+                    while pending:
+                        yield from self.merge(pending.popleft())
+                    self.start_pool()
+
+                pending.append(self.pool.apply_async(NgxWorker.run, (block,)))
+                while len(pending) >= self.max_pending or (pending and pending[0].ready()):
+                    yield from self.merge(pending.popleft())
+
+            while pending:
+                yield from self.merge(pending.popleft())
+
+            yield self.sample()
+        finally:
+            self.pool.terminate()
+
+
 class Tailer:
     def __init__(self, filename, buffer=0, lines=10, from_start=False):
         cmd = ['/usr/bin/tail', '-F', '-n']
@@ -265,75 +741,294 @@ class Tailer:
         pass
 
 
+class Inotify:
+    IN_MODIFY = 0x00000002
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+
+    def __init__(self):
+        self.fd = -1
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.add_watch = libc.inotify_add_watch
+            self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            print('inotify unavailable:', e)
+
+    @property
+    def enabled(self):
+        return self.fd >= 0
+
+    def watch(self, path, mask):
+        if self.enabled and self.add_watch(self.fd, os.fsencode(path), mask) < 0:
+            print('inotify_add_watch failed:', path, os.strerror(ctypes.get_errno()))
+
+    def wait(self, timeout):
+        if not self.enabled:
+            time.sleep(timeout)
+            return
+
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except (OSError, ValueError):
+            return
+
+        if readable:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except OSError:
+                pass
+
+    def close(self):
+        if self.enabled:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class FileTailer:
+    """
+    Follows a log file by inode without forking tail(1).
+
+    Iterating yields bytes blocks made of complete lines, read in chunks of
+    up to chunk_size. When the path is renamed or replaced the rest of the
+    old inode is drained before switching to the new file; a truncated file
+    is re-read from the start. The (dev, ino, offset) of the last consumed
+    line is persisted to offset_file so a restart resumes at the same byte.
+    """
+
+    def __init__(self, filename, offset_file=None, chunk_size=1 << 20,
+                 idle_timeout=1.0, from_start=False):
+        self.filename = filename
+        self.offset_file = offset_file
+        self.chunk_size = chunk_size
+        self.idle_timeout = idle_timeout
+        self.from_start = from_start
+        self.fd = -1
+        self.ino = None
+        self.offset = 0
+        self.saved_time = 0
+        self._closed = False
+        self.inotify = Inotify()
+        self.inotify.watch(
+            os.path.dirname(os.path.abspath(filename)),
+            Inotify.IN_MODIFY | Inotify.IN_CREATE | Inotify.IN_DELETE |
+            Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO
+        )
+
+    def load_offset(self):
+        try:
+            with open(self.offset_file) as fp:
+                saved = json.load(fp)
+            return (saved['dev'], saved['ino']), saved['offset']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, 0
+
+    def save_offset(self, force=False):
+        now = time.time()
+        if not self.offset_file or self.ino is None or (not force and now - self.saved_time < 1):
+            return
+
+        self.saved_time = now
+        tmp = self.offset_file + '.tmp'
+        try:
+            with open(tmp, 'w') as fp:
+                json.dump({'dev': self.ino[0], 'ino': self.ino[1], 'offset': self.offset}, fp)
+            os.replace(tmp, self.offset_file)
+        except OSError as e:
+            print('tailer save offset:', e)
+
+    def open(self, resume):
+        try:
+            fd = os.open(self.filename, os.O_RDONLY | os.O_CLOEXEC)
+        except FileNotFoundError:
+            return False
+
+        st = os.fstat(fd)
+        self.fd = fd
+        self.ino = (st.st_dev, st.st_ino)
+
+        if resume:
+            ino, offset = self.load_offset() if self.offset_file else (None, 0)
+            if ino == self.ino:
+                # shorter than the saved offset, it was truncated while we were down
+                self.offset = offset if offset <= st.st_size else 0
+            elif ino is not None:
+                # rotated while we were down, everything in the new file is unread
+                self.offset = 0
+            else:
+                self.offset = 0 if self.from_start else st.st_size
+        else:
+            self.offset = 0
+
+        os.lseek(fd, self.offset, os.SEEK_SET)
+        return True
+
+    def reopen(self):
+        os.close(self.fd)
+        self.fd = -1
+        self.open(False)
+
+    def rotated(self):
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+
+        return (st.st_dev, st.st_ino) != self.ino
+
+    def truncated(self):
+        # compared with what was read, the unconsumed partial line included
+        if os.fstat(self.fd).st_size >= os.lseek(self.fd, 0, os.SEEK_CUR):
+            return False
+
+        print('tailer: %s truncated' % self.filename)
+        self.offset = 0
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        return True
+
+    def __iter__(self):
+        pending = b''
+        resume = True
+
+        while not self._closed:
+            if self.fd < 0:
+                if not self.open(resume):
+                    self.inotify.wait(self.idle_timeout)
+                    self.on_idle()
+                    continue
+                resume = False
+
+            data = os.read(self.fd, self.chunk_size)
+            if data:
+                end = data.rfind(b'\n')
+                if end < 0:
+                    pending += data
+                    continue
+
+                block = pending + data[:end + 1]
+                pending = data[end + 1:]
+                yield block
+
+                self.offset += len(block)
+                self.save_offset()
+                continue
+
+            if self.rotated():
+                # the old inode is drained, anything left is an unterminated last line
+                if pending:
+                    yield pending + b'\n'
+                    pending = b''
+                self.reopen()
+                self.save_offset(True)
+                continue
+
+            if self.truncated():
+                # the rest of a partial line went with the truncation
+                pending = b''
+                continue
+
+            self.inotify.wait(self.idle_timeout)
+            self.on_idle()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        if self._closed:
+            return
+
+        self._closed = True
+        self.save_offset(True)
+        self.inotify.close()
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def on_idle(self):
+        pass
+
+
 class NgxLog:
+    """
+    Hands sampled metrics from the parsing thread to the collect timer.
+
+    The parser appends whole windows to a pending list and collect() swaps
+    that list out under a lock, so neither side waits on the other. Windows
+    that would grow the pending list past buffer_size are dropped and
+    counted. Produced, dropped and domain cache hits and misses since the
+    previous collect, and the lag behind the newest parsed log line, are
+    reported as ngx.log.* metrics on every collect.
+    """
+
     def __init__(self, stream, buffer_size=100000, collect_diff=10):
         self.stream = stream
+        self.buffer_size = buffer_size
         self.collect_diff = collect_diff
         self.done = False
-        self.queue = queue.Queue(buffer_size)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.produced = 0
+        self.dropped = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.newest = 0
         threading.Thread(target=self._target).start()
 
     def collect(self, ts):
-        return self._get(ts)
+        metrics = self._get(ts)
+        metrics.extend(self.self_metrics(ts))
+        return metrics
 
     def _get(self, ts):
-        metrics = []
-        while not self.done:
-            try:
-                metrics.append(self.queue.get(timeout=1))
-            except queue.Empty:
-                break
-
+        with self.lock:
+            metrics, self.pending = self.pending, []
         return metrics
 
-    def _put(self, metric):
-        try:
-            self.queue.put(metric, timeout=0.1)
-        except queue.Full:
-            pass
+    def _put(self, metrics, cache=(0, 0), newest=0):
+        with self.lock:
+            self.newest = max(self.newest, newest)
+            self.cache_hits += cache[0]
+            self.cache_misses += cache[1]
+            room = self.buffer_size - len(self.pending)
+            if len(metrics) > room:
+                self.dropped += len(metrics) - max(room, 0)
+                metrics = metrics[:max(room, 0)]
+            self.pending.extend(metrics)
+            self.produced += len(metrics)
+
+    def self_metrics(self, ts):
+        with self.lock:
+            produced, self.produced = self.produced, 0
+            dropped, self.dropped = self.dropped, 0
+            hits, self.cache_hits = self.cache_hits, 0
+            misses, self.cache_misses = self.cache_misses, 0
+            newest = self.newest
+
+        values = [
+            ('ngx.log.produced', produced),
+            ('ngx.log.dropped', dropped),
+            ('ngx.log.lag', max(ts - newest, 0) if newest else 0),
+            ('ngx.log.domain_cache.hits', hits),
+            ('ngx.log.domain_cache.misses', misses),
+        ]
+        return [{'ts': ts, 'metric': name, 'value': value} for name, value in values]
 
     def _target(self):
         try:
-            for df in self.stream:
-                for metric in NgxLog.format_as_metrics(df):
-                    self._put(metric)
+            for aggregator in self.stream:
+                metrics = NgxLog.format_as_metrics(aggregator)
+                self._put(metrics, self.stream.domain_cache(), aggregator.newest)
         finally:
             self.done = True
 
     @classmethod
-    def format_as_metrics(cls, df):
-        names = [x for x in df]
-        tuples = df.itertuples(index=False)
-        metrics = []
-        for values in tuples:
-            d = {}
-            metric_index = []
-            values = list(values)
-            for i in range(len(names)):
-                value_type = type(values[i])
-                if value_type is np.int64:
-                    values[i] = int(values[i])
-                elif value_type is np.float64:
-                    values[i] = float(values[i])
-
-                name, value = names[i], values[i]
-                if name.startswith('ngx.log.'):
-                    metric_index.append(i)
-                else:
-                    d[name] = value
-
-            for i in metric_index:
-                metric = d.copy()
-                name = names[i]
-                metric['metric'] = name
-                value = values[i]
-                if math.isclose(value, 0, abs_tol=1e-6):
-                    value = 0
-
-                metric['value'] = value
-                metrics.append(metric)
-
-        return metrics
+    def format_as_metrics(cls, aggregator):
+        return aggregator.metrics()
 
 
 class TestRewriteDomain(unittest.TestCase):
@@ -353,6 +1048,243 @@ class TestRewriteDomain(unittest.TestCase):
         self.assertEqual(rewrite_domain('x.com'), 'unknown')
         self.assertEqual(rewrite_domain('x.com:80'), 'unknown')
 
+    def test_reload(self):
+        old = supported_domains
+        try:
+            reload_domains(['a.com'])
+            self.assertEqual(rewrite_domain('x.a.com'), 'a.com')
+            self.assertEqual(rewrite_domain('x.a.com:80'), 'a.com')
+            self.assertEqual(domain_rewriter.cache_info().hits, 0)
+            self.assertEqual(rewrite_domain('x.a.com'), 'a.com')
+            self.assertEqual(domain_rewriter.cache_info().hits, 1)
+
+            reload_domains(['b.com'])
+            self.assertEqual(rewrite_domain('x.a.com'), 'unknown')
+            self.assertEqual(rewrite_domain(''), 'unknown')
+        finally:
+            reload_domains(old.domains)
+
+
+class TestNgxBatchParser(unittest.TestCase):
+    LINE = ('"10.0.0.1:80" "1.1.1.1" "{time_local}" "GET / HTTP/1.1" "{status}" "100" "1100" "1000" "-" '
+            '"{http_host}" "curl" "-" "-" "-" "{request_time}" "5" "-" "-" "-" "-" "0.001" "0.002" '
+            '"{upstream_response_time}" "10.0.0.2:80" "-" "-" "-" "1"')
+
+    def make_line(self, **kwargs):
+        x = {
+            'time_local': time.strftime('%d/%b/%Y:%H:%M:%S %z'),
+            'status': 200,
+            'http_host': 'x.y.com.cn',
+            'request_time': '0.500',
+            'upstream_response_time': '0.100, 0.200',
+        }
+        x.update(kwargs)
+        return self.LINE.format_map(x)
+
+    def test_same_as_ngx_var(self):
+        lines = [
+            self.make_line(),
+            self.make_line(status=404, request_time='-', upstream_response_time='-'),
+            self.make_line(http_host='127.0.0.1:80', upstream_response_time='0.100 : 0.300'),
+        ]
+        batch = NgxBatchParser().parse('\n'.join(lines).encode())
+        self.assertEqual(len(batch), len(lines))
+
+        for i, line in enumerate(lines):
+            ngx_var = NgxVar(line)
+            self.assertEqual(batch.timestamp[i], ngx_var.time_local)
+            self.assertEqual(batch.host[i], ngx_var.http_host)
+            self.assertEqual(batch.status[i], ngx_var.status)
+            self.assertEqual(batch.bytes_sent[i], ngx_var.bytes_sent)
+            self.assertEqual(batch.content_length[i], ngx_var.sent_http_content_length)
+            self.assertAlmostEqual(batch.request_time[i], ngx_var.request_time)
+            self.assertAlmostEqual(batch.upstream_response_time[i], ngx_var.upstream_response_time)
+
+    def test_fallback_and_bad_lines(self):
+        fallback = self.make_line().replace('"10.0.0.1:80"', '"10.0.0.1:16688"')
+        parser = NgxBatchParser()
+        batch = parser.parse('\n'.join([fallback, 'garbage', self.make_line()]).encode())
+        self.assertEqual(len(batch), 1)
+        self.assertEqual(parser.errors, 1)
+        self.assertEqual(len(parser.time_cache), 1)
+
+
+class TestNgxAggregator(unittest.TestCase):
+    def setUp(self):
+        self.domains = supported_domains.domains
+        reload_domains(['y.com.cn'])
+
+    def tearDown(self):
+        reload_domains(self.domains)
+
+    def make(self, rows):
+        aggregator = NgxAggregator()
+        for host, status, bytes_sent, request_time in rows:
+            aggregator.add(1500000003, host, status, bytes_sent, bytes_sent, request_time, request_time)
+        return aggregator
+
+    def test_metrics(self):
+        aggregator = self.make([
+            ('x.y.com.cn', 200, 100, 1.0),
+            ('x.y.com.cn', 204, 300, 1.0),
+            ('x.y.com.cn', 206, 200, 1.0),
+            ('x.y.com.cn', 404, 50, 0.5),
+        ])
+        metrics = {(m['code'], m['metric']): m for m in aggregator.metrics()}
+        self.assertEqual(len(aggregator), 2)
+        self.assertEqual(metrics[(2, 'ngx.log.qps')]['value'], 0.3)
+        self.assertEqual(metrics[(2, 'ngx.log.qps')]['ts'], 1500000000)
+        self.assertEqual(metrics[(2, 'ngx.log.qps')]['domain'], 'y.com.cn')
+        self.assertEqual(metrics[(2, 'ngx.log.speed.avg')]['value'], 200)
+        self.assertEqual(metrics[(2, 'ngx.log.speed.min')]['value'], 100)
+        self.assertEqual(metrics[(2, 'ngx.log.speed.max')]['value'], 300)
+        self.assertAlmostEqual(metrics[(2, 'ngx.log.speed.mid')]['value'], 200, delta=200 * 0.01)
+        self.assertEqual(metrics[(4, 'ngx.log.speed.avg')]['value'], 100)
+
+    def test_merge(self):
+        rows = [('x.y.com.cn', 200, i + 1, 1.0) for i in range(1000)]
+        whole = self.make(rows)
+        merged = self.make(rows[:300])
+        merged.merge(self.make(rows[300:]))
+        self.assertEqual(
+            sorted((m['metric'], m['value']) for m in whole.metrics()),
+            sorted((m['metric'], m['value']) for m in merged.metrics())
+        )
+
+
+class TestFileTailer(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.dir.name, 'access.log')
+        self.offset = os.path.join(self.dir.name, 'access.log.offset')
+        open(self.fname, 'w').close()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def follow(self, actions):
+        tailer = FileTailer(self.fname, self.offset, idle_timeout=0.1)
+        blocks = []
+        th = threading.Thread(target=lambda: blocks.extend(tailer))
+        th.start()
+        for action in actions:
+            time.sleep(0.3)
+            action()
+        time.sleep(0.3)
+        tailer.close()
+        th.join()
+        return b''.join(blocks)
+
+    def append(self, fname, data):
+        with open(fname, 'a') as fp:
+            fp.write(data)
+
+    def test_rotate_and_resume(self):
+        rotated = self.fname + '.1'
+        data = self.follow([
+            lambda: self.append(self.fname, 'a1\npart'),
+            lambda: self.append(self.fname, 'ial\n'),
+            lambda: os.rename(self.fname, rotated),
+            lambda: self.append(rotated, 'late\n'),
+            lambda: self.append(self.fname, 'n1\n'),
+        ])
+        self.assertEqual(data, b'a1\npartial\nlate\nn1\n')
+
+        self.append(self.fname, 'r1\n')
+        self.assertEqual(self.follow([]), b'r1\n')
+
+    def test_truncate(self):
+        data = self.follow([
+            lambda: self.append(self.fname, 'a1\na2\n'),
+            lambda: open(self.fname, 'w').write('b\n'),
+        ])
+        self.assertEqual(data, b'a1\na2\nb\n')
+
+    def test_truncate_partial(self):
+        data = self.follow([
+            lambda: self.append(self.fname, 'a1\npart'),
+            lambda: open(self.fname, 'w').write('b\n'),
+        ])
+        self.assertEqual(data, b'a1\nb\n')
+
+    def test_resume_truncated(self):
+        self.append(self.fname, 'a1\na2\n')
+        self.assertEqual(self.follow([]), b'')
+        # truncated and rewritten while the tailer was down
+        open(self.fname, 'w').write('b\n')
+        self.assertEqual(self.follow([]), b'b\n')
+
+
+class TestNgxLogHandoff(unittest.TestCase):
+    def setUp(self):
+        # a cold domain cache
+        self.domains = supported_domains.domains
+        reload_domains(['example.com'])
+
+    def tearDown(self):
+        reload_domains(self.domains)
+
+    def test_drop(self):
+        ngx_log = NgxLog(iter([]), buffer_size=3)
+        ngx_log._put([{'ts': 0}] * 2)
+        ngx_log._put([{'ts': 0}] * 2)
+        self.assertEqual(len(ngx_log._get(0)), 3)
+
+        metrics = {m['metric']: m['value'] for m in ngx_log.self_metrics(0)}
+        self.assertEqual(metrics['ngx.log.produced'], 3)
+        self.assertEqual(metrics['ngx.log.dropped'], 1)
+
+    def self_metrics(self, sample, ts):
+        ngx_log = NgxLog(sample)
+        while not ngx_log.done:
+            time.sleep(0.05)
+        return {m['metric']: m['value'] for m in ngx_log.self_metrics(ts)}
+
+    def block(self, ts, hosts):
+        line = TestNgxBatchParser.LINE.format(
+            time_local=time.strftime('%d/%b/%Y:%H:%M:%S %z', time.localtime(ts)),
+            status=200, request_time='0.500', upstream_response_time='0.100',
+            http_host='{http_host}'
+        )
+        return '\n'.join(line.format(http_host=host) for host in hosts).encode()
+
+    def test_self_metrics(self):
+        ts = 1500000003
+        hosts = ['a.example.com', 'b.example.com', 'a.example.com']
+        metrics = self.self_metrics(NgxSample(iter([self.block(ts, hosts)]), batch=True), ts + 5)
+        self.assertEqual(metrics['ngx.log.lag'], 5)
+        self.assertEqual(metrics['ngx.log.domain_cache.hits'], 1)
+        self.assertEqual(metrics['ngx.log.domain_cache.misses'], 2)
+
+    def test_pool_reload(self):
+        ts = 1500000003
+        reloaded = []
+
+        def blocks():
+            yield self.block(ts, ['a.example.com'])
+            reloaded.append(domains_version)
+            reload_domains(['a.example.com'])
+            yield self.block(ts, ['a.example.com'])
+
+        sample = NgxPoolSample(blocks(), 1)
+        pool = sample.pool
+        domains = [m['domain'] for aggregator in sample for m in aggregator.metrics()
+                   if m['metric'] == 'ngx.log.qps']
+        self.assertIsNot(sample.pool, pool)
+        self.assertEqual(sample.pool_version, reloaded[0] + 1)
+        # both blocks share one window, the first one rewritten by the old list
+        self.assertEqual(sorted(domains), ['a.example.com', 'example.com'])
+
+    def test_self_metrics_pool(self):
+        ts = 1500000003
+        hosts = ['a.example.com', 'b.example.com', 'a.example.com']
+        sample = NgxPoolSample(iter([self.block(ts, hosts)]), 1)
+        metrics = self.self_metrics(sample, ts + 5)
+        self.assertEqual(metrics['ngx.log.lag'], 5)
+        self.assertEqual(metrics['ngx.log.domain_cache.hits'], 1)
+        self.assertEqual(metrics['ngx.log.domain_cache.misses'], 2)
+
 
 class TestNgxLog(unittest.TestCase):
     def setUp(self):
@@ -415,6 +1347,7 @@ class TestNgxLog(unittest.TestCase):
     def test_collect(self):
         while not self.ngx_log.done:
             self.ngx_log.collect(int(time.time()))
+            time.sleep(1)
 
 
 if __name__ == '__main__':
@@ -425,18 +1358,48 @@ if __name__ == '__main__':
 
 from .collector import Collector
 from orderedattrdict import AttrDict
+from tornado.options import options
 from util.exception import print_frame
 
 
 class NgxLogCollector(Collector):
     def __init__(self):
-        self.ngx_log = NgxLog(NgxSample(Tailer('/usr/local/example/access.log')))
+        # before the pool starts, its workers are handed the domains once
+        self.domains_mtime = None
+        self.load_domains()
+        tailer = FileTailer(options.access_log, options.access_log_offset or None)
+        if options.access_log_workers > 0:
+            sample = NgxPoolSample(tailer, options.access_log_workers)
+        else:
+            sample = NgxSample(tailer, batch=True)
+        self.ngx_log = NgxLog(sample)
         super().__init__()
 
     def name(self):
         return "NginxLogCollector"
 
+    def load_domains(self):
+        path = options.access_log_domains
+        if not path:
+            return
+
+        try:
+            mtime = os.stat(path).st_mtime
+            if mtime == self.domains_mtime:
+                return
+
+            with open(path, encoding='utf-8') as fp:
+                domains = [x.strip() for x in fp if x.strip() and not x.startswith('#')]
+        except OSError as e:
+            print_frame(e)
+            return
+
+        reload_domains(domains)
+        self.domains_mtime = mtime
+        print('access log domains reloaded: %d' % len(domains))
+
     def collect(self, ts):
+        self.load_domains()
         try:
             for metric in self.ngx_log.collect(ts):
                 self.send_message(AttrDict(metric))
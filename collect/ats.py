@@ -2,90 +2,129 @@
 
 import socket
 import struct
-from typing import no_type_check, Tuple, List, Union
+import unittest
+from collections import deque
+from typing import Deque, List, Tuple, Union
 
 from orderedattrdict import AttrDict
+from tornado.options import options
 from twisted.internet import protocol
 
 from util import reactor
 from util.exception import print_frame
 from .collector import Collector
 
+# mgmtapi operation of a single record lookup
+RECORD_GET = 3
+
+_I32 = struct.Struct("i")
+_REPLY = struct.Struct("iii")
+
+DEFAULT_RECORDS: List[str] = [
+    "proxy.process.cache.bytes_used",
+    "proxy.process.cache.ram_cache.bytes_used",
+    "proxy.process.cache.direntries.used",
+    "proxy.node.current_client_connections",
+    "proxy.node.current_server_connections",
+    "proxy.node.user_agent_xacts_per_second",
+    "proxy.node.client_throughput_out",
+    "proxy.node.bandwidth_hit_ratio",
+    "proxy.node.cache_hit_mem_ratio",
+    "proxy.node.cache_hit_ratio",
+]
+
+
+def record_request(record: str) -> bytes:
+    """Length prefixed RECORD_GET of one record name."""
+    name = record.encode("ascii") + b"\0"
+    body = struct.pack("ii%ds" % len(name), RECORD_GET, len(name), name)
+    return _I32.pack(len(body)) + body
+
+
+def record_value(body: bytes) -> Tuple[str, Union[int, float, None]]:
+    """
+    (name, value) of a RECORD_GET reply without its length prefix:
+    i32 error, i32 type, i32 name length, name, i32 value length, value.
+    """
+    error, kind, size = _REPLY.unpack_from(body, 0)
+    name = body[12:12 + size].rstrip(b"\0").decode("ascii")
+    if error:
+        return name, None
+
+    offset = 12 + size
+    (length,) = _I32.unpack_from(body, offset)
+    raw = body[offset + 4:offset + 4 + length]
+
+    value = None
+    if kind in (0, 1) and len(raw) == 8:
+        value = struct.unpack("q", raw)[0]
+    elif kind == 2:
+        if len(raw) == 4:
+            value = round(struct.unpack("f", raw)[0], 3)
+        elif len(raw) == 8:
+            value = round(struct.unpack("d", raw)[0], 3)
+    return name, value
+
+
+class AtsProtocol(protocol.Protocol):
+    """
+    One long-lived mgmtapi connection. Lookups are written back to back
+    and answered in order, replies are framed by their length prefix
+    however the reads split them.
+    """
 
-class ClientUnix(protocol.Protocol):
     def __init__(self) -> None:
-        self.metric: str = None
-        self.message: str = None
-        self.count_msg: int = None
-        self.ts: int = None
+        self.buffer = bytearray()
+        self.pending: Deque[int] = deque()
         self.collector: 'AtsCollector' = None
 
     def connectionMade(self) -> None:
-        message: bytes = self.message.encode('ascii')
-        count_msg = len(message)
-        message1: bytes = struct.pack('%sss' % count_msg, message, ''.encode('ascii'))
-        message2: bytes = struct.pack('ii%sss' % count_msg, 3, len(message1), message1, ''.encode('ascii'))
-        message3: bytes = struct.pack('i%ss' % len(message2), len(message2), message2)
-        self.count_msg = count_msg
-        self.transport.write(message3)
+        self.collector.client = self
+
+    def connectionLost(self, reason=protocol.connectionDone) -> None:
+        if self.collector.client is self:
+            self.collector.client = None
+
+    def query(self, records: List[str], ts: int) -> None:
+        self.transport.write(b"".join(record_request(record) for record in records))
+        self.pending.extend(ts for _ in records)
 
     def dataReceived(self, data: bytes) -> None:
+        self.buffer.extend(data)
+        offset = 0
         try:
-            count_msg = self.count_msg
-            rev_data: bytes = data
-            recv_num = len(rev_data)
-            (env_str, ecode, recv_type, num1, recv_name, pad_str, recv_value) = \
-                struct.unpack("4siii%ss4s%ss" % (count_msg + 1, recv_num - 16 - (count_msg + 1) - 4), rev_data)
-
-            if recv_type == 0 or recv_type == 1:
-                if len(recv_value) == 8:
-                    recv_value = struct.unpack("q", recv_value)[0]
-
-            elif recv_type == 2:
-                if len(recv_value) == 4:
-                    recv_value = struct.unpack("f", recv_value)[0]
-                elif len(recv_value) == 8:
-                    recv_value = struct.unpack("d", recv_value)[0]
-
-            elif recv_type == 3:
-                recv_value = recv_value[:-1]
-
-            if type(recv_value) == float:
-                recv_value = round(recv_value, 3)
-
-            elif type(recv_value) != int:
-                print("break", 'bad value')
-                self.transport.loseConnection()
-                return
-
-            message: bytes = recv_name[:-1]
-            self.collector.print_ats(message.decode('ascii'), recv_value, self.ts)
-            self.transport.loseConnection()
+            while len(self.buffer) - offset >= 4:
+                (length,) = _I32.unpack_from(self.buffer, offset)
+                if len(self.buffer) - offset - 4 < length:
+                    break
+                body = bytes(self.buffer[offset + 4:offset + 4 + length])
+                offset += 4 + length
 
+                ts = self.pending.popleft() if self.pending else None
+                name, value = record_value(body)
+                if value is None:
+                    print("ats mgmtapi: no value for %s" % name)
+                elif ts is not None:
+                    self.collector.print_ats(name, value, ts)
         except Exception as e:
+            # out of step with the server, start over on a new connection
             print_frame(e)
-
-        self.transport.loseConnection()
+            self.transport.loseConnection()
+        del self.buffer[:offset]
 
 
-class ClientUnixFactory(protocol.ClientFactory):
-    protocol: type = ClientUnix
+class AtsFactory(protocol.ReconnectingClientFactory):
+    protocol: type = AtsProtocol
 
-    def __init__(self, metric: str, message: str,
-                 collector: 'AtsCollector', ts: int) -> None:
-        self.metric: str = metric
-        self.message: str = message
-        self.collector: AtsCollector = collector
-        self.ts: int = ts
+    def __init__(self, collector: 'AtsCollector') -> None:
         super().__init__()
+        self.collector = collector
+        self.maxDelay = options.collect_interval
 
-    @no_type_check
-    def buildProtocol(self, addr):
+    def buildProtocol(self, addr) -> AtsProtocol:
+        self.resetDelay()
         p = protocol.ClientFactory.buildProtocol(self, addr)
-        p.ts = self.ts
         p.collector = self.collector
-        p.metric = self.metric
-        p.message = self.message
         return p
 
 
@@ -93,49 +132,15 @@ class AtsCollector(Collector):
     def __init__(self) -> None:
         super().__init__()
         self.addr: str = None
+        self.client: AtsProtocol = None
+        self.factory: AtsFactory = None
+        # rounds given up on with replies outstanding, since the last collect
+        self.stale = 0
 
-        self.args: List[Tuple[str, str]] = [
-            (
-                "proxy.process.cache.bytes_used",
-                "cache_bytes_used"
-            ),
-            (
-                "proxy.process.cache.ram_cache.bytes_used",
-                "ram_cache_bytes_used"
-            ),
-            (
-                "proxy.process.cache.direntries.used",
-                "direntries_used"
-            ),
-            (
-                "proxy.node.current_client_connections",
-                "client_connections"
-            ),
-            (
-                "proxy.node.current_server_connections",
-                "server_connections"
-            ),
-            (
-                "proxy.node.user_agent_xacts_per_second",
-                "user_agent_xacts_per_second"
-            ),
-            (
-                "proxy.node.client_throughput_out",
-                "client_throughput_out"
-            ),
-            (
-                "proxy.node.bandwidth_hit_ratio",
-                "bandwidth_hit_ratio"
-            ),
-            (
-                "proxy.node.cache_hit_mem_ratio",
-                "cache_hit_mem_ratio"
-            ),
-            (
-                "proxy.node.cache_hit_ratio",
-                "cache_hit_ratio"
-            ),
-        ]
+        # record names, or the defaults
+        self.records: List[str] = [
+            record.strip() for record in options.ats_records.split(",") if record.strip()
+        ] or DEFAULT_RECORDS
 
         self.addrs: List[str] = [
             '/usr/local/var/trafficserver/mgmtapi.sock',
@@ -152,6 +157,10 @@ class AtsCollector(Collector):
                 sock.close()
                 break
 
+        if self.addr:
+            self.factory = AtsFactory(self)
+            reactor().connectUNIX(self.addr, self.factory, timeout=1)
+
     def name(self) -> str:
         return "AtsCollector"
 
@@ -178,10 +187,109 @@ class AtsCollector(Collector):
         return sock
 
     def collect(self, ts: int) -> None:
+        client = self.client
+        if client is not None and client.pending:
+            # the last round is still unanswered, reconnect rather than queue up
+            print("ats mgmtapi: %d replies outstanding, reconnecting" % len(client.pending))
+            self.stale += 1
+            client.transport.loseConnection()
+            client = None
+
         if self.addr:
-            for arg in self.args:
-                try:
-                    factory: ClientUnixFactory = ClientUnixFactory(arg[1], arg[0], self, ts)
-                    reactor().connectUNIX(self.addr, factory, timeout=1)
-                except Exception as e:
-                    print_frame(e)
+            data: AttrDict = AttrDict()
+            data.metric = "ats.mgmtapi.stale"
+            data.ts = ts
+            data.value, self.stale = self.stale, 0
+            self.send_message(data)
+
+        if client is None:
+            return
+        try:
+            client.query(self.records, ts)
+        except Exception as e:
+            print_frame(e)
+
+
+class TestRecordRequest(unittest.TestCase):
+    def test_baseline_encoding(self):
+        record = "proxy.node.cache_hit_ratio"
+        self.assertEqual(
+            record_request(record),
+            b"\x23\x00\x00\x00"             # length of the rest, 35
+            b"\x03\x00\x00\x00"             # RECORD_GET
+            b"\x1b\x00\x00\x00"             # name length with its NUL, 27
+            b"proxy.node.cache_hit_ratio\x00"
+        )
+
+    def test_same_as_connection_per_record(self):
+        # the encoding of the ClientUnix this replaced
+        for record in DEFAULT_RECORDS:
+            message = record.encode('ascii')
+            count_msg = len(message)
+            message1 = struct.pack('%sss' % count_msg, message, ''.encode('ascii'))
+            message2 = struct.pack('ii%sss' % count_msg, 3, len(message1), message1, ''.encode('ascii'))
+            message3 = struct.pack('i%ss' % len(message2), len(message2), message2)
+            self.assertEqual(record_request(record), message3)
+
+    def test_reply(self):
+        name = b"proxy.node.cache_hit_ratio\0"
+        body = struct.pack("iii", 0, 2, len(name)) + name + struct.pack("i", 8) + struct.pack("d", 0.12345)
+        self.assertEqual(record_value(body), ("proxy.node.cache_hit_ratio", 0.123))
+        body = struct.pack("iii", 1, 0, len(name)) + name + struct.pack("i", 0)
+        self.assertEqual(record_value(body), ("proxy.node.cache_hit_ratio", None))
+
+
+class TestAtsProtocol(unittest.TestCase):
+    class Collector:
+        def __init__(self):
+            self.client = None
+            self.values = list()
+
+        def print_ats(self, metric, value, ts):
+            self.values.append((metric, value, ts))
+
+    class Transport:
+        def __init__(self):
+            self.lost = False
+
+        def loseConnection(self):
+            self.lost = True
+
+    def reply(self, name, value):
+        name = name.encode("ascii") + b"\0"
+        body = _REPLY.pack(0, 0, len(name)) + name + _I32.pack(8) + struct.pack("q", value)
+        return _I32.pack(len(body)) + body
+
+    def setUp(self):
+        self.proto = AtsProtocol()
+        self.proto.collector = self.Collector()
+        self.proto.transport = self.Transport()
+        self.proto.pending.extend([10, 10, 10])
+
+    def test_split(self):
+        data = self.reply("proxy.node.a", 1)
+        for i in range(0, len(data), 5):
+            self.proto.dataReceived(data[i:i + 5])
+        self.assertEqual(self.proto.collector.values, [("proxy.node.a", 1, 10)])
+        self.assertEqual(len(self.proto.buffer), 0)
+
+    def test_coalesced(self):
+        data = self.reply("proxy.node.a", 1) + self.reply("proxy.node.b", 2) + self.reply("proxy.node.c", 3)
+        # two whole replies and the head of the third in one read
+        self.proto.dataReceived(data[:-3])
+        self.assertEqual(self.proto.collector.values, [("proxy.node.a", 1, 10), ("proxy.node.b", 2, 10)])
+        self.proto.dataReceived(data[-3:])
+        self.assertEqual(self.proto.collector.values[-1], ("proxy.node.c", 3, 10))
+        self.assertEqual(list(self.proto.pending), [])
+        self.assertFalse(self.proto.transport.lost)
+
+    def test_stale_round(self):
+        collector = AtsCollector.__new__(AtsCollector)
+        collector.addr, collector.client, collector.stale = "mgmtapi.sock", self.proto, 0
+        sent = list()
+        collector.send_message = sent.append
+
+        collector.collect(20)
+        self.assertTrue(self.proto.transport.lost)
+        self.assertEqual([(data.metric, data.value) for data in sent], [("ats.mgmtapi.stale", 1)])
+        self.assertEqual(collector.stale, 0)
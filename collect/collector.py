@@ -1,23 +1,33 @@
 # coding=utf-8
 
 import hashlib
-from typing import Dict, List
+import unittest
+from typing import Dict, List, Optional, Tuple, Union
 
 from orderedattrdict import AttrDict
-from tornado.options import options
+from tornado.options import define, options
 
 from util import loop_timer, get_hostname, round_looper
+from util.batch import BATCH_PROTOCOL, BatchEncoder
 from util.exception import print_frame
 from util.json import AttrJson
 from util.message import WsClientMessage
+from .procfs import ProcSnapshot, snapshot
+
+COUNTER_32: int = 1 << 32
 
 
 class Collector:
     message: WsClientMessage = None
     count: int = 0
-    data: Dict[str, List[str]] = dict()
-    sending: Dict[str, List[str]] = dict()
+    data: Dict[str, List[AttrDict]] = dict()
+    sending: Dict[str, List[AttrDict]] = dict()
+    # samples that could not be encoded, per collector
+    dropped: Dict[str, int] = dict()
     host: str = str()
+    # read /proc and /sys through the shared snapshot, collected together
+    procfs: bool = False
+    proc: ProcSnapshot = snapshot
 
     def __init__(self) -> None:
         self.offset = int(
@@ -28,6 +38,10 @@ class Collector:
         Collector.data[self.name()] = list()
         Collector.sending[self.name()] = list()
 
+        # cumulative counter series: key -> [value, ts, sent ts, round]
+        self.counters: Dict[Tuple, List[int]] = dict()
+        self.round = 0
+
     def name(self) -> str:
         return "Collector"
 
@@ -35,23 +49,118 @@ class Collector:
         pass
 
     def swap(self, timestamp: int) -> None:
+        self.round += 1
         self.collect(timestamp)
+        self.sweep()
         self.sending[self.name()] = self.data[self.name()]
         self.data[self.name()] = list()
 
     def run(self) -> None:
+        if self.procfs:
+            self.proc.attach(self)
+            self.proc.run()
+            return
         loop_timer(round_looper(options.collect_interval, self.offset, self.swap))
 
     def send_message(self, data: AttrDict) -> None:
-        data.host = self.host
-        data_json: str = AttrJson.dumps(data)
-        Collector.data[self.name()].append(data_json)
+        """
+        Queues data as it is, it is encoded in send() once the walker's
+        codec is known; callers must not reuse it for another sample.
+        """
+        Collector.data[self.name()].append(data)
+
+    @staticmethod
+    def counter_delta(prev: int, value: int) -> Optional[int]:
+        """
+        Increase of a counter from prev to value. A 32-bit counter that went
+        backwards wrapped if that is the shorter way round; anything else
+        was reset and has no delta.
+        """
+        if value >= prev:
+            return value - prev
+        if prev < COUNTER_32:
+            delta = COUNTER_32 - prev + value
+            if delta < COUNTER_32 // 2:
+                return delta
+        return None
+
+    def send_counter(self, data: AttrDict) -> None:
+        """
+        send_message() for cumulative counters. With --collect_counters
+        set to delta or rate, the increase since the previous collect is
+        sent as <metric>.delta or <metric>.rate (per second) instead of the
+        raw value. The first sample of a series, a reset, and a zero
+        increase within --collect_heartbeat seconds of the last send are
+        not sent.
+        """
+        mode = options.collect_counters
+        if not mode:
+            self.send_message(data)
+            return
+
+        key = (data.metric,) + tuple(
+            (k, v) for k, v in data.items() if k not in ("metric", "ts", "value")
+        )
+        value = int(data.value)
+        state = self.counters.get(key)
+        if state is None:
+            self.counters[key] = [value, data.ts, 0, self.round]
+            return
+
+        prev, prev_ts, sent_ts = state[0], state[1], state[2]
+        state[0], state[1], state[3] = value, data.ts, self.round
+
+        delta = self.counter_delta(prev, value)
+        elapsed = data.ts - prev_ts
+        if delta is None or elapsed <= 0:
+            return
+        if delta == 0 and data.ts - sent_ts < options.collect_heartbeat:
+            return
+
+        state[2] = data.ts
+        data.metric = "%s.%s" % (data.metric, mode)
+        if mode == "rate":
+            data.value = round(delta / elapsed, 2)
+        else:
+            data.value = delta
+        self.send_message(data)
+
+    def sweep(self) -> None:
+        """Drops the state of series not seen this round, e.g. removed devices."""
+        if not self.counters:
+            return
+        gone = [key for key, state in self.counters.items() if state[3] != self.round]
+        for key in gone:
+            del self.counters[key]
 
     @classmethod
-    def do_send(cls, content: str) -> bool:
+    def encode(cls, data: List[AttrDict], binary: bool) -> Tuple[Union[str, bytes], int]:
+        """The payload and the number of samples that had to be dropped."""
+        if binary:
+            encoder = BatchEncoder(cls.host)
+            for d in data:
+                encoder.add(d)
+            return encoder.encode(), encoder.dropped
+
+        lines: List[str] = list()
+        dropped = 0
+        for d in data:
+            item = AttrDict(d)
+            item.host = cls.host
+            try:
+                lines.append(AttrJson.dumps_plain(item))
+            except (TypeError, ValueError):
+                dropped += 1
+        return "\n".join(lines), dropped
+
+    @classmethod
+    def do_send(cls, content: Union[str, bytes]) -> bool:
         ret = False
         try:
-            cls.message.send_message(content)
+            if isinstance(content, bytes):
+                cls.message.send_binary(content)
+            else:
+                cls.message.send_message(content)
             ret = True
         except Exception as e:
             print_frame(e)
@@ -60,13 +169,121 @@ class Collector:
 
     @classmethod
     def send(cls, _: int) -> None:
+        binary = cls.message.protocol_in_use == BATCH_PROTOCOL
         sending = cls.sending
         for name, data in sending.items():
-            content = "\n".join([d for d in data])
             # print(name, len(data))
+            try:
+                content, dropped = cls.encode(data, binary)
+            except Exception as e:
+                print_frame(e)
+                continue
+            if dropped:
+                cls.dropped[name] = cls.dropped.get(name, 0) + dropped
+                print("%s: %d samples dropped, %d in total" % (name, dropped, cls.dropped[name]))
             cls.do_send(content)
 
     @classmethod
     def loop_send(cls, message: WsClientMessage) -> None:
         cls.message = message
         loop_timer(round_looper(options.collect_interval, 0, cls.send))
+
+
+class TestEncode(unittest.TestCase):
+    def items(self):
+        good = AttrDict()
+        good.metric = "test.good"
+        good.ts = 1500000000
+        good.value = 1
+        bad = AttrDict()
+        bad.metric = "test.bad"
+        bad.ts = "soon"
+        bad.value = 2
+        return [good, bad]
+
+    def test_binary_drops_bad_samples(self):
+        from util.batch import decode_batch
+        content, dropped = Collector.encode(self.items(), True)
+        self.assertEqual(dropped, 1)
+        self.assertEqual([d.metric for d in decode_batch(content)], ["test.good"])
+
+    def test_json_leaves_samples_alone(self):
+        items = self.items()
+        content, dropped = Collector.encode(items[:1], False)
+        self.assertEqual(dropped, 0)
+        self.assertIn('"host"', content)
+        self.assertNotIn("host", items[0])
+
+
+class TestCounters(unittest.TestCase):
+    class Sample(Collector):
+        def __init__(self, series) -> None:
+            self.series = series
+            super().__init__()
+
+        def name(self) -> str:
+            return "TestCounters"
+
+        def collect(self, ts: int) -> None:
+            for dev, value in self.series.items():
+                data = AttrDict()
+                data.metric = "test.counter"
+                data.ts = ts
+                data.value = value
+                data.dev = dev
+                self.send_counter(data)
+
+    def setUp(self):
+        for name, value in (("collect_interval", 10), ("collect_counters", ""), ("collect_heartbeat", 30)):
+            if name not in options:
+                define(name, default=value, type=type(value))
+        self.saved = (options.collect_counters, options.collect_heartbeat)
+        options.collect_counters = "rate"
+        options.collect_heartbeat = 30
+
+    def tearDown(self):
+        options.collect_counters, options.collect_heartbeat = self.saved
+
+    def run_rounds(self, rounds):
+        collector = self.Sample({})
+        result = list()
+        for ts, series in rounds:
+            collector.series = series
+            collector.swap(ts)
+            result.append({d.dev: d.value for d in collector.sending[collector.name()]})
+        return collector, result
+
+    def test_rate(self):
+        _, result = self.run_rounds([(0, {"a": 100}), (10, {"a": 200}), (20, {"a": 250})])
+        self.assertEqual(result, [{}, {"a": 10.0}, {"a": 5.0}])
+
+    def test_delta_and_name(self):
+        options.collect_counters = "delta"
+        collector, _ = self.run_rounds([(0, {"a": 1}), (10, {"a": 4})])
+        data = collector.sending[collector.name()][0]
+        self.assertEqual((data.metric, data.value), ("test.counter.delta", 3))
+
+    def test_wrap_and_reset(self):
+        self.assertEqual(Collector.counter_delta(COUNTER_32 - 10, 20), 30)
+        self.assertEqual(Collector.counter_delta(200, 50), None)
+        self.assertEqual(Collector.counter_delta(1 << 40, 5), None)
+        _, result = self.run_rounds([(0, {"a": 200}), (10, {"a": 50}), (20, {"a": 150})])
+        self.assertEqual(result, [{}, {}, {"a": 10.0}])
+
+    def test_heartbeat(self):
+        rounds = [(ts, {"a": 7}) for ts in range(1000, 1060, 10)]
+        _, result = self.run_rounds(rounds)
+        # the first zero increase is sent, then held back for 30s
+        self.assertEqual(result, [{}, {"a": 0.0}, {}, {}, {"a": 0.0}, {}])
+
+    def test_sweep(self):
+        collector, result = self.run_rounds([(0, {"a": 1, "b": 1}), (10, {"a": 2}), (20, {"a": 3, "b": 5})])
+        # b went away and comes back with a fresh baseline
+        self.assertEqual(result, [{}, {"a": 0.1}, {"a": 0.1}])
+        self.assertEqual(len(collector.counters), 2)
+
+    def test_raw(self):
+        options.collect_counters = ""
+        collector, result = self.run_rounds([(0, {"a": 1}), (10, {"a": 2})])
+        self.assertEqual(result, [{"a": 1}, {"a": 2}])
+        self.assertEqual(collector.counters, {})
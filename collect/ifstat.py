@@ -1,7 +1,7 @@
 # coding=utf-8
 
 import re
-from typing import Tuple
+from typing import Dict, List, Tuple
 
 from orderedattrdict import AttrDict
 
@@ -27,42 +27,54 @@ FIELDS: Tuple[str, ...] = (
     "fifo.errs", "collisions", "carrier.errs", "compressed"
 )
 
+# (metric, direction) of each field
+TEMPLATES: Tuple[Tuple[str, str], ...] = tuple(
+    ("proc.net.%s" % field, "out" if i >= 8 else "in")
+    for i, field in enumerate(FIELDS)
+)
+
+INTERFACE = re.compile(
+    r"eth?\d+|em\d+_\d+/\d+|em\d+_\d+|em\d+|"
+    r"p\d+p\d+_\d+/\d+|p\d+p\d+_\d+|p\d+p\d+"
+)
+
 
 class IfstatCollector(Collector):
+    procfs = True
+
     def __init__(self) -> None:
         super().__init__()
-        self.f_netdev = open("/proc/net/dev", encoding='utf-8')
+        self.proc.add("/proc/net/dev")
+
+        # interface names of /proc/net/dev at the last scan, and those we report
+        self.names: List[str] = list()
+        self.interfaces: List[str] = list()
 
     def name(self) -> str:
         return "IfstatCollector"
 
+    def scan(self, names: List[str]) -> None:
+        """Matches interface names again, only when /proc/net/dev lists others."""
+        if names == self.names:
+            return
+        self.names = names
+        self.interfaces = [name for name in names if INTERFACE.fullmatch(name)]
+
     def collect(self, ts: int) -> None:
         # We just care about ethN and emN interfaces.  We specifically
         # want to avoid bond interfaces, because interface
         # stats are still kept on the child interfaces when
         # you bond.  By skipping bond we avoid double counting.
 
-        self.f_netdev.seek(0)
-
-        for line in self.f_netdev:
-            m = re.match("\s+(eth?\d+|em\d+_\d+/\d+|em\d+_\d+|em\d+|"
-                         "p\d+p\d+_\d+/\d+|p\d+p\d+_\d+|p\d+p\d+):(.*)", line)
-            if not m:
-                continue
-
-            intf = m.group(1)
-            stats = m.group(2).split(None)
-
-            def direction(_i: int) -> str:
-                if _i >= 8:
-                    return "out"
-                return "in"
+        netdev: Dict[str, List[int]] = self.proc.net_dev()
+        self.scan(list(netdev))
 
-            for i in range(16):
+        for intf in self.interfaces:
+            for (metric, direction), value in zip(TEMPLATES, netdev[intf]):
                 data = AttrDict()
-                data.metric = "proc.net.%s" % FIELDS[i]
+                data.metric = metric
                 data.ts = ts
-                data.value = int(stats[i])
+                data.value = value
                 data.iface = intf
-                data.direction = direction(i)
-                self.send_message(data)
+                data.direction = direction
+                self.send_counter(data)
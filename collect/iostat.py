@@ -49,17 +49,26 @@
 # when you have to handle mapping of /dev/mapper to dm-N, pulling out
 # swap partitions from /proc/swaps, etc.
 
-import copy
 import os
 import re
-from typing import Tuple, Dict
+from typing import Dict, List, Tuple
 
 from orderedattrdict import AttrDict
 
 from .collector import Collector
 
+# indexes into FIELDS_DISK
+READ_REQUESTS = 0
+MSEC_READ = 3
+WRITE_REQUESTS = 4
+MSEC_WRITE = 7
+IOS_IN_PROGRESS = 8
+MSEC_TOTAL = 9
+
 
 class IostatCollector(Collector):
+    procfs = True
+
     def __init__(self) -> None:
         super().__init__()
 
@@ -85,23 +94,24 @@ class IostatCollector(Collector):
             "write_sectors",
         )
 
-        self.prev_times = (0, 0)
+        self.proc.add("/proc/diskstats")
+        self.proc.add("/proc/uptime")
+        self.prev_uptime = 0.0
+
+        # device -> [current sample, previous sample], swapped every collect
+        self.samples: Dict[str, List[List[int]]] = dict()
+        # device -> whether it is a real disk, for the derived metrics
+        self.devices: Dict[str, bool] = dict()
 
     def name(self) -> str:
         return "IostatCollector"
 
-    def read_uptime(self) -> Tuple[float, float]:
-        try:
-            f_uptime = open("/proc/uptime", encoding='utf-8')
-            line = f_uptime.readline()
-
-            curr_times = line.split(None)
-            delta_times = (float(curr_times[0]) - float(self.prev_times[0]),  float(curr_times[1]) - float(self.prev_times[1]))
-            self.prev_times = curr_times
-            return delta_times
-
-        finally:
-            f_uptime.close()
+    def read_uptime(self) -> float:
+        """Seconds since the previous call, 0.0 on the first."""
+        uptime = float(self.proc.text("/proc/uptime").split(None, 1)[0])
+        itv = uptime - self.prev_uptime if self.prev_uptime else 0.0
+        self.prev_uptime = uptime
+        return itv
 
     @staticmethod
     def get_system_hz() -> int:
@@ -125,32 +135,43 @@ class IostatCollector(Collector):
 
         return os.access(devicename, os.F_OK)
 
+    def send_derived(self, metric: str, ts: int, device: str, itv: float,
+                     curr: List[int], prev: List[int]) -> None:
+        """
+        iostat -x style metrics from the deltas of two samples, all times
+        in milliseconds and util in percent.
+        """
+        rd_ios = curr[READ_REQUESTS] - prev[READ_REQUESTS]
+        wr_ios = curr[WRITE_REQUESTS] - prev[WRITE_REQUESTS]
+        rd_ticks = curr[MSEC_READ] - prev[MSEC_READ]
+        wr_ticks = curr[MSEC_WRITE] - prev[MSEC_WRITE]
+        tot_ticks = curr[MSEC_TOTAL] - prev[MSEC_TOTAL]
+        if min(rd_ios, wr_ios, rd_ticks, wr_ticks, tot_ticks) < 0:
+            # counters wrapped or the device was reset
+            return
+
+        nr_ios = rd_ios + wr_ios
+        values = (
+            ("svctm", tot_ticks / nr_ios if nr_ios else 0.0),
+            ("r_await", rd_ticks / rd_ios if rd_ios else 0.0),
+            ("w_await", wr_ticks / wr_ios if wr_ios else 0.0),
+            ("await", (rd_ticks + wr_ticks) / nr_ios if nr_ios else 0.0),
+            ("util", min(tot_ticks / (itv * 10.0), 100.0)),
+        )
+        for name, value in values:
+            data = AttrDict()
+            data.metric = metric + name
+            data.ts = ts
+            data.value = round(value, 2)
+            data.dev = device
+            self.send_message(data)
+
     def collect(self, ts: int) -> None:
-        init_stats = {
-            "read_requests": 0,
-            "read_merged": 0,
-            "read_sectors": 0,
-            "msec_read": 0,
-            "write_requests": 0,
-            "write_merged": 0,
-            "write_sectors": 0,
-            "msec_write": 0,
-            "ios_in_progress": 0,
-            "msec_total": 0,
-            "msec_weighted_total": 0,
-        }
-
-        prev_stats: Dict = dict()
-        f_diskstats = open("/proc/diskstats", encoding='utf-8')
-        HZ = self.get_system_hz()
-        itv = 1.0
-
-        f_diskstats.seek(0)
-        itv = self.read_uptime()[0]
-
-        for line in f_diskstats:
+        itv = self.read_uptime()
+        seen = set()
+
+        for values in self.proc.fields("/proc/diskstats"):
             # maj, min, devicename, [list of stats, see above]
-            values = line.split(None)
             # shortcut the deduper and just skip disks that
             # haven't done a single read.  This eliminates a bunch
             # of loopback, ramdisk, and cdrom devices but still
@@ -166,101 +187,54 @@ class IostatCollector(Collector):
                 # metric = "iostat.part."
 
             device = values[2]
-            if len(values) == 14:
+            # kernels from 4.18 append discard and flush fields, ignored
+            if len(values) >= 14:
                 # full stats line
+                samples = self.samples.get(device)
+                if samples is None:
+                    samples = self.samples[device] = [[0] * 11, [0] * 11]
+                    fresh = True
+                else:
+                    samples.reverse()
+                    fresh = False
+                curr, prev = samples
+                seen.add(device)
+
                 for i in range(11):
+                    value = curr[i] = int(values[i + 3])
                     data = AttrDict()
-                    data.metric = "%s%s" % (metric, self.FIELDS_DISK[i])
+                    data.metric = metric + self.FIELDS_DISK[i]
                     data.ts = ts
-                    data.value = int(values[i+3])
+                    data.value = value
                     data.dev = device
-                    self.send_message(data)
-
-                ret = self.is_device(device, 0)
+                    if i == IOS_IN_PROGRESS:
+                        # ios_in_progress is a gauge
+                        self.send_message(data)
+                    else:
+                        self.send_counter(data)
+
+                real = self.devices.get(device)
+                if real is None:
+                    real = self.devices[device] = self.is_device(device, 0)
                 # if a device or a partition, calculate the svctm/await/util
-                if not ret:
-                    continue
-
-                stats = dict(zip(self.FIELDS_DISK, values[3:]))
-                if device not in prev_stats:
-                    prev_stats[device] = init_stats
-
-                rd_ios = float(stats.get(b"read_requests".decode('ascii')))
-                wr_ios = float(stats.get(b"write_requests".decode('ascii')))
-                nr_ios = rd_ios + wr_ios
-                prev_rd_ios = float(prev_stats[device].get(b"read_requests".decode('ascii')))
-                prev_wr_ios = float(prev_stats[device].get(b"write_requests".decode('ascii')))
-                prev_nr_ios = prev_rd_ios + prev_wr_ios
-                tput = ((nr_ios - prev_nr_ios) * float(HZ) / float(itv))
-                util = ((float(stats.get(b"msec_total".decode('ascii'))) - float(prev_stats[device].get(b"msec_total".decode('ascii')))) * float(HZ) / float(itv))
-                svctm = 0.0
-                await = 0.0
-                r_await = 0.0
-                w_await = 0.0
-
-                if tput:
-                    svctm = util / tput
-
-                rd_ticks = stats.get(b"msec_read".decode('ascii'))
-                wr_ticks = stats.get(b"msec_write".decode('ascii'))
-
-                prev_rd_ticks = prev_stats[device].get(b"msec_read".decode('ascii'))
-                prev_wr_ticks = prev_stats[device].get(b"msec_write".decode("ascii"))
-
-                if rd_ios != prev_rd_ios:
-                    r_await = (float(rd_ticks) - float(prev_rd_ticks) ) / float(rd_ios - prev_rd_ios)
-                if wr_ios != prev_wr_ios:
-                    w_await = (float(wr_ticks) - float(prev_wr_ticks) ) / float(wr_ios - prev_wr_ios)
-                if nr_ios != prev_nr_ios:
-                    await = (float(rd_ticks) + float(wr_ticks) - float(prev_rd_ticks) - float(prev_wr_ticks)) / float(nr_ios - prev_nr_ios)
-
-                data = AttrDict()
-                data.metric = "%s%s" % (metric, "svctm")
-                data.ts = ts
-                data.value = round(svctm, 2)
-                data.dev = device
-                self.send_message(data)
-
-                data = AttrDict()
-                data.metric = "%s%s" % (metric, "r_await")
-                data.ts = ts
-                data.value = round(r_await, 2)
-                data.dev = device
-                self.send_message(data)
-
-                data = AttrDict()
-                data.metric = "%s%s" % (metric, "w_await")
-                data.ts = ts
-                data.value = round(w_await, 2)
-                data.dev = device
-                self.send_message(data)
-
-                data = AttrDict()
-                data.metric = "%s%s" % (metric, "await")
-                data.ts = ts
-                data.value = round(await, 2)
-                data.dev = device
-                self.send_message(data)
-
-                data = AttrDict()
-                data.metric = "%s%s" % (metric, "util")
-                data.ts = ts
-                data.value = round(util/1000.0, 2)
-                data.dev = device
-                self.send_message(data)
-
-                prev_stats[device] = copy.deepcopy(stats)
+                if real and not fresh and itv > 0:
+                    self.send_derived(metric, ts, device, itv, curr, prev)
 
             elif len(values) == 7:
                 # partial stats line
                 for i in range(4):
                     data = AttrDict()
-                    data.metric = "%s%s" % (metric, self.FIELDS_PART[i])
+                    data.metric = metric + self.FIELDS_PART[i]
                     data.ts = ts
-                    data.value = int(values[i+3])
+                    data.value = int(values[i + 3])
                     data.dev = device
-                    self.send_message(data)
+                    self.send_counter(data)
 
             else:
                 pass
                 # print >> sys.stderr, "Cannot parse /proc/diskstats line: ", line
+
+        # forget devices that went away, they start over if they come back
+        for device in [d for d in self.samples if d not in seen]:
+            del self.samples[device]
+            self.devices.pop(device, None)
@@ -49,23 +49,16 @@ from .collector import Collector
 
 
 class NetstatCollector(Collector):
+    procfs = True
+
     def __init__(self) -> None:
         super().__init__()
 
         self.page_size = resource.getpagesize()
 
-        self.sockstat = None
-        self.netstat = None
-        self.snmp = None
-
-        try:
-            self.sockstat = open("/proc/net/sockstat", encoding='utf-8')
-            self.netstat = open("/proc/net/netstat", encoding='utf-8')
-            # self.snmp = open("/proc/net/snmp", encoding='utf-8')
-        except IOError as e:
-            pass
-            # print >> sys.stderr, "open failed: %s" % e
-            # return 13  # Ask tcollector to not re-start us.
+        self.proc.add("/proc/net/sockstat")
+        self.proc.add("/proc/net/netstat")
+        # self.proc.add("/proc/net/snmp")
 
         # Note: up until v2.6.37-rc2 most of the values were 32 bits.
         # The first value is pretty useless since it accounts for some
@@ -253,7 +246,7 @@ class NetstatCollector(Collector):
                 if tag:
                     t = tag.split("=", 1)
                     data[t[0]] = t[1]
-        self.send_message(data)
+        self.send_counter(data)
 
     def parse_stats(self, stats: str, ts: int, filename: str) -> None:
         statsdikt: Dict[str, Dict] = dict()
@@ -312,13 +305,9 @@ class NetstatCollector(Collector):
             self.send_message(data)
 
     def collect(self, ts: int) -> None:
-        self.sockstat.seek(0)
-        self.netstat.seek(0)
-        # self.snmp.seek(0)
-
-        data = self.sockstat.read()
-        netstats = self.netstat.read()
-        # snmpstats = self.snmp.read()
+        data = self.proc.text("/proc/net/sockstat")
+        netstats = self.proc.text("/proc/net/netstat")
+        # snmpstats = self.proc.text("/proc/net/snmp")
 
         m = re.match(self.regexp, data)
         if not m:
@@ -345,5 +334,5 @@ class NetstatCollector(Collector):
         self.print_sockstat("memory", ts, int(m.group("ip_frag_mem")), " type=ipfrag")
         self.print_sockstat("ipfragqueues", ts, int(m.group("ip_frag_nqueues")))
 
-        self.parse_stats(netstats, ts, self.netstat.name)
-        # self.parse_stats(snmpstats, ts, self.snmp.name)
+        self.parse_stats(netstats, ts, "/proc/net/netstat")
+        # self.parse_stats(snmpstats, ts, "/proc/net/snmp")
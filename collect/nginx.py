@@ -1,14 +1,19 @@
 # coding=utf-8
 
+import json
 import re
-from typing import Any, Tuple, Dict
+import unittest
+from typing import Any, Dict, Tuple
 
 import treq
 from orderedattrdict import AttrDict
+from tornado.options import options
 from treq.response import _Response
 from twisted.internet.defer import Deferred
 from twisted.python.failure import Failure
+from twisted.web.client import HTTPConnectionPool
 
+from util import reactor
 from util.exception import print_frame
 from .collector import Collector
 
@@ -18,14 +23,24 @@ from .collector import Collector
 #  16630948 16630948 31070465
 # Reading: 6 Writing: 179 Waiting: 106
 
+# nginx-module-vts connections -> stub_status names
+VTS_CONNECTIONS: Tuple[Tuple[str, str], ...] = (
+    ("active", "actives"),
+    ("accepted", "accepts"),
+    ("handled", "handled"),
+    ("requests", "requests"),
+    ("reading", "reading"),
+    ("writing", "writing"),
+    ("waiting", "waiting"),
+)
+
 
 class NginxCollector(Collector):
     def __init__(self) -> None:
-        self.ts: int = 0
         self.regexp: re.__Regex = re.compile(
-            u"Active connections: (?P<actives>\d+).*\n"
-            u"server accepts handled requests.*\n (?P<accepts>\d+) (?P<handled>\d+) (?P<requests>\d+).*\n"
-            u"Reading: (?P<reading>\d+) Writing: (?P<writing>\d+) Waiting: (?P<waiting>\d+).*")
+            r"Active connections: (?P<actives>\d+).*\n"
+            r"server accepts handled requests.*\n (?P<accepts>\d+) (?P<handled>\d+) (?P<requests>\d+).*\n"
+            r"Reading: (?P<reading>\d+) Writing: (?P<writing>\d+) Waiting: (?P<waiting>\d+).*")
 
         self.last: Dict[str, Tuple] = dict([
             ('accepts', None),
@@ -33,45 +48,54 @@ class NginxCollector(Collector):
             ('requests', None),
         ])
 
+        # one kept-alive connection to the local nginx
+        self.pool = HTTPConnectionPool(reactor(), persistent=True)
+        self.pool.maxPersistentPerHost = 1
+        self.pool.cachedConnectionTimeout = options.collect_interval * 3
+        self.pool.retryAutomatically = True
+
+        # the vts json has stub_status' connections and the zones in one response
+        self.vts = bool(options.nginx_vts_url)
+        self.status_url = options.nginx_vts_url or options.nginx_status_url
+
         super().__init__()
 
     def name(self) -> str:
         return "NginxCollector"
 
-    def collect(self, ts: int) -> None:
-        self.ts = ts
-        status_url = "http://127.0.0.1/NginxStatus/"
-
+    def request(self, ts: int, retry: bool) -> None:
         try:
-            d: Deferred = treq.get(status_url, timeout=1)
+            d: Deferred = treq.get(self.status_url, timeout=1, pool=self.pool)
             d.addCallback(self.complete_header, ts)
-            d.addErrback(self.response_error)
+            d.addErrback(self.response_error, ts, retry)
         except Exception as e:
             print_frame(e)
 
-    def handler_error(self, error: Failure) -> None:
-        print(error.getErrorMessage())
+    def collect(self, ts: int) -> None:
+        self.request(ts, True)
 
-    def response_error(self, error: Failure) -> None:
+    def response_error(self, error: Failure, ts: int, retry: bool) -> None:
         print(error.getErrorMessage())
-        try:
-            status_url = "http://127.0.0.1/NginxStatus/"
-            d: Deferred = treq.get(status_url, timeout=1)
-            d.addCallback(self.complete_header)
-            d.addErrback(self.handler_error)
-        except Exception as e:
-            print_frame(e)
+        if retry:
+            self.request(ts, False)
 
-    def complete_header(self, r: _Response) -> None:
+    def complete_header(self, r: _Response, ts: int) -> Deferred:
         if r is not None and r.code == 200:
             content: Deferred = r.content()
-            content.addCallback(self.complete_body)
-            content.addErrback(self.response_error)
-
-    def complete_body(self, content: bytes) -> None:
+            content.addCallback(self.complete_body, ts)
+            return content
+        if r is not None:
+            print("nginx status %s: HTTP %d" % (self.status_url, r.code))
+            # read the body anyway so the connection goes back to the pool
+            return r.content()
+
+    def complete_body(self, content: bytes, ts: int) -> None:
         try:
-            ts = self.ts
             text = content.decode()
+            if self.vts:
+                self.parse_vts(json.loads(text), ts)
+                return
+
             m = re.match(self.regexp, text)
             if m:
                 self.print_ngx("actives", int(m.group("actives")), ts)
@@ -85,21 +109,65 @@ class NginxCollector(Collector):
         except Exception as e:
             print_frame(e)
 
+    def parse_vts(self, status: Dict[str, Any], ts: int) -> None:
+        """nginx-module-vts /format/json: connections, server zones and upstreams."""
+        connections = status.get("connections", {})
+        for key, metric in VTS_CONNECTIONS:
+            if key in connections:
+                self.print_ngx(metric, int(connections[key]), ts)
+
+        for zone, stats in status.get("serverZones", {}).items():
+            self.print_zone("ngx.vts.server", stats, ts, zone=zone)
+
+        for upstream, servers in status.get("upstreamZones", {}).items():
+            for stats in servers:
+                self.print_zone("ngx.vts.upstream", stats, ts, upstream=upstream, server=stats.get("server"))
+
+                data = AttrDict()
+                data.metric = "ngx.vts.upstream.response_msec"
+                data.ts = ts
+                data.value = int(stats.get("responseMsec", 0))
+                data.upstream = upstream
+                data.server = stats.get("server")
+                self.send_message(data)
+
+    def print_zone(self, prefix: str, stats: Dict[str, Any], ts: int, **tags: str) -> None:
+        """Cumulative counters of a vts zone, left to send_counter()."""
+        values = [
+            ("requests", {}, stats.get("requestCounter")),
+            ("bytes", {"direction": "in"}, stats.get("inBytes")),
+            ("bytes", {"direction": "out"}, stats.get("outBytes")),
+        ]
+        for code, value in stats.get("responses", {}).items():
+            if code.endswith("xx"):
+                values.append(("responses", {"code": code}, value))
+
+        for metric, extra, value in values:
+            if value is None:
+                continue
+            data = AttrDict()
+            data.metric = "%s.%s" % (prefix, metric)
+            data.ts = ts
+            data.value = int(value)
+            data.update(tags)
+            data.update(extra)
+            self.send_counter(data)
+
     def print_ngx(self, metric: str, value: int, ts: int) -> None:
         if metric in self.last:
             item = self.last[metric]
             if item is not None:
                 timestamp = item[0]
                 _value = item[1]
-                if self.ts > timestamp and value > _value:
-                    self.last[metric] = (self.ts, value)
-                    value = (value - _value) // (self.ts - timestamp) + 1
+                if ts > timestamp and value > _value:
+                    self.last[metric] = (ts, value)
+                    value = (value - _value) // (ts - timestamp) + 1
 
                 else:
                     return None
 
             else:
-                self.last[metric] = (self.ts, value)
+                self.last[metric] = (ts, value)
                 return None
 
         data = AttrDict()
@@ -107,3 +175,48 @@ class NginxCollector(Collector):
         data.ts = ts
         data.value = value
         self.send_message(data)
+
+
+class TestParseVts(unittest.TestCase):
+    VTS = {
+        "connections": {"active": 3, "reading": 0, "writing": 1, "waiting": 2,
+                        "accepted": 100, "handled": 100, "requests": 250},
+        "serverZones": {
+            "example.com": {"requestCounter": 200, "inBytes": 1000, "outBytes": 5000,
+                            "responses": {"1xx": 0, "2xx": 190, "3xx": 5, "4xx": 4, "5xx": 1,
+                                          "miss": 7}},
+        },
+        "upstreamZones": {
+            "backend": [{"server": "10.0.0.2:80", "requestCounter": 50, "inBytes": 10,
+                         "outBytes": 20, "responses": {"2xx": 50}, "responseMsec": 12}],
+        },
+    }
+
+    def setUp(self):
+        self.collector = NginxCollector.__new__(NginxCollector)
+        self.collector.last = {'accepts': None, 'handled': None, 'requests': None}
+        self.sent = list()
+        self.counters = list()
+        self.collector.send_message = self.sent.append
+        self.collector.send_counter = self.counters.append
+
+    def test_parse(self):
+        self.collector.parse_vts(self.VTS, 1500000000)
+
+        # the counters of stub_status start with their second sample
+        self.assertEqual(
+            sorted((data.metric, data.value) for data in self.sent),
+            [("ngx.status.actives", 3), ("ngx.status.reading", 0),
+             ("ngx.status.waiting", 2), ("ngx.status.writing", 1),
+             ("ngx.vts.upstream.response_msec", 12)]
+        )
+        counters = {
+            (data.metric, data.get("direction"), data.get("code")): data for data in self.counters
+        }
+        self.assertEqual(counters[("ngx.vts.server.requests", None, None)].value, 200)
+        self.assertEqual(counters[("ngx.vts.server.bytes", "out", None)].value, 5000)
+        self.assertEqual(counters[("ngx.vts.server.responses", None, "5xx")].value, 1)
+        self.assertEqual(counters[("ngx.vts.server.requests", None, None)].zone, "example.com")
+        self.assertEqual(counters[("ngx.vts.upstream.requests", None, None)].server, "10.0.0.2:80")
+        self.assertNotIn(("ngx.vts.server.responses", None, "miss"), counters)
+        self.assertEqual(len(self.counters), 3 + 5 + 3 + 1)
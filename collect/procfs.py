@@ -0,0 +1,193 @@
+# coding=utf-8
+
+"""
+One read of every /proc and /sys source per collect interval.
+
+Collectors add() the files they use when they are created and attach()
+themselves. Each interval the snapshot reads every file once with
+os.preadv into a buffer kept per file, then calls swap() of the attached
+collectors with the same timestamp, so they all see one consistent view.
+Parsed views are built on first use and cached until the next refresh.
+"""
+
+import os
+import time
+import unittest
+from typing import Callable, Dict, List
+
+from tornado.options import options
+
+from util import loop_timer, round_looper
+from util.exception import print_frame
+
+
+class ProcFile:
+    def __init__(self, path: str, size: int=4096) -> None:
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.buffer = bytearray(size)
+
+    def read(self) -> str:
+        """
+        The whole file. seq_file hands out about a page per read, so reads
+        go on at increasing offsets until one returns nothing; the buffer
+        doubles when it is full and is kept for the next interval.
+        """
+        view = memoryview(self.buffer)
+        size = 0
+        while True:
+            if size == len(self.buffer):
+                view.release()
+                self.buffer.extend(bytes(len(self.buffer)))
+                view = memoryview(self.buffer)
+            count = os.preadv(self.fd, [view[size:]], size)
+            if not count:
+                break
+            size += count
+        view.release()
+        return self.buffer[:size].decode("utf-8", "replace")
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class ProcSnapshot:
+    def __init__(self) -> None:
+        self.files: Dict[str, ProcFile] = dict()
+        self.texts: Dict[str, str] = dict()
+        self.views: Dict[tuple, object] = dict()
+        self.collectors: List = list()
+        self.ts = 0
+        self.running = False
+
+    def add(self, path: str) -> bool:
+        """Opens path once, False when it does not exist here."""
+        if path in self.files:
+            return True
+        try:
+            self.files[path] = ProcFile(path)
+        except OSError:
+            return False
+        return True
+
+    def attach(self, collector) -> None:
+        self.collectors.append(collector)
+
+    def refresh(self, ts: int) -> None:
+        self.ts = ts
+        self.views = dict()
+        texts: Dict[str, str] = dict()
+        for path, proc in self.files.items():
+            try:
+                texts[path] = proc.read()
+            except OSError as e:
+                # e.g. a cpu went offline, the others are still read
+                print_frame(e)
+        self.texts = texts
+
+    def text(self, path: str) -> str:
+        return self.texts.get(path, "")
+
+    def view(self, path: str, parser: Callable[[str], object]) -> object:
+        key = (path, parser)
+        result = self.views.get(key)
+        if result is None:
+            result = self.views[key] = parser(self.text(path))
+        return result
+
+    def lines(self, path: str) -> List[str]:
+        return self.view(path, str.splitlines)
+
+    def fields(self, path: str) -> List[List[str]]:
+        """Every line split on whitespace, e.g. /proc/diskstats."""
+        return self.view(path, split_fields)
+
+    def pairs(self, path: str) -> Dict[str, int]:
+        """"name value" files like /proc/vmstat, or "Name: value kB" of /proc/meminfo in bytes."""
+        return self.view(path, parse_pairs)
+
+    def net_dev(self) -> Dict[str, List[int]]:
+        """/proc/net/dev as interface -> its 16 counters."""
+        return self.view("/proc/net/dev", parse_net_dev)
+
+    def value(self, path: str) -> int:
+        """Files holding a single integer, e.g. under /sys."""
+        text = self.text(path)
+        return int(text) if text else None
+
+    def swap(self, ts: int) -> None:
+        self.refresh(ts)
+        for collector in self.collectors:
+            try:
+                collector.swap(ts)
+            except Exception as e:
+                print_frame(e)
+
+    def run(self) -> None:
+        if self.running or not self.collectors:
+            return
+        self.running = True
+        # halfway into the interval, clear of Collector.send at the boundary
+        loop_timer(round_looper(options.collect_interval, 50 * options.collect_interval, self.swap))
+
+
+def split_fields(text: str) -> List[List[str]]:
+    return [line.split() for line in text.splitlines()]
+
+
+def parse_pairs(text: str) -> Dict[str, int]:
+    result: Dict[str, int] = dict()
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) < 2 or not fields[1].isdigit():
+            continue
+        value = int(fields[1])
+        if len(fields) > 2 and fields[2].lower() == "kb":
+            value *= 1024
+        result[fields[0].rstrip(":")] = value
+    return result
+
+
+def parse_net_dev(text: str) -> Dict[str, List[int]]:
+    result: Dict[str, List[int]] = dict()
+    # two header lines
+    for line in text.splitlines()[2:]:
+        name, _, stats = line.partition(":")
+        if stats:
+            result[name.strip()] = [int(value) for value in stats.split()[:16]]
+    return result
+
+
+snapshot: ProcSnapshot = ProcSnapshot()
+
+
+class TestProcFile(unittest.TestCase):
+    def test_large(self):
+        # a seq_file of several pages, the maps of an idle process
+        import subprocess
+        child = subprocess.Popen(["python3", "-c", "import time; time.sleep(30)"])
+        try:
+            time.sleep(0.5)
+            path = "/proc/%d/maps" % child.pid
+            with open(path) as fp:
+                expected = fp.read()
+            self.assertGreater(len(expected), 4096)
+
+            proc = ProcFile(path, size=1024)
+            try:
+                self.assertEqual(proc.read(), expected)
+                # and again into the grown buffer
+                self.assertEqual(proc.read(), expected)
+            finally:
+                proc.close()
+        finally:
+            child.kill()
+            child.wait()
+
+    def test_snapshot_missing(self):
+        snapshot = ProcSnapshot()
+        self.assertFalse(snapshot.add("/proc/does/not/exist"))
+        self.assertTrue(snapshot.add("/proc/self/maps"))
+        snapshot.refresh(10)
+        self.assertGreater(len(snapshot.lines("/proc/self/maps")), 10)
+        self.assertEqual(snapshot.text("/proc/does/not/exist"), "")
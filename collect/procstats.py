@@ -4,33 +4,32 @@ import glob
 import os
 import re
 import sys
-import time
 from typing import Dict, List
 
 from orderedattrdict import AttrDict
 
 from .collector import Collector
 
+MEMINFO = re.compile("(\w+):\s+(\d+)\s+(\w+)")
+
 
 class ProcstatsCollector(Collector):
+    procfs = True
+
     def __init__(self) -> None:
         super().__init__()
 
         self.NUMADIR = "/sys/devices/system/node"
 
-        self.f_uptime = open("/proc/uptime", "r", encoding='utf-8')
-        self.f_meminfo = open("/proc/meminfo", "r", encoding='utf-8')
-        self.f_vmstat = open("/proc/vmstat", "r", encoding='utf-8')
-        self.f_stat = open("/proc/stat", "r", encoding='utf-8')
-        self.f_loadavg = open("/proc/loadavg", "r", encoding='utf-8')
-        self.f_entropy_avail = open("/proc/sys/kernel/random/entropy_avail", "r", encoding='utf-8')
-        self.f_interrupts = open("/proc/interrupts", "r", encoding='utf-8')
+        for path in ("/proc/uptime", "/proc/meminfo", "/proc/vmstat", "/proc/stat",
+                     "/proc/loadavg", "/proc/sys/kernel/random/entropy_avail",
+                     "/proc/interrupts", "/proc/softirqs"):
+            self.proc.add(path)
 
         self.f_scaling = "/sys/devices/system/cpu/cpu%s/cpufreq/%s_freq"
         self.f_scaling_min: Dict = dict([])
         self.f_scaling_max: Dict = dict([])
         self.f_scaling_cur: Dict = dict([])
-        self.f_softirqs = open("/proc/softirqs", "r", encoding='utf-8')
 
         for cpu in glob.glob("/sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_cur_freq"):
             m = re.match("/sys/devices/system/cpu/cpu([0-9]*)/cpufreq/scaling_cur_freq", cpu)
@@ -38,11 +37,15 @@ class ProcstatsCollector(Collector):
                 continue
             cpu_no = m.group(1)
             sys.stderr.write(self.f_scaling % (cpu_no, "min"))
-            self.f_scaling_min[cpu_no] = open(self.f_scaling % (cpu_no, "cpuinfo_min"), "r", encoding='utf-8')
-            self.f_scaling_max[cpu_no] = open(self.f_scaling % (cpu_no, "cpuinfo_max"), "r", encoding='utf-8')
-            self.f_scaling_cur[cpu_no] = open(self.f_scaling % (cpu_no, "scaling_cur"), "r", encoding='utf-8')
+            self.f_scaling_min[cpu_no] = self.f_scaling % (cpu_no, "cpuinfo_min")
+            self.f_scaling_max[cpu_no] = self.f_scaling % (cpu_no, "cpuinfo_max")
+            self.f_scaling_cur[cpu_no] = self.f_scaling % (cpu_no, "scaling_cur")
+            for path in (self.f_scaling_min[cpu_no], self.f_scaling_max[cpu_no], self.f_scaling_cur[cpu_no]):
+                self.proc.add(path)
 
         self.numastats = self.find_sysfs_numa_stats()
+        for path in self.numastats:
+            self.proc.add(path)
 
     def name(self) -> str:
         return "ProcstatsCollector"
@@ -67,13 +70,13 @@ class ProcstatsCollector(Collector):
                 raise
         return numastats
 
-    def print_numa_stats(self, numafiles: List) -> None:
-        """From a list of files names, opens file, extracts and prints NUMA stats."""
+    def print_numa_stats(self, numafiles: List, ts: int) -> None:
+        """From a list of files names, extracts and prints NUMA stats of the snapshot."""
         for numafilename in numafiles:
-            numafile = open(numafilename, 'r', encoding='utf-8')
-            node_id = int(numafile.name[numafile.name.find("/node/node")+10:-9])
-            ts = int(time.time())
-            stats = dict(line.split() for line in numafile.read().splitlines())
+            node_id = int(numafilename[numafilename.find("/node/node")+10:-9])
+            stats = self.proc.pairs(numafilename)
+            if not stats:
+                continue
             for stat, tag in (# hit: process wanted memory from this node and got it
                               ("numa_hit", "hit"),
                               # miss: process wanted another node and got it from
@@ -86,7 +89,7 @@ class ProcstatsCollector(Collector):
                 data.value = int(stats[stat])
                 data.node = node_id
                 data.type = tag
-                self.send_message(data)
+                self.send_counter(data)
 
             # Count this one as a separate metric because we can't sum up hit +
             # miss + foreign, this would result in double-counting of all misses.
@@ -99,7 +102,7 @@ class ProcstatsCollector(Collector):
             data.ts = ts
             data.value = int(stats["numa_foreign"])
             data.node = node_id
-            self.send_message(data)
+            self.send_counter(data)
 
             # When is memory allocated to a node that's local or remote to where
             # the process is running.
@@ -111,7 +114,7 @@ class ProcstatsCollector(Collector):
                 data.value = int(stats[stat])
                 data.node = node_id
                 data.type = tag
-                self.send_message(data)
+                self.send_counter(data)
 
             # Pages successfully allocated with the interleave policy.
             data = AttrDict()
@@ -119,15 +122,11 @@ class ProcstatsCollector(Collector):
             data.ts = ts
             data.value = int(stats["interleave_hit"])
             data.node = node_id
-            self.send_message(data)
-
-            numafile.close()
+            self.send_counter(data)
 
     def collect(self, ts: int) -> None:
         # proc.uptime
-        self.f_uptime.seek(0)
-        ts = int(time.time())
-        for line in self.f_uptime:
+        for line in self.proc.lines("/proc/uptime"):
             m = re.match("(\S+)\s+(\S+)", line)
             if m:
                 data = AttrDict()
@@ -143,10 +142,8 @@ class ProcstatsCollector(Collector):
                 self.send_message(data)
 
         # proc.meminfo
-        self.f_meminfo.seek(0)
-        ts = int(time.time())
-        for line in self.f_meminfo:
-            m = re.match("(\w+):\s+(\d+)\s+(\w+)", line)
+        for line in self.proc.lines("/proc/meminfo"):
+            m = MEMINFO.match(line)
             if m:
                 if m.group(3).lower() == 'kb':
                     # convert from kB to B for easier graphing
@@ -161,24 +158,18 @@ class ProcstatsCollector(Collector):
                 self.send_message(data)
 
         # proc.vmstat
-        self.f_vmstat.seek(0)
-        ts = int(time.time())
-        for line in self.f_vmstat:
-            m = re.match("(\w+)\s+(\d+)", line)
-            if not m:
-                continue
-            if m.group(1) in ("pgpgin", "pgpgout", "pswpin",
-                              "pswpout", "pgfault", "pgmajfault"):
-
+        vmstat = self.proc.pairs("/proc/vmstat")
+        for name in ("pgpgin", "pgpgout", "pswpin",
+                     "pswpout", "pgfault", "pgmajfault"):
+            if name in vmstat:
                 data = AttrDict()
-                data.metric = "proc.vmstat.%s" % m.group(1)
+                data.metric = "proc.vmstat.%s" % name
                 data.ts = ts
-                data.value = int(m.group(2))
-                self.send_message(data)
+                data.value = vmstat[name]
+                self.send_counter(data)
 
         # proc.stat
-        self.f_stat.seek(0)
-        for line in self.f_stat:
+        for line in self.proc.lines("/proc/stat"):
             m = re.match("(\w+)\s+(.*)", line)
             if not m:
                 continue
@@ -209,28 +200,28 @@ class ProcstatsCollector(Collector):
                             if tag:
                                 t = tag.split("=", 1)
                                 data[t[0]] = t[1]
-                    self.send_message(data)
+                    self.send_counter(data)
 
             elif m.group(1) == "intr":
                 data = AttrDict()
                 data.metric = "proc.stat.intr"
                 data.ts = ts
                 data.value = int(m.group(2).split()[0])
-                self.send_message(data)
+                self.send_counter(data)
 
             elif m.group(1) == "ctxt":
                 data = AttrDict()
                 data.metric = "proc.stat.ctxt"
                 data.ts = ts
                 data.value = int(m.group(2))
-                self.send_message(data)
+                self.send_counter(data)
 
             elif m.group(1) == "processes":
                 data = AttrDict()
                 data.metric = "proc.stat.processes"
                 data.ts = ts
                 data.value = int(m.group(2))
-                self.send_message(data)
+                self.send_counter(data)
 
             elif m.group(1) == "procs_blocked":
                 data = AttrDict()
@@ -239,9 +230,7 @@ class ProcstatsCollector(Collector):
                 data.value = int(m.group(2))
                 self.send_message(data)
 
-        self.f_loadavg.seek(0)
-
-        for line in self.f_loadavg:
+        for line in self.proc.lines("/proc/loadavg"):
             m = re.match("(\S+)\s+(\S+)\s+(\S+)\s+(\d+)/(\d+)\s+", line)
             if not m:
                 continue
@@ -276,20 +265,18 @@ class ProcstatsCollector(Collector):
             data.value = int(m.group(5))
             self.send_message(data)
 
-        self.f_entropy_avail.seek(0)
-
-        for line in self.f_entropy_avail:
+        for line in self.proc.lines("/proc/sys/kernel/random/entropy_avail"):
             data = AttrDict()
             data.metric = "proc.kernel.entropy_avail"
             data.ts = ts
             data.value = int(line.strip())
             self.send_message(data)
 
-        self.f_interrupts.seek(0)
+        lines = self.proc.lines("/proc/interrupts")
 
         # Get number of CPUs from description line.
-        num_cpus = len(self.f_interrupts.readline().split())
-        for line in self.f_interrupts:
+        num_cpus = len(lines[0].split()) if lines else 0
+        for line in lines[1:]:
             cols = line.split()
 
             irq_type = cols[0].rstrip(":")
@@ -315,13 +302,13 @@ class ProcstatsCollector(Collector):
                     data.value = int(val)
                     data.type = irq_type
                     data.cpu = i
-                    self.send_message(data)
+                    self.send_counter(data)
 
-        self.f_softirqs.seek(0)
+        lines = self.proc.lines("/proc/softirqs")
 
         # Get number of CPUs from description line.
-        num_cpus = len(self.f_softirqs.readline().split())
-        for line in self.f_softirqs:
+        num_cpus = len(lines[0].split()) if lines else 0
+        for line in lines[1:]:
             cols = line.split()
 
             irq_type = cols[0].rstrip(":")
@@ -341,41 +328,38 @@ class ProcstatsCollector(Collector):
                 data.value = int(val)
                 data.type = irq_type
                 data.cpu = i
-                self.send_message(data)
+                self.send_counter(data)
 
-        self.print_numa_stats(self.numastats)
+        self.print_numa_stats(self.numastats, ts)
 
         # Print scaling stats
 
-        for cpu_no in self.f_scaling_min.keys():
-            f = self.f_scaling_min[cpu_no]
-            f.seek(0)
-            for line in f:
+        for cpu_no, path in self.f_scaling_min.items():
+            value = self.proc.value(path)
+            if value is not None:
                 data = AttrDict()
                 data.metric = "proc.scaling.min"
                 data.ts = ts
-                data.value = int(line.rstrip('\n'))
+                data.value = value
                 data.cpu = cpu_no
                 self.send_message(data)
 
-        for cpu_no in self.f_scaling_max.keys():
-            f = self.f_scaling_max[cpu_no]
-            f.seek(0)
-            for line in f:
+        for cpu_no, path in self.f_scaling_max.items():
+            value = self.proc.value(path)
+            if value is not None:
                 data = AttrDict()
                 data.metric = "proc.scaling.max"
                 data.ts = ts
-                data.value = int(line.rstrip('\n'))
+                data.value = value
                 data.cpu = cpu_no
                 self.send_message(data)
 
-        for cpu_no in self.f_scaling_cur.keys():
-            f = self.f_scaling_cur[cpu_no]
-            f.seek(0)
-            for line in f:
+        for cpu_no, path in self.f_scaling_cur.items():
+            value = self.proc.value(path)
+            if value is not None:
                 data = AttrDict()
                 data.metric = "proc.scaling.cur"
                 data.ts = ts
-                data.value = int(line.rstrip('\n'))
+                data.value = value
                 data.cpu = cpu_no
                 self.send_message(data)
@@ -57,7 +57,18 @@ def load_options() -> None:
     define("dns_port", default=35353, help="use localhost dns port.", type=int)
     define("walker_interval", default=30, help="walker timer interval", type=int)
     define("collect_interval", default=10, help="collect timer interval", type=int)
+    define("collect_counters", default="", help="send counters as delta or rate (per second), empty to send raw values.", type=str)
+    define("collect_heartbeat", default=60, help="seconds an unchanged counter is held back, 0 sends every collect.", type=int)
+    define("apm_compress", default="", help="compress apm publishes: zlib or lz4, empty to send plain.", type=str)
+    define("apm_preaggregate", default=False, help="merge apm points per 10s bucket and send them as binary batches.", type=bool)
     define("enable_collector", default="ats:if:ngx:log", help="enable collectors.", type=str)
+    define("ats_records", default="", help="comma separated traffic server records to collect, empty for the defaults.", type=str)
+    define("nginx_status_url", default="http://127.0.0.1/NginxStatus/", help="nginx stub_status url.", type=str)
+    define("nginx_vts_url", default="", help="nginx vts json status url, used instead of stub_status when set.", type=str)
+    define("access_log", default="/usr/local/example/access.log", help="nginx access log to tail.", type=str)
+    define("access_log_domains", default="", help="file listing supported domains, reloaded on change.", type=str)
+    define("access_log_workers", default=0, help="access log parser processes, 0 parses in the collector.", type=int)
+    define("access_log_offset", default="/usr/local/cdntoolkit/ctk/access.log.offset", help="access log offset file, empty to disable.", type=str)
 
     define("git_server", default="train.example.com", help="git server address", type=str)
     define("git_user", default="OSS-config_manager", help="for git server", type=str)
@@ -69,14 +80,33 @@ def load_options() -> None:
     define("apm_multiple", default=2, help="apm multiple.", type=int)
     define("apm_client", default="tcp:host=127.0.0.1:port=580{port:02d}", help="apm server address.", type=str)
     define("apm_server", default="tcp:port=580{port:02d}", help="apm listen address.", type=str)
+    define("ws_compression", default="", help="apm websocket compression to negotiate, e.g. lz4,zlib; empty to disable.", type=str)
+    define("apm_workers", default=16, help="apm slave anomaly detection workers.", type=int)
+    define("apm_worker_mode", default="thread", help="apm slave worker mode, thread or process.", type=str)
+    define("apm_slaves", default="", help="file listing apm slave addresses and weights, reloaded on change.", type=str)
+    define("apm_slave_pending", default=64 << 20, help="max bytes held per apm slave while it is down or slow.", type=int)
+    define("apm_slave_vnodes", default=160, help="virtual nodes per apm slave weight.", type=int)
+    define("apm_stats_port", default=0, help="apm stats http port on localhost, 0 to disable.", type=int)
+    define("apm_worker_queue", default=10000, help="apm slave batches queued per worker.", type=int)
 
     define("influx_addrs", default="127.0.0.1", help="influxdb address.", type=str)
     # define("influx_addrs", default="124.95.176.16:124.95.176.17:124.95.176.18:124.95.176.19", help="influxdb address.", type=str)
     define("influx_ports", default="5252:6262:7272:8282", help="influxdb port.", type=str)
     # define("influx_ports", default="7272:8282", help="influxdb port.", type=str)
+    define("influx_pool", default=2, help="connections per influxdb shard.", type=int)
+    define("influx_flush_size", default=65536, help="influxdb flush size in bytes.", type=int)
+    define("influx_flush_interval", default=1.0, help="influxdb flush interval in seconds.", type=float)
+    define("influx_spill_dir", default="/usr/local/cdntoolkit/ctk/apm/spill", help="spill dir while an influxdb shard is down, empty to drop.", type=str)
+    define("influx_spill_max", default=256 << 20, help="max spill file size per influxdb shard.", type=int)
+    define("influx_buffer_max", default=16 << 20, help="bytes held per influxdb shard while its connections are paused, then spilled.", type=int)
 
     define("elasticsearch_online", default="127.0.0.1:9000", help="online elasticsearch address.", type=str)
     define("elasticsearch_offline", default="127.0.0.1:9201", help="offline elasticsearch address.", type=str)
+    define("apm_alert_batch", default=500, help="apm alerts per elasticsearch bulk.", type=int)
+    define("apm_alert_interval", default=1.0, help="apm alert flush interval in seconds.", type=float)
+    define("apm_alert_suppress", default=60, help="seconds between alerts of one metric and idc.", type=int)
+    define("apm_alert_spill_dir", default="/usr/local/cdntoolkit/ctk/apm/spill", help="spill dir while elasticsearch is down, empty to drop.", type=str)
+    define("apm_alert_spill_max", default=64 << 20, help="max alert spill file size per process.", type=int)
 
     define("param", default="", help="param for private app", type=str)
     define("config", default=AttrDict(), help="internal config for app", type=AttrDict)
@@ -0,0 +1,309 @@
+# coding=utf-8
+
+"""
+Columnar binary encoding for a batch of collector samples.
+
+A sample is an AttrDict with metric, ts, value and any number of tags.
+Instead of one JSON object per sample, a batch stores every distinct
+string once, every distinct tag set once, and the samples as packed
+columns of (metric, tag set, ts, value):
+
+    header   magic, version, host, #strings, #tag sets, #samples
+    strings  u16 length + utf-8 bytes each
+    tag sets u8 count, then (u32 key, scalar value) per tag
+    samples  u32 metric[], u32 tag set[], i64 ts[], u8 kind[],
+             i64 ints[], f64 floats[]
+
+A scalar is a kind byte followed by its payload; kind is one of
+KIND_INT, KIND_FLOAT, KIND_STR (u32 string index) or KIND_NONE. Sample
+values use the same kinds but are split into the ints (ints and string
+indexes) and floats columns in sample order.
+
+A sample that does not fit the format (a string over 65535 bytes, more
+than 255 tags, a ts or int outside i64) is skipped and counted in
+BatchEncoder.dropped; the rest of the batch is still encoded.
+"""
+
+import struct
+import unittest
+from array import array
+from typing import Dict, List, Tuple, Any
+
+from orderedattrdict import AttrDict
+
+BATCH_PROTOCOL: str = "ctk.batch.v1"
+
+MAGIC: bytes = b"CTKB"
+VERSION: int = 1
+
+KIND_INT: int = 0
+KIND_FLOAT: int = 1
+KIND_STR: int = 2
+KIND_NONE: int = 3
+
+_HEADER = struct.Struct("<4sBIIII")
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_I64 = struct.Struct("<q")
+_F64 = struct.Struct("<d")
+
+_RESERVED = ("metric", "ts", "value", "host")
+
+_I64_MIN: int = -(1 << 63)
+_I64_MAX: int = (1 << 63) - 1
+_STR_MAX: int = 0xffff
+_TAGS_MAX: int = 0xff
+
+
+class BatchEncoder:
+    def __init__(self, host: str) -> None:
+        self.strings: Dict[str, int] = dict()
+        self.tag_sets: Dict[Tuple, int] = dict()
+        self.host: int = self.string(host)
+        self.metrics: array = array("I")
+        self.tags: array = array("I")
+        self.ts: array = array("q")
+        self.kinds: bytearray = bytearray()
+        self.ints: array = array("q")
+        self.floats: array = array("d")
+        self.dropped: int = 0
+
+    def __len__(self) -> int:
+        return len(self.metrics)
+
+    def string(self, value: str) -> int:
+        index = self.strings.get(value)
+        if index is None:
+            index = len(self.strings)
+            self.strings[value] = index
+        return index
+
+    @staticmethod
+    def check_scalar(value: Any) -> None:
+        if isinstance(value, bool) or isinstance(value, int):
+            if not _I64_MIN <= value <= _I64_MAX:
+                raise ValueError("int out of i64 range")
+        elif value is not None and not isinstance(value, float):
+            if len(str(value).encode("utf-8")) > _STR_MAX:
+                raise ValueError("string over %d bytes" % _STR_MAX)
+
+    def check(self, data: AttrDict, tags: Tuple) -> int:
+        """Raises ValueError for a sample the format cannot hold, returns its ts."""
+        ts = int(data.ts)
+        if not _I64_MIN <= ts <= _I64_MAX:
+            raise ValueError("ts out of i64 range")
+        if len(tags) > _TAGS_MAX:
+            raise ValueError("more than %d tags" % _TAGS_MAX)
+        # tag sets are dict keys
+        hash(tags)
+        self.check_scalar(str(data.metric))
+        for key, value in tags:
+            self.check_scalar(str(key))
+            self.check_scalar(value)
+        self.check_scalar(data.value)
+        return ts
+
+    def add(self, data: AttrDict) -> bool:
+        """Adds a sample, False when it was dropped; nothing is kept of it then."""
+        tags = tuple((k, v) for k, v in data.items() if k not in _RESERVED)
+        try:
+            ts = self.check(data, tags)
+        except (AttributeError, TypeError, ValueError):
+            self.dropped += 1
+            return False
+
+        tag_set = self.tag_sets.get(tags)
+        if tag_set is None:
+            tag_set = len(self.tag_sets)
+            self.tag_sets[tags] = tag_set
+
+        value = data.value
+        if isinstance(value, bool) or isinstance(value, int):
+            self.kinds.append(KIND_INT)
+            self.ints.append(int(value))
+        elif isinstance(value, float):
+            self.kinds.append(KIND_FLOAT)
+            self.floats.append(value)
+        elif value is None:
+            self.kinds.append(KIND_NONE)
+        else:
+            self.kinds.append(KIND_STR)
+            self.ints.append(self.string(str(value)))
+
+        self.metrics.append(self.string(str(data.metric)))
+        self.tags.append(tag_set)
+        self.ts.append(ts)
+        return True
+
+    def scalar(self, value: Any) -> bytes:
+        if isinstance(value, bool) or isinstance(value, int):
+            return _U8.pack(KIND_INT) + _I64.pack(int(value))
+        elif isinstance(value, float):
+            return _U8.pack(KIND_FLOAT) + _F64.pack(value)
+        elif value is None:
+            return _U8.pack(KIND_NONE)
+        return _U8.pack(KIND_STR) + _U32.pack(self.string(str(value)))
+
+    def encode(self) -> bytes:
+        # tag sets may add strings, so they are serialized first
+        tag_sets: List[bytes] = list()
+        for tags in self.tag_sets:
+            tag_sets.append(_U8.pack(len(tags)))
+            for key, value in tags:
+                tag_sets.append(_U32.pack(self.string(key)))
+                tag_sets.append(self.scalar(value))
+
+        parts: List[bytes] = [_HEADER.pack(
+            MAGIC, VERSION, self.host,
+            len(self.strings), len(self.tag_sets), len(self.metrics)
+        )]
+
+        for value in self.strings:
+            raw = value.encode("utf-8")
+            parts.append(_U16.pack(len(raw)))
+            parts.append(raw)
+
+        parts.extend(tag_sets)
+        parts.append(_U32.pack(len(self.ints)))
+        parts.append(_U32.pack(len(self.floats)))
+        for column in (self.metrics, self.tags, self.ts):
+            parts.append(column.tobytes())
+        parts.append(bytes(self.kinds))
+        parts.append(self.ints.tobytes())
+        parts.append(self.floats.tobytes())
+        return b"".join(parts)
+
+
+def encode_batch(host: str, items: List[AttrDict]) -> bytes:
+    """Bad samples are skipped, use BatchEncoder to count them."""
+    encoder = BatchEncoder(host)
+    for item in items:
+        encoder.add(item)
+    return encoder.encode()
+
+
+def _column(typecode: str, data: bytes, offset: int, count: int) -> Tuple[array, int]:
+    column = array(typecode)
+    end = offset + count * column.itemsize
+    column.frombytes(data[offset:end])
+    return column, end
+
+
+def decode_batch(data: bytes) -> List[AttrDict]:
+    magic, version, host, n_strings, n_tag_sets, n_points = \
+        _HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("bad batch header %r %r" % (magic, version))
+
+    offset = _HEADER.size
+    strings: List[str] = list()
+    for _ in range(n_strings):
+        length, = _U16.unpack_from(data, offset)
+        offset += _U16.size
+        strings.append(data[offset:offset + length].decode("utf-8"))
+        offset += length
+
+    def scalar(_offset: int) -> Tuple[Any, int]:
+        kind, = _U8.unpack_from(data, _offset)
+        _offset += _U8.size
+        if kind == KIND_INT:
+            return _I64.unpack_from(data, _offset)[0], _offset + _I64.size
+        elif kind == KIND_FLOAT:
+            return _F64.unpack_from(data, _offset)[0], _offset + _F64.size
+        elif kind == KIND_STR:
+            return strings[_U32.unpack_from(data, _offset)[0]], _offset + _U32.size
+        return None, _offset
+
+    tag_sets: List[List[Tuple[str, Any]]] = list()
+    for _ in range(n_tag_sets):
+        count, = _U8.unpack_from(data, offset)
+        offset += _U8.size
+        tags = list()
+        for _ in range(count):
+            key, = _U32.unpack_from(data, offset)
+            value, offset = scalar(offset + _U32.size)
+            tags.append((strings[key], value))
+        tag_sets.append(tags)
+
+    n_ints, = _U32.unpack_from(data, offset)
+    n_floats, = _U32.unpack_from(data, offset + _U32.size)
+    offset += 2 * _U32.size
+
+    metrics, offset = _column("I", data, offset, n_points)
+    tags_index, offset = _column("I", data, offset, n_points)
+    ts, offset = _column("q", data, offset, n_points)
+    kinds = data[offset:offset + n_points]
+    offset += n_points
+    ints, offset = _column("q", data, offset, n_ints)
+    floats, offset = _column("d", data, offset, n_floats)
+
+    host_name = strings[host]
+    items: List[AttrDict] = list()
+    i_int = i_float = 0
+    for i in range(n_points):
+        kind = kinds[i]
+        if kind == KIND_INT:
+            value = ints[i_int]
+            i_int += 1
+        elif kind == KIND_FLOAT:
+            value = floats[i_float]
+            i_float += 1
+        elif kind == KIND_STR:
+            value = strings[ints[i_int]]
+            i_int += 1
+        else:
+            value = None
+
+        item = AttrDict()
+        item.metric = strings[metrics[i]]
+        item.ts = ts[i]
+        item.value = value
+        for key, tag in tag_sets[tags_index[i]]:
+            item[key] = tag
+        item.host = host_name
+        items.append(item)
+
+    return items
+
+
+class TestBatch(unittest.TestCase):
+    def item(self, metric="m", ts=1500000000, value=1, **tags):
+        data = AttrDict()
+        data.metric = metric
+        data.ts = ts
+        data.value = value
+        data.update(tags)
+        return data
+
+    def test_round_trip(self):
+        items = [
+            self.item(value=1, dev="sda"),
+            self.item(value=1.5, dev="sdb"),
+            self.item(value="x", dev="sda"),
+            self.item(value=None),
+        ]
+        decoded = decode_batch(encode_batch("h", items))
+        for item, got in zip(items, decoded):
+            self.assertEqual(got.pop("host"), "h")
+            self.assertEqual(dict(got), dict(item))
+
+    def test_bad_items_dropped(self):
+        bad = [
+            self.item(value="x" * 70000),
+            self.item(metric="m" * 70000),
+            self.item(dev="d" * 70000),
+            self.item(ts="soon"),
+            self.item(ts=None),
+            self.item(value=1 << 64),
+            self.item(**{"t%d" % i: i for i in range(256)}),
+            self.item(dev=["unhashable"]),
+        ]
+        encoder = BatchEncoder("h")
+        for item in bad[:4] + [self.item(value=7)] + bad[4:]:
+            encoder.add(item)
+        self.assertEqual(encoder.dropped, len(bad))
+        decoded = decode_batch(encoder.encode())
+        self.assertEqual([(d.metric, d.value) for d in decoded], [("m", 7)])
+        # nothing of the dropped samples is left in the string table
+        self.assertEqual(sorted(encoder.strings), ["h", "m"])
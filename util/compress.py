@@ -0,0 +1,114 @@
+# coding=utf-8
+
+"""
+Framed compression for websocket and wamp payloads.
+
+A compressed payload is always binary:
+
+    magic b"CTKZ", u8 algorithm, u8 flags, compressed bytes
+
+FLAG_TEXT marks a payload that was utf-8 text before compression, so the
+receiver hands the same type on. Anything without the magic is passed
+through untouched, which lets receivers accept both forms while senders
+are switched over.
+
+Over WsClientMessage/WsServerMessage the algorithm is negotiated as a
+websocket subprotocol suffix, e.g. "ctk.batch.v1+zlib"; see
+offer_protocols() and accept_protocol().
+"""
+
+import struct
+import zlib
+from typing import List, Tuple, Union
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+MAGIC: bytes = b"CTKZ"
+
+ALGO_ZLIB: int = 1
+ALGO_LZ4: int = 2
+
+FLAG_TEXT: int = 1
+
+_HEADER = struct.Struct("<4sBB")
+
+_ALGORITHMS = {"zlib": ALGO_ZLIB, "lz4": ALGO_LZ4}
+
+
+def algorithms() -> List[str]:
+    """Algorithms usable here, preferred first."""
+    result = list()
+    if lz4_frame is not None:
+        result.append("lz4")
+    result.append("zlib")
+    return result
+
+
+def compress(data: Union[str, bytes], algorithm: str, level: int=6) -> bytes:
+    flags = 0
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+        flags |= FLAG_TEXT
+
+    algo = _ALGORITHMS[algorithm]
+    if algo == ALGO_LZ4:
+        if lz4_frame is None:
+            raise ValueError("lz4 is not installed")
+        body = lz4_frame.compress(data)
+    else:
+        body = zlib.compress(data, level)
+    return _HEADER.pack(MAGIC, algo, flags) + body
+
+
+def is_compressed(data: Union[str, bytes]) -> bool:
+    return isinstance(data, bytes) and data[:4] == MAGIC
+
+
+def decompress(data: Union[str, bytes]) -> Union[str, bytes]:
+    if not is_compressed(data):
+        return data
+
+    _, algo, flags = _HEADER.unpack_from(data, 0)
+    body = memoryview(data)[_HEADER.size:]
+    if algo == ALGO_LZ4:
+        if lz4_frame is None:
+            raise ValueError("lz4 payload but lz4 is not installed")
+        raw = lz4_frame.decompress(body)
+    elif algo == ALGO_ZLIB:
+        raw = zlib.decompress(body)
+    else:
+        raise ValueError("unknown compression %d" % algo)
+
+    if flags & FLAG_TEXT:
+        return raw.decode("utf-8")
+    return raw
+
+
+def offer_protocols(protocols: List[str], compression: List[str]) -> List[str]:
+    """Client side offer, compressed variants first."""
+    offer: List[str] = list()
+    for protocol in protocols:
+        for algorithm in compression:
+            offer.append("%s+%s" % (protocol, algorithm))
+        offer.append(protocol)
+    return offer
+
+
+def split_protocol(protocol: str) -> Tuple[str, str]:
+    """"ctk.batch.v1+zlib" -> ("ctk.batch.v1", "zlib")."""
+    if protocol and "+" in protocol:
+        base, algorithm = protocol.rsplit("+", 1)
+        return base, algorithm
+    return protocol, None
+
+
+def accept_protocol(offered: List[str], protocols: List[str], compression: List[str]) -> str:
+    """Server side, the first offered protocol we speak, with a codec we have."""
+    for protocol in offered:
+        base, algorithm = split_protocol(protocol)
+        if base in protocols and (algorithm is None or algorithm in compression):
+            return protocol
+    return None
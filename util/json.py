@@ -2,6 +2,9 @@
 
 import datetime
 import json
+import math
+import re
+import unittest
 from typing import no_type_check
 
 from bson.objectid import ObjectId
@@ -9,6 +12,21 @@ from orderedattrdict import AttrDict
 
 import util
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# strptime raises for almost every string it is tried on, so only strings
+# shaped like the two formats attr_json_decoder understands are tried.
+_datetime_re = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{1,6}\Z')
+_date_re = re.compile(r'\d{4}-\d{2}-\d{2}\Z')
+
 
 class AttrJSONEncoder(json.JSONEncoder):
     @no_type_check
@@ -30,20 +48,27 @@ def attr_json_decoder(d):
 
     result = []
     for k, v in pairs:
-        if isinstance(k, str) and k.find("_id") != -1:
-            try:
-                v = ObjectId(v)
-            except:
-                pass
+        if isinstance(k, str) and "_id" in k:
+            if v is None or isinstance(v, (str, bytes)):
+                try:
+                    v = ObjectId(v)
+                except:
+                    pass
         elif isinstance(v, str):
-            try:
-                v = datetime.datetime.strptime(v, u'%Y-%m-%dT%H:%M:%S.%f')
-            except ValueError:
+            if _datetime_re.match(v):
+                try:
+                    v = datetime.datetime.strptime(v, u'%Y-%m-%dT%H:%M:%S.%f')
+                except ValueError:
+                    pass
+            elif _date_re.match(v):
                 try:
                     v = datetime.datetime.strptime(v, u'%Y-%m-%d').date()
                 except ValueError:
                     pass
-        elif isinstance(v, (dict, list)):
+        elif isinstance(v, list):
+            v = attr_json_decoder(v)
+        elif isinstance(v, dict) and not isinstance(v, AttrDict):
+            # object_hook already converted nested objects
             v = attr_json_decoder(v)
         result.append((k, v))
     if isinstance(d, list):
@@ -52,6 +77,14 @@ def attr_json_decoder(d):
         return AttrDict(result)
 
 
+def attr_json_default(obj):
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    elif isinstance(obj, (ObjectId, util.FrozenClass)):
+        return str(obj)
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
 _default_encoder: json.JSONEncoder = AttrJSONEncoder(
     skipkeys=False,
     ensure_ascii=True,
@@ -67,6 +100,31 @@ _default_decoder: json.JSONDecoder = json.JSONDecoder(
     object_pairs_hook=None
 )
 
+_plain_encoder: json.JSONEncoder = AttrJSONEncoder(
+    skipkeys=False,
+    ensure_ascii=True,
+    check_circular=False,
+    allow_nan=True,
+    indent=None,
+    separators=(',', ':'),
+    default=None,
+)
+
+_plain_decoder: json.JSONDecoder = json.JSONDecoder(
+    object_pairs_hook=AttrDict
+)
+
+
+def _non_finite(obj) -> bool:
+    """Whether a NaN or an infinity is anywhere in obj."""
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    elif isinstance(obj, dict):
+        return any(_non_finite(v) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return any(_non_finite(v) for v in obj)
+    return False
+
 
 class AttrJson:
     @staticmethod
@@ -76,3 +134,43 @@ class AttrJson:
     @staticmethod
     def loads(s: str) -> AttrDict:
         return _default_decoder.decode(s)
+
+    @staticmethod
+    def dumps_plain(obj: AttrDict) -> str:
+        """
+        Compact dumps for hot paths, through orjson or ujson when one is
+        installed. Output is equivalent JSON but not byte for byte the same
+        as dumps(): no spaces, and orjson does not escape non-ASCII.
+        NaN and infinities come out as NaN/Infinity, as from dumps(), on
+        every backend; orjson writes null for them, so such objects go
+        through json instead.
+        """
+        if orjson is not None:
+            raw = orjson.dumps(obj, default=attr_json_default)
+            if b"null" not in raw or not _non_finite(obj):
+                return raw.decode()
+        elif ujson is not None:
+            try:
+                return ujson.dumps(obj, ensure_ascii=True, default=attr_json_default)
+            except (TypeError, OverflowError):
+                # OverflowError: NaN or infinity on ujson before 5.4
+                pass
+        return _plain_encoder.encode(obj)
+
+    @staticmethod
+    def loads_plain(s: str) -> AttrDict:
+        """loads() without ObjectId and date conversion, for payloads that carry neither."""
+        return _plain_decoder.decode(s)
+
+
+class TestDumpsPlain(unittest.TestCase):
+    def test_non_finite_on_every_backend(self):
+        global orjson, ujson
+        backends = (orjson, ujson)
+        obj = AttrDict([("a", float("nan")), ("b", [float("inf"), -float("inf")]), ("c", None)])
+        try:
+            for orjson, ujson in ((backends[0], None), (None, backends[1]), (None, None)):
+                self.assertEqual(AttrJson.dumps_plain(obj), '{"a":NaN,"b":[Infinity,-Infinity],"c":null}')
+                self.assertEqual(AttrJson.dumps_plain(AttrDict(c=None)), '{"c":null}')
+        finally:
+            orjson, ujson = backends
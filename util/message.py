@@ -1,6 +1,6 @@
 # coding=utf-8
 
-from typing import Callable, Any, no_type_check, Dict
+from typing import Callable, Any, no_type_check, Dict, List, Union
 
 from autobahn.twisted.wamp import Application
 from autobahn.twisted.websocket import WebSocketClientFactory, WebSocketClientProtocol
@@ -10,9 +10,12 @@ from twisted.application.internet import ClientService
 from twisted.internet.defer import Deferred
 from twisted.internet.endpoints import clientFromString
 from twisted.internet.endpoints import serverFromString
-from twisted.internet.interfaces import IStreamServerEndpoint
+from twisted.internet.interfaces import IStreamServerEndpoint, IPushProducer
+from zope.interface import implementer
 
 from util import reactor
+from util.compress import algorithms, compress, decompress
+from util.compress import accept_protocol, offer_protocols, split_protocol
 from util.exception import print_frame
 from util.observer import Observer
 from util.observer import signal
@@ -75,14 +78,30 @@ class WsClientProtocol(WebSocketClientProtocol):
         self.state: int = -1
         super().__init__()
 
+    def onOpen(self) -> None:
+        # the transport pauses the message while its send buffer is full
+        message = self.factory.message
+        message.paused = False
+        self.registerProducer(message, True)
+        message.drained()
+
+    @no_type_check
+    def onClose(self, was_clean, code, reason):
+        self.factory.message.paused = False
+
     def onMessage(self, payload: bytes, is_binary: bool) -> None:
         if not is_binary:
             self.factory.message.recv_message(payload.decode())
+        else:
+            self.factory.message.recv_message(decompress(payload))
 
 
 class WsClientFactory(WebSocketClientFactory):
     def __init__(self, message: 'WsClientMessage') -> None:
-        super().__init__()
+        protocols = message.protocols
+        if protocols and message.compression:
+            protocols = offer_protocols(protocols, message.compression)
+        super().__init__(protocols=protocols or None)
         self.message: WsClientMessage = message
 
     @no_type_check
@@ -92,14 +111,56 @@ class WsClientFactory(WebSocketClientFactory):
         return p
 
 
+@implementer(IPushProducer)
 class WsClientMessage(Observer):
-    def __init__(self) -> None:
+    def __init__(self, protocols: List[str]=None, compression: List[str]=None) -> None:
         self.session: WebSocketClientProtocol = None
         self.service: ClientService = None
         self.endpoint: IStreamServerEndpoint = None
         self.factory: WsClientFactory = None
+        self.protocols: List[str] = protocols or list()
+        self.compression: List[str] = [
+            algorithm for algorithm in compression or list()
+            if algorithm in algorithms()
+        ]
+        self.paused: bool = False
         super().__init__()
 
+    @property
+    def writable(self) -> bool:
+        """Open and not pushed back by the transport."""
+        return (self.session is not None and not self.paused and
+                self.session.state == WebSocketProtocol.STATE_OPEN)
+
+    def pauseProducing(self) -> None:
+        self.paused = True
+
+    def resumeProducing(self) -> None:
+        self.paused = False
+        self.drained()
+
+    def stopProducing(self) -> None:
+        self.paused = False
+
+    @signal
+    def drained(self) -> None:
+        pass
+
+    @property
+    def protocol_in_use(self) -> str:
+        """Subprotocol the server accepted during the handshake, if any."""
+        if (self.session and self.session.state ==
+                WebSocketProtocol.STATE_OPEN):
+            return split_protocol(self.session.websocket_protocol_in_use)[0]
+        return None
+
+    @property
+    def compression_in_use(self) -> str:
+        if (self.session and self.session.state ==
+                WebSocketProtocol.STATE_OPEN):
+            return split_protocol(self.session.websocket_protocol_in_use)[1]
+        return None
+
     def run(self, sock: str) -> None:
         self.factory = WsClientFactory(self)
         self.factory.protocol = WsClientProtocol
@@ -124,12 +185,26 @@ class WsClientMessage(Observer):
     def send_message(self, content: str) -> None:
         if (self.session and self.session.state ==
                 WebSocketProtocol.STATE_OPEN):
-            self.session.sendMessage(content.encode())
+            algorithm = self.compression_in_use
+            if algorithm:
+                self.session.sendMessage(compress(content, algorithm), isBinary=True)
+            else:
+                self.session.sendMessage(content.encode())
+        else:
+            print('self session is None')
+
+    def send_binary(self, content: bytes) -> None:
+        if (self.session and self.session.state ==
+                WebSocketProtocol.STATE_OPEN):
+            algorithm = self.compression_in_use
+            if algorithm:
+                content = compress(content, algorithm)
+            self.session.sendMessage(content, isBinary=True)
         else:
             print('self session is None')
 
     @signal
-    def recv_message(self, data: str) -> None:
+    def recv_message(self, data: Union[str, bytes]) -> None:
         pass
 
 
@@ -138,9 +213,16 @@ class WsServerProtocol(WebSocketServerProtocol):
         self.state: int = -1
         super().__init__()
 
+    @no_type_check
+    def onConnect(self, request):
+        message = self.factory.message
+        return accept_protocol(request.protocols, message.protocols, message.compression)
+
     def onMessage(self, payload: bytes, is_binary: bool) -> None:
         if not is_binary:
             self.factory.message.recv_message(payload.decode())
+        else:
+            self.factory.message.recv_message(decompress(payload))
 
 
 class WsServerFactory(WebSocketServerFactory):
@@ -156,10 +238,15 @@ class WsServerFactory(WebSocketServerFactory):
 
 
 class WsServerMessage(Observer):
-    def __init__(self) -> None:
+    def __init__(self, protocols: List[str]=None, compression: List[str]=None) -> None:
         self.session: WebSocketProtocol = None
         self.factory: WsServerFactory = None
         self.server: IStreamServerEndpoint = None
+        self.protocols: List[str] = protocols or list()
+        self.compression: List[str] = [
+            algorithm for algorithm in compression or list()
+            if algorithm in algorithms()
+        ]
         super().__init__()
 
     def run(self, sock: str) -> None:
@@ -180,12 +267,16 @@ class WsServerMessage(Observer):
         if (self.session and self.session.state ==
                 WebSocketProtocol.STATE_OPEN):
             try:
-                self.session.sendMessage(content.encode())
+                algorithm = split_protocol(self.session.websocket_protocol_in_use)[1]
+                if algorithm:
+                    self.session.sendMessage(compress(content, algorithm), isBinary=True)
+                else:
+                    self.session.sendMessage(content.encode())
             except Exception as e:
                 print_frame(e)
         else:
             print('self session is None')
 
     @signal
-    def recv_message(self, data: str) -> None:
+    def recv_message(self, data: Union[str, bytes]) -> None:
         pass
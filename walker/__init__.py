@@ -95,8 +95,9 @@ class WalkerApp:
             self.run_set_config
         )
 
+        from util.batch import BATCH_PROTOCOL
         from util.message import WsServerMessage
-        self.collect = WsServerMessage()
+        self.collect = WsServerMessage([BATCH_PROTOCOL])
         self.collect.add_slot(WsServerMessage.recv_message, self.apm.data)
         self.collect.run(options.config.unix_sock)
 
@@ -1,11 +1,16 @@
 # coding=utf-8
 
-from typing import List
+import unittest
+from typing import Dict, List, Tuple, Union
 
+from orderedattrdict import AttrDict
 from tornado.options import options
+from twisted.internet import task
 from twisted.internet.defer import Deferred
 
-from util import reactor, get_isp_idc
+from util import reactor, get_isp_idc, get_hostname
+from util.batch import decode_batch, encode_batch
+from util.compress import compress
 from util.json import AttrJson
 from util.message import WampMessage
 from util.protocol import ConfigGetResponse
@@ -18,39 +23,38 @@ class ApmHandler(WalkerHandler):
         self.config: ConfigGetResponse = ConfigGetResponse()
         super().__init__(message)
 
+        # pre-aggregation: [latest point, sum, count] per (metric, tags, 10s bucket)
+        self.pending: Dict[Tuple, List] = dict()
+        self.looper: task.LoopingCall = None
+        if options.apm_preaggregate:
+            self.looper = task.LoopingCall(self.flush)
+            self.looper.start(10, now=False)
+
     def name(self) -> str:
         return "apm"
 
     def set_config(self, data: str) -> None:
         self.config = ConfigGetResponse(data)
 
-    def data(self, content: str) -> None:
+    def data(self, content: Union[str, bytes]) -> None:
         if not content:
             return
 
         send_list: List[str] = list()
 
-        for line in content.split('\n'):
-            if not line:
-                continue
-
-            item = AttrJson.loads(line)
+        if isinstance(content, bytes):
+            items = decode_batch(content)
+        else:
+            items = [AttrJson.loads_plain(line) for line in content.split('\n') if line]
 
-            item.area = self.config.area
-            item.country = self.config.country
-            item.province = self.config.province
-            item.role = self.config.role
-            item.isp = self.config.isp
-            item.idc = self.config.idc
-
-            if item.isp == 'unknown' or item.idc == 'unknown':
-                isp, idc = get_isp_idc()
-                if isp:
-                    item.isp = isp
-                if idc:
-                    item.idc = idc
+        if self.looper is not None:
+            for item in items:
+                self.merge(item)
+            return
 
-            send_list.append(AttrJson.dumps(item))
+        for item in items:
+            self.stamp(item)
+            send_list.append(AttrJson.dumps_plain(item))
 
         if send_list:
             reactor().callLater(
@@ -65,12 +69,120 @@ class ApmHandler(WalkerHandler):
             reactor().callLater(5, self.data, content, False)
         """
 
+    def stamp(self, item: AttrDict) -> None:
+        item.area = self.config.area
+        item.country = self.config.country
+        item.province = self.config.province
+        item.role = self.config.role
+        item.isp = self.config.isp
+        item.idc = self.config.idc
+
+        if item.isp == 'unknown' or item.idc == 'unknown':
+            isp, idc = get_isp_idc()
+            if isp:
+                item.isp = isp
+            if idc:
+                item.idc = idc
+
+    def merge(self, item: AttrDict) -> None:
+        tags = tuple(
+            (k, v) for k, v in item.items()
+            if k not in ("metric", "ts", "value", "host")
+        )
+        key = (item.metric, int(item.ts) // 10, tags)
+        if not isinstance(item.value, (int, float)) or isinstance(item.value, bool):
+            # None and str values of a batch are sent as they are, one by one
+            self.pending[(key, len(self.pending))] = [item, item.value, 1]
+            return
+
+        merged = self.pending.get(key)
+        if merged is None:
+            self.pending[key] = [item, item.value, 1]
+        else:
+            merged[0] = item
+            merged[1] += item.value
+            merged[2] += 1
+
+    @staticmethod
+    def aggregate(item: AttrDict, total: Union[int, float], count: int) -> AttrDict:
+        """
+        The point a bucket is sent as, at its latest sample: counter
+        increases (send_counter's <metric>.delta) add up over the bucket,
+        gauges and rates are averaged.
+        """
+        if count > 1:
+            item.value = total if item.metric.endswith(".delta") else total / count
+        return item
+
+    def flush(self) -> None:
+        """
+        Sends the merged points as one batch; repeated strings and the tag
+        sets shared by a host's series are encoded once.
+        """
+        if not self.pending:
+            return
+
+        items = [self.aggregate(*merged) for merged in self.pending.values()]
+        self.pending = dict()
+        for item in items:
+            self.stamp(item)
+
+        reactor().callLater(
+            self.offset,
+            self.send_apm,
+            encode_batch(get_hostname(), items)
+        )
+
     def call_config(self, data: str) -> Deferred:
         return self.message.rpc(
             options.topic_config_get, data
         )
 
-    def send_apm(self, data: str) -> bool:
+    def send_apm(self, data: Union[str, bytes]) -> bool:
+        if options.apm_compress:
+            data = compress(data, options.apm_compress)
         return self.message.send(
             options.topic_apm_collector, data
         )
+
+
+class TestMerge(unittest.TestCase):
+    def setUp(self):
+        # no message or config needed for merging
+        self.handler = ApmHandler.__new__(ApmHandler)
+        self.handler.pending = dict()
+
+    def point(self, metric, ts, value, **tags):
+        item = AttrDict(metric=metric, ts=ts, value=value)
+        item.update(tags)
+        return item
+
+    def merged(self):
+        return sorted(
+            (item.metric, item.ts, item.value)
+            for item in (ApmHandler.aggregate(*merged) for merged in self.handler.pending.values())
+        )
+
+    def test_gauge(self):
+        for ts, value in ((100, 1), (103, 2), (106, 6), (111, 5)):
+            self.handler.merge(self.point("cpu.idle", ts, value, disk="sda"))
+        self.assertEqual(self.merged(), [("cpu.idle", 106, 3.0), ("cpu.idle", 111, 5.0)])
+
+    def test_delta(self):
+        for ts, value in ((100, 1), (103, 2), (106, 6)):
+            self.handler.merge(self.point("net.bytes.delta", ts, value))
+        self.assertEqual(self.merged(), [("net.bytes.delta", 106, 9.0)])
+
+    def test_not_numeric(self):
+        for ts, value in ((100, None), (103, None), (104, "up"), (105, "down"), (106, 2), (107, 4)):
+            self.handler.merge(self.point("link.state", ts, value))
+        self.assertEqual(
+            [(item.ts, item.value) for item in
+             (ApmHandler.aggregate(*merged) for merged in self.handler.pending.values())],
+            [(100, None), (103, None), (104, "up"), (105, "down"), (107, 3.0)]
+        )
+
+    def test_tags(self):
+        self.handler.merge(self.point("disk.util", 100, 1, disk="sda"))
+        self.handler.merge(self.point("disk.util", 101, 3, disk="sdb"))
+        self.assertEqual(len(self.handler.pending), 2)